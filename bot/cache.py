@@ -0,0 +1,214 @@
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import NamedTuple
+
+from config import SCREEN_CACHE_SIZE, PAGE_SNAPSHOT_TTL
+from database.db import get_telegram_ids_by_cards, mark_written, publish_cache_invalidation
+from database.models import TransactionType
+
+logger = logging.getLogger(__name__)
+
+
+class ScreenCache:
+    """
+    LRU-кэш отрисованных экранов.
+    Ключ содержит версию данных пользователя: импорт, отзыв документа или смена карт
+    увеличивают версию, и старые записи больше не запрашиваются, а со временем вытесняются.
+    Одинаковые одновременные запросы объединяются — считает только первый.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._versions = {}
+        # общая версия данных для сводных экранов по всем клиентам
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def version(self, telegram_id: int) -> int:
+        return self._versions.get(telegram_id, 0)
+
+    def bump(self, *telegram_ids: int):
+        for telegram_id in telegram_ids:
+            self._versions[telegram_id] = self._versions.get(telegram_id, 0) + 1
+
+    def bump_generation(self):
+        self.generation += 1
+
+    def clear(self):
+        self._entries.clear()
+
+    def get(self, key):
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    async def get_or_compute(self, key, factory):
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.coalesced += 1
+            return await asyncio.shield(inflight)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value = await factory()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # помечаем исключение как полученное, если ожидающих не было
+            future.exception()
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+        future.set_result(value)
+        self.put(key, value)
+        return value
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses + self.coalesced
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "hit_ratio": (self.hits + self.coalesced) / total if total else 0.0,
+        }
+
+
+class TransactionSnapshot(NamedTuple):
+    """Компактная копия строки сделки для клавиатуры и карточки деталей."""
+    id: int
+    card_number: str
+    date: datetime
+    item_name: str
+    cost: float
+    type: TransactionType
+
+    @classmethod
+    def from_transaction(cls, t):
+        return cls(t.id, t.card_number, t.date, t.item_name, t.cost, t.type)
+
+
+class PageSnapshotCache:
+    """
+    Короткоживущий кэш последней показанной страницы сделок пользователя:
+    карты пользователя и снимки строк страницы по id.
+    Позволяет открыть детали сделки без повторного запроса в БД.
+    """
+
+    def __init__(self, ttl: float, max_users: int):
+        self.ttl = ttl
+        self.max_users = max_users
+        self._entries = OrderedDict()  # telegram_id -> (истекает, карты, {id: снимок})
+
+    def put(self, telegram_id: int, cards, rows):
+        expires = time.monotonic() + self.ttl
+        self._entries[telegram_id] = (expires, frozenset(cards), {r.id: r for r in rows})
+        self._entries.move_to_end(telegram_id)
+        if len(self._entries) > self.max_users:
+            self._entries.popitem(last=False)
+
+    def get(self, telegram_id: int):
+        """Возвращает (карты, строки) или None, если снимка нет или он устарел."""
+        entry = self._entries.get(telegram_id)
+        if entry is None:
+            return None
+        expires, cards, rows = entry
+        if expires < time.monotonic():
+            del self._entries[telegram_id]
+            return None
+        return cards, rows
+
+    def drop(self, *telegram_ids: int):
+        for telegram_id in telegram_ids:
+            self._entries.pop(telegram_id, None)
+
+    def clear(self):
+        self._entries.clear()
+
+
+screen_cache = ScreenCache(SCREEN_CACHE_SIZE)
+# file_id уже отправленных выписок: повторный запрос отдаётся без генерации
+statement_cache = ScreenCache(SCREEN_CACHE_SIZE)
+page_snapshots = PageSnapshotCache(PAGE_SNAPSHOT_TTL, SCREEN_CACHE_SIZE)
+
+
+# Сколько id пользователей помещается в одно сообщение NOTIFY (лимит payload — 8000 байт)
+NOTIFY_IDS_PER_MESSAGE = 500
+
+
+def apply_invalidation(telegram_ids, generation: bool = False):
+    """Сброс локальных кэшей; вызывается и для своих изменений, и по сообщениям других экземпляров."""
+    if generation:
+        screen_cache.bump_generation()
+    # данные пользователя изменились: читаем их с основной БД, пока реплика не догонит
+    mark_written(*telegram_ids)
+    screen_cache.bump(*telegram_ids)
+    page_snapshots.drop(*telegram_ids)
+
+
+def reset_local_caches():
+    """Полный сброс, когда сообщения о сбросе могли быть потеряны."""
+    screen_cache.bump_generation()
+    screen_cache.clear()
+    page_snapshots.clear()
+
+
+async def publish_invalidation(telegram_ids, generation: bool = False):
+    """Рассылает сброс остальным экземплярам бота через NOTIFY."""
+    from bot.cluster import INSTANCE_ID
+
+    telegram_ids = list(telegram_ids)
+    for start in range(0, max(len(telegram_ids), 1), NOTIFY_IDS_PER_MESSAGE):
+        payload = {
+            "src": INSTANCE_ID,
+            "users": telegram_ids[start:start + NOTIFY_IDS_PER_MESSAGE],
+            "generation": generation,
+        }
+        try:
+            await publish_cache_invalidation(json.dumps(payload))
+        except Exception as e:
+            logger.warning(f"Failed to publish cache invalidation: {e}")
+            return
+
+
+async def invalidate_user(telegram_id: int):
+    apply_invalidation([telegram_id])
+    await publish_invalidation([telegram_id])
+
+
+async def invalidate_cards(cards):
+    """Сбрасывает кэш всех пользователей, к которым привязаны указанные карты, и сводные экраны."""
+    telegram_ids = await get_telegram_ids_by_cards(cards)
+    apply_invalidation(telegram_ids, generation=True)
+    await publish_invalidation(telegram_ids, generation=True)
@@ -0,0 +1,183 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+import zlib
+from contextlib import asynccontextmanager
+
+from bot.cache import apply_invalidation, reset_local_caches
+from config import LEADER_CHECK_INTERVAL
+from database.db import (
+    engine,
+    IS_POSTGRES,
+    CACHE_CHANNEL,
+    advisory_lock,
+    advisory_unlock,
+    try_advisory_lock,
+    ping,
+)
+
+logger = logging.getLogger(__name__)
+
+# Отличает сообщения этого процесса от сообщений других экземпляров
+INSTANCE_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+
+def lock_key(name: str) -> int:
+    """Ключ advisory-блокировки Postgres по имени (одинаковый во всех процессах)."""
+    return zlib.crc32(f"roadcards:{name}".encode())
+
+
+_local_locks = {}
+
+
+@asynccontextmanager
+async def cluster_lock(name: str):
+    """
+    Блокировка на весь кластер: пока она взята, другой экземпляр с тем же именем ждёт.
+    Держится на отдельном соединении и снимается при его закрытии, даже если процесс упал.
+    Без Postgres экземпляр один, и хватает блокировки внутри процесса.
+    """
+    if not IS_POSTGRES:
+        async with _local_locks.setdefault(name, asyncio.Lock()):
+            yield
+        return
+    key = lock_key(name)
+    async with engine.connect() as conn:
+        await advisory_lock(conn, key)
+        try:
+            yield
+        finally:
+            await advisory_unlock(conn, key)
+
+
+class LeaderElector:
+    """
+    Выбор ведущего экземпляра через pg_try_advisory_lock на выделенном соединении.
+    Ведущий запускает зарегистрированные одиночные задачи (polling, папка загрузки,
+    плановые пересчёты); если соединение пропало, задачи останавливаются,
+    а блокировку забирает другой экземпляр.
+    """
+
+    def __init__(self, name: str, interval: float):
+        self.key = lock_key(name)
+        self.interval = interval
+        self.is_leader = False
+        self.elections = 0
+        self._factories = {}
+        self._tasks = {}
+        self._runner = None
+
+    def run_while_leader(self, name: str, factory):
+        """factory() возвращает корутину; она запускается при получении лидерства."""
+        self._factories[name] = factory
+        if self.is_leader:
+            self._start(name)
+
+    def _start(self, name: str):
+        task = self._tasks.get(name)
+        if task is None or task.done():
+            self._tasks[name] = asyncio.create_task(self._factories[name]())
+            self._tasks[name].add_done_callback(lambda t, name=name: self._on_done(name, t))
+
+    def _on_done(self, name: str, task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Leader task {name} failed", exc_info=task.exception())
+
+    def _stop_all(self):
+        for task in self._tasks.values():
+            task.cancel()
+        self._tasks.clear()
+
+    async def _hold(self, conn):
+        """Держит лидерство, пока соединение живо."""
+        self.is_leader = True
+        self.elections += 1
+        logger.info(f"Instance {INSTANCE_ID} became leader")
+        for name in self._factories:
+            self._start(name)
+        try:
+            while True:
+                await asyncio.sleep(self.interval)
+                await ping(conn)
+        finally:
+            self.is_leader = False
+            self._stop_all()
+            logger.warning(f"Instance {INSTANCE_ID} lost leadership")
+
+    async def run(self):
+        if not IS_POSTGRES:
+            # без Postgres экземпляр один — он и ведущий
+            self.is_leader = True
+            self.elections += 1
+            for name in self._factories:
+                self._start(name)
+            return
+        while True:
+            try:
+                async with engine.connect() as conn:
+                    try:
+                        while True:
+                            if await try_advisory_lock(conn, self.key):
+                                await self._hold(conn)
+                            await asyncio.sleep(self.interval)
+                    except BaseException:
+                        # соединение с блокировкой не возвращаем в пул — закрываем
+                        await conn.invalidate()
+                        raise
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Leader election connection failed: {e}")
+                await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._runner is None:
+            self._runner = asyncio.create_task(self.run())
+        return self._runner
+
+    def stats(self) -> dict:
+        return {
+            "instance": INSTANCE_ID,
+            "leader": self.is_leader,
+            "elections": self.elections,
+            "tasks": sorted(name for name, task in self._tasks.items() if not task.done()),
+        }
+
+
+leader = LeaderElector("leader", LEADER_CHECK_INTERVAL)
+
+
+async def listen_cache_invalidations():
+    """
+    Слушает канал сброса кэшей (LISTEN/NOTIFY) и применяет сообщения других экземпляров
+    к локальным кэшам. При обрыве соединения переподключается и очищает локальные кэши,
+    так как сообщения за время обрыва потеряны.
+    """
+    def on_message(connection, pid, channel, payload):
+        message = json.loads(payload)
+        if message.get("src") == INSTANCE_ID:
+            return
+        apply_invalidation(message.get("users", []), message.get("generation", False))
+
+    if not IS_POSTGRES:
+        return
+    while True:
+        try:
+            async with engine.connect() as conn:
+                raw = await conn.get_raw_connection()
+                driver = raw.driver_connection
+                await driver.add_listener(CACHE_CHANNEL, on_message)
+                try:
+                    while not driver.is_closed():
+                        await asyncio.sleep(LEADER_CHECK_INTERVAL)
+                finally:
+                    if not driver.is_closed():
+                        await driver.remove_listener(CACHE_CHANNEL, on_message)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Cache invalidation listener failed: {e}")
+        reset_local_caches()
+        await asyncio.sleep(LEADER_CHECK_INTERVAL)
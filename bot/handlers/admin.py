@@ -1,6 +1,6 @@
 from aiogram import Router, F, Bot
 from aiogram.types import Message, CallbackQuery, FSInputFile
-from aiogram.filters import Command
+from aiogram.filters import Command, CommandObject
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from bot.keyboards import (
@@ -8,17 +8,49 @@ from bot.keyboards import (
     get_report_type_kb,
     get_confirm_format_kb,
     get_documents_kb,
+    get_admin_back_kb,
+    get_search_results_kb,
 )
-from bot.utils import update_last_update_time
-from database.db import add_to_whitelist, async_session
-from database.models import Transaction, TransactionType
-import pandas as pd
-import io
+from bot.cache import screen_cache
+from bot.middlewares import throttling_middleware
+from bot.notify import notifier
+from bot.reports import (
+    validate_format,
+    make_document_label,
+    import_report,
+    after_data_change,
+    extract_zip_reports,
+    import_many,
+    ImportResult,
+    merge_collision_reports,
+)
+from bot.jobs import job_queue
+from bot.cluster import leader
+from bot.scheduler import scheduler
+from tracing import tracer
+from bot.prices import render_station_prices
+from bot.utils import format_number, MONTH_NAMES_RU
+from database.db import (
+    delete_document,
+    get_all_telegram_ids,
+    delete_import_checkpoints,
+    get_fleet_analytics,
+    get_pool_stats,
+    get_documents,
+    archive_transactions,
+    advance_rollup_watermark,
+    get_transactions_for_export,
+    get_user_by_card,
+    get_all_user_cards,
+    get_cards_balance_as_of,
+    search_transactions,
+)
+from database.models import TransactionType
+import asyncio
 import os
-import openpyxl
+import zipfile
 from datetime import datetime
-from sqlalchemy import select, and_
-from config import ADMIN_IDS
+from config import ADMIN_IDS, ZIP_WORKERS
 import re
 
 router = Router()
@@ -33,6 +65,7 @@ class AdminState(StatesGroup):
     confirm_format_payment = State()
     waiting_for_link_card = State()
     waiting_for_document_choice = State()
+    waiting_for_search_query = State()
 
 
 def parse_cards_from_text(raw_value: str) -> list[str]:
@@ -45,6 +78,36 @@ def parse_cards_from_text(raw_value: str) -> list[str]:
             unique_cards.append(card)
     return unique_cards
 
+SEARCH_PAGE_SIZE = 10
+SEARCH_PERIOD_RE = re.compile(r"^(\d{2}\.\d{2}\.\d{4})-(\d{2}\.\d{2}\.\d{4})$")
+SEARCH_TYPES = {
+    "траты": TransactionType.EXPENSE,
+    "трата": TransactionType.EXPENSE,
+    "оплаты": TransactionType.PAYMENT,
+    "оплата": TransactionType.PAYMENT,
+}
+
+
+def parse_search_request(raw_value: str) -> dict:
+    """
+    «<текст> [ДД.ММ.ГГГГ-ДД.ММ.ГГГГ] [траты|оплаты]» -> параметры поиска.
+    Даты хранятся строками, чтобы их можно было положить в состояние FSM.
+    """
+    params = {"query": "", "start": None, "end": None, "type": None}
+    words = []
+    for token in (raw_value or "").split():
+        period = SEARCH_PERIOD_RE.match(token)
+        if period:
+            datetime.strptime(period.group(1), "%d.%m.%Y")
+            datetime.strptime(period.group(2), "%d.%m.%Y")
+            params["start"], params["end"] = period.group(1), period.group(2)
+        elif token.lower() in SEARCH_TYPES:
+            params["type"] = SEARCH_TYPES[token.lower()].value
+        else:
+            words.append(token)
+    params["query"] = " ".join(words)
+    return params
+
 def is_admin(user_id: int):
     return user_id in ADMIN_IDS
 
@@ -54,6 +117,102 @@ async def cmd_admin(message: Message):
         return
     await message.answer("Админ-панель:", reply_markup=get_admin_main_menu())
 
+@router.message(Command("metrics"))
+async def cmd_metrics(message: Message):
+    if not is_admin(message.from_user.id):
+        return
+    cache = screen_cache.stats()
+    throttling = throttling_middleware.stats()
+    notifications = notifier.stats()
+    text = (
+        "📈 Метрики бота\n\n"
+        f"Кэш экранов: {cache['size']}/{cache['max_size']}\n"
+        f"Попадания: {cache['hits']}, промахи: {cache['misses']}, "
+        f"объединено: {cache['coalesced']}, вытеснено: {cache['evictions']}\n"
+        f"Доля попаданий: {cache['hit_ratio']:.1%}\n\n"
+        f"Ограничение частоты: отклонено {throttling['throttled']}, "
+        f"склеено повторов {throttling['merged']}, пользователей {throttling['tracked_users']}\n\n"
+        f"Уведомления: в очереди {notifications['queued']}, отправлено {notifications['sent']}, "
+        f"ошибок {notifications['failed']}"
+    )
+    jobs = job_queue.stats()
+    text += (
+        f"\n\nФоновые задания: в очереди {jobs['queued']}, выполнено {jobs['done']}, "
+        f"с ошибкой {jobs['failed']}"
+    )
+    traces = tracer.stats()
+    if traces["enabled"]:
+        text += f"\n\nТрассировка: записано {traces['written']}, пропущено выборкой {traces['dropped']}"
+    cluster = leader.stats()
+    text += (
+        f"\n\nЭкземпляр {cluster['instance']}: "
+        f"{'ведущий' if cluster['leader'] else 'ведомый'}, задачи ведущего: "
+        f"{', '.join(cluster['tasks']) or 'нет'}"
+    )
+    for name, job in scheduler.stats().items():
+        last_run = job["last_run"].strftime("%d.%m %H:%M") if job["last_run"] else "ещё не было"
+        text += (
+            f"\n\nЗадание {name}: запусков {job['runs']}, ошибок {job['failures']}, "
+            f"превышений бюджета {job['timeouts']}, последний {last_run} "
+            f"({job['last_duration']:.1f} с)"
+        )
+    for name, pool in get_pool_stats().items():
+        text += (
+            f"\n\nПул БД ({name}): размер {pool['size']}, выдано {pool['checked_out']}, "
+            f"переполнение {pool['overflow']}, таймауты {pool['timeouts']}\n"
+            f"Ожидание соединения: среднее {pool['wait_avg_ms']:.1f} мс, максимум {pool['wait_max_ms']:.1f} мс"
+        )
+    await message.answer(text)
+
+@router.message(Command("archive"))
+async def cmd_archive(message: Message, command: CommandObject):
+    """/archive ДД.ММ.ГГГГ — перенести в архив сделки до указанной даты."""
+    if not is_admin(message.from_user.id):
+        return
+    try:
+        cutoff = datetime.strptime((command.args or "").strip(), "%d.%m.%Y")
+    except ValueError:
+        await message.answer("Укажите дату: /archive ДД.ММ.ГГГГ — сделки до этой даты будут перенесены в архив.")
+        return
+
+    await message.answer("Архивация запущена...")
+    archived, summaries, cards = await archive_transactions(cutoff)
+    await after_data_change(cards)
+    await advance_rollup_watermark()
+    await message.answer(
+        f"Архивация завершена.\nПеренесено сделок: {archived}\n"
+        f"Итоговых строк по месяцам: {summaries}\nЗатронуто карт: {len(cards)}"
+    )
+
+@router.message(Command("balance_at"))
+async def cmd_balance_at(message: Message, command: CommandObject):
+    """/balance_at <карта или telegram_id> ДД.ММ.ГГГГ — баланс клиента на конец указанного дня."""
+    if not is_admin(message.from_user.id):
+        return
+    args = (command.args or "").split()
+    try:
+        as_of = datetime.strptime(args[1], "%d.%m.%Y").date()
+        target = args[0]
+    except (IndexError, ValueError):
+        await message.answer("Использование: /balance_at <карта или telegram_id> ДД.ММ.ГГГГ")
+        return
+
+    # Карта зарегистрирована — считаем по всем картам её владельца
+    owner = await get_user_by_card(target)
+    cards = []
+    if owner is not None:
+        cards = await get_all_user_cards(owner.telegram_id)
+    elif target.isdigit():
+        cards = await get_all_user_cards(int(target))
+    if not cards:
+        cards = [target]
+
+    balance = await get_cards_balance_as_of(cards, as_of)
+    await message.answer(
+        f"Баланс на конец {as_of.strftime('%d.%m.%Y')}: {-balance:.2f} рублей\n"
+        f"Карты: {', '.join(cards)}"
+    )
+
 @router.callback_query(F.data == "admin_upload")
 async def process_upload_report(callback: CallbackQuery):
     if not is_admin(callback.from_user.id):
@@ -68,14 +227,7 @@ async def list_documents(callback: CallbackQuery, state: FSMContext):
         await callback.answer("Доступ запрещен")
         return
 
-    async with async_session() as session:
-        result = await session.execute(
-            select(Transaction.document)
-            .where(Transaction.document.is_not(None))
-            .distinct()
-            .order_by(Transaction.document)
-        )
-        docs = [d for (d,) in result.all() if d]
+    docs = await get_documents()
 
     if not docs:
         await callback.message.edit_text("Документы (дампы) не найдены.")
@@ -90,6 +242,134 @@ async def list_documents(callback: CallbackQuery, state: FSMContext):
     await state.set_state(AdminState.waiting_for_document_choice)
     await callback.answer()
 
+async def render_fleet_analytics():
+    analytics = await get_fleet_analytics()
+    expenses = analytics["expenses"]
+    payments = analytics["payments"]
+    text = (
+        "📈 Аналитика по всем клиентам\n\n"
+        f"🔴 Списания: {format_number(expenses)} ₽\n"
+        f"🟢 Оплаты: {format_number(payments)} ₽\n"
+        f"⚖️ Сальдо (оплаты − списания): {format_number(payments - expenses)} ₽\n"
+    )
+
+    if analytics["top_cards"]:
+        text += "\n🏆 Карты с наибольшими тратами:\n"
+        for pos, item in enumerate(analytics["top_cards"], start=1):
+            text += (
+                f"{pos}. {item['card']}: {format_number(item['cost'])} ₽ "
+                f"({format_number(item['liters'])} л)\n"
+            )
+
+    if analytics["monthly"]:
+        text += "\n⛽ Заправлено по месяцам:\n"
+        for item in analytics["monthly"]:
+            month_name = MONTH_NAMES_RU.get(item["month"], str(item["month"]))
+            text += (
+                f"• {month_name} {item['year']}: {format_number(item['liters'])} л "
+                f"({format_number(item['cost'])} ₽)\n"
+            )
+    return text
+
+@router.callback_query(F.data == "admin_analytics")
+async def show_fleet_analytics(callback: CallbackQuery):
+    if not is_admin(callback.from_user.id):
+        await callback.answer("Доступ запрещен")
+        return
+    # Итоги читаются из card_month_totals и кэшируются до следующего импорта или отзыва
+    text = await screen_cache.get_or_compute(
+        ("admin_analytics", screen_cache.generation), render_fleet_analytics
+    )
+    await callback.message.edit_text(text, reply_markup=get_admin_back_kb())
+    await callback.answer()
+
+@router.callback_query(F.data.startswith("admin_prices"))
+async def show_station_prices(callback: CallbackQuery):
+    if not is_admin(callback.from_user.id):
+        await callback.answer("Доступ запрещен")
+        return
+    year = month = None
+    parts = callback.data.split("_")
+    if len(parts) == 4:
+        year, month = int(parts[2]), int(parts[3])
+    text, kb = await render_station_prices(
+        year, month, prefix="admin_prices", back_callback="admin_main", detailed=True
+    )
+    await callback.message.edit_text(text, reply_markup=kb)
+    await callback.answer()
+
+@router.callback_query(F.data == "admin_search")
+async def search_start(callback: CallbackQuery, state: FSMContext):
+    if not is_admin(callback.from_user.id):
+        await callback.answer("Доступ запрещен")
+        return
+    await callback.message.answer(
+        "Введите часть номера карты, адреса АЗС или наименования (от 3 символов).\n"
+        "Можно добавить период и тип: <code>Лукойл 01.01.2026-31.01.2026 траты</code>",
+        parse_mode="HTML",
+    )
+    await state.set_state(AdminState.waiting_for_search_query)
+    await callback.answer()
+
+@router.message(AdminState.waiting_for_search_query)
+async def search_process(message: Message, state: FSMContext):
+    if not is_admin(message.from_user.id):
+        return
+    try:
+        params = parse_search_request(message.text)
+    except ValueError:
+        await message.answer("Неверная дата в периоде. Используйте ДД.ММ.ГГГГ-ДД.ММ.ГГГГ")
+        return
+    if len(params["query"]) < 3:
+        await message.answer("Строка поиска должна содержать не меньше 3 символов.")
+        return
+    await state.set_state(None)
+    await state.update_data(search=params)
+    text, kb = await render_search_page(params, 0)
+    await message.answer(text, reply_markup=kb)
+
+@router.callback_query(F.data.startswith("admin_search_page_"))
+async def search_page(callback: CallbackQuery, state: FSMContext):
+    if not is_admin(callback.from_user.id):
+        await callback.answer("Доступ запрещен")
+        return
+    params = (await state.get_data()).get("search")
+    if not params:
+        await callback.answer("Поиск устарел, начните заново.")
+        return
+    page = int(callback.data.split("_")[-1])
+    text, kb = await render_search_page(params, page)
+    await callback.message.edit_text(text, reply_markup=kb)
+    await callback.answer()
+
+async def render_search_page(params: dict, page: int):
+    start_date = datetime.strptime(params["start"], "%d.%m.%Y") if params["start"] else None
+    end_date = (
+        datetime.strptime(params["end"], "%d.%m.%Y").replace(hour=23, minute=59, second=59)
+        if params["end"] else None
+    )
+    t_type = TransactionType(params["type"]) if params["type"] else None
+    rows, has_more = await search_transactions(
+        params["query"],
+        start_date,
+        end_date,
+        t_type,
+        limit=SEARCH_PAGE_SIZE,
+        offset=page * SEARCH_PAGE_SIZE,
+    )
+
+    text = f"🔎 Поиск «{params['query']}», страница {page + 1}:\n\n"
+    if not rows:
+        text += "Ничего не найдено."
+    for t in rows:
+        prefix = "🔴" if t.type == TransactionType.EXPENSE else "🟢"
+        text += (
+            f"{prefix} {t.date.strftime('%d.%m.%Y %H:%M')} • {t.card_number}\n"
+            f"{t.item_name or ''} • {t.address or ''} • {t.cost:.2f} руб. • {t.document or ''}"
+            f"{' • архив' if t.archived else ''}\n\n"
+        )
+    return text[:4096], get_search_results_kb(page, has_more)
+
 @router.callback_query(F.data == "admin_main")
 async def process_admin_main(callback: CallbackQuery, state: FSMContext):
     if not is_admin(callback.from_user.id):
@@ -120,15 +400,10 @@ async def revoke_document(callback: CallbackQuery, state: FSMContext):
 
     document_label = docs[idx]
 
-    async with async_session() as session:
-        result = await session.execute(
-            select(Transaction).where(Transaction.document == document_label)
-        )
-        txs = result.scalars().all()
-        deleted_count = len(txs)
-        for t in txs:
-            await session.delete(t)
-        await session.commit()
+    deleted_count, affected_cards, affected_months = await delete_document(document_label)
+
+    await delete_import_checkpoints(document_label)
+    await after_data_change(affected_cards, affected_months)
 
     await callback.message.edit_text(
         f"Документ «{document_label}» отозван. "
@@ -149,128 +424,52 @@ async def report_payment_cb(callback: CallbackQuery, state: FSMContext):
     await state.set_state(AdminState.waiting_for_payment_file)
     await callback.answer()
 
-async def validate_format(file_content: bytes):
-    wb = openpyxl.load_workbook(io.BytesIO(file_content), data_only=True)
-    ws = wb.active
-    
-    # B2 is row 2, col 2; A3 is row 3, col 1; B3 is row 3, col 2
-    b2_val = ws.cell(row=2, column=2).value
-    a3_val = ws.cell(row=3, column=1).value
-    b3_val = ws.cell(row=3, column=2).value
-    
-    is_valid = (b2_val is None or str(b2_val).strip() == "") and \
-               (a3_val is None or str(a3_val).strip() == "") and \
-               (b3_val is not None and str(b3_val).strip() != "")
-               
-    return is_valid
-
-async def process_excel_expense(file_content: bytes, document: str):
-    # Format: Фирма, карта, дата, адрес, наименование, количество, цена, стоимость
-    df = pd.read_excel(io.BytesIO(file_content), skiprows=2, usecols="B:I")
-    df.columns = ["firm", "card", "date", "address", "item_name", "quantity", "price", "cost"]
-    return await save_transactions(df, TransactionType.EXPENSE, document)
-
-async def process_excel_payment(file_content: bytes, document: str):
-    # New format for payments: Дата, карта, имя, вид транзакции, стоимость
-    df = pd.read_excel(io.BytesIO(file_content), skiprows=2, usecols="B:F")
-    df.columns = ["date", "card", "item_name", "type_str", "cost"]
-    
-    df["firm"] = ""
-    df["address"] = ""
-    df["quantity"] = 1.0
-    df["price"] = df["cost"]
-    
-    return await save_transactions(df, TransactionType.PAYMENT, document)
+async def submit_zip_import(message: Message, state: FSMContext, zip_content: bytes, zip_name: str, t_type: TransactionType):
+    """ZIP с несколькими отчётами: распаковка и импорт одним фоновым заданием."""
+    await state.clear()
+    try:
+        files = await asyncio.to_thread(extract_zip_reports, zip_content)
+    except (zipfile.BadZipFile, ValueError) as e:
+        await message.answer(f"Не удалось прочитать архив: {e}")
+        return
+    if not files:
+        await message.answer("В архиве нет файлов .xlsx.")
+        return
 
-async def save_transactions(df, t_type: TransactionType, document: str):
-    """
-    Сохраняем транзакции с логикой:
-    - дубликат определяется по: карта, дата, тип, наименование, стоимость (округлённая до целого);
-    - если в БД уже есть любая строка с той же картой и датой (даже если остальные поля отличаются),
-      добавляем предупреждение с номером строки и 4 полями.
-    """
-    df = df.dropna(subset=["card", "date"])
-    added_count = 0
-    skipped_count = 0
-    warnings = []
-
-    async with async_session() as session:
-        for idx, row in df.iterrows():
-            card_number = str(row["card"])
-            date = row["date"]
-
-            if isinstance(date, str):
-                for fmt in ("%d.%m.%Y %H:%M:%S", "%d.%m.%Y %H:%M"):
-                    try:
-                        date = datetime.strptime(date, fmt)
-                        break
-                    except Exception:
-                        continue
-
-            cost_val = float(row["cost"])
-            rounded_cost = int(round(cost_val))
-            item_name = str(row["item_name"])
-
-            # Все существующие сделки с такой же картой и датой
-            result = await session.execute(
-                select(Transaction).where(
-                    and_(
-                        Transaction.card_number == card_number,
-                        Transaction.date == date,
-                    )
-                )
+    ahead = job_queue.submit(zip_name, run_zip_import(message, zip_name, files, t_type))
+    text = f"Архив «{zip_name}» принят: файлов {len(files)}. Итог придёт отдельным сообщением."
+    if ahead:
+        text += f"\nЗаданий в очереди перед ним: {ahead}."
+    await message.answer(text)
+
+async def run_zip_import(message: Message, zip_name: str, files, t_type: TransactionType):
+    results = await import_many(files, t_type, ZIP_WORKERS)
+    kind = "трат" if t_type == TransactionType.EXPENSE else "оплат"
+    total_added = sum(r.added for _, r in results if isinstance(r, ImportResult))
+    lines = []
+    for file_name, result in results:
+        if isinstance(result, ImportResult):
+            lines.append(
+                f"✅ {file_name}: добавлено {result.added}, пропущено {result.skipped}, "
+                f"совпадений карты и даты {result.collisions.count}"
             )
-            existing = result.scalars().all()
-
-            is_duplicate = False
-            if existing:
-                # Проверяем дубликат по всем 4 полям
-                for t in existing:
-                    if (
-                        t.type == t_type
-                        and (t.item_name or "") == item_name
-                        and int(round(t.cost)) == rounded_cost
-                    ):
-                        is_duplicate = True
-                        break
-
-                # Всегда добавляем предупреждение о совпадении карты и даты
-                excel_row = idx + 4  # данные начинаются с 4-й строки в Excel
-                warnings.append(
-                    {
-                        "row": excel_row,
-                        "card": card_number,
-                        "date": date,
-                        "item_name": item_name,
-                        "cost_rounded": rounded_cost,
-                    }
-                )
-
-            if is_duplicate:
-                skipped_count += 1
-                continue
-
-            await add_to_whitelist(card_number)
-
-            session.add(
-                Transaction(
-                    card_number=card_number,
-                    document=document,
-                    firm=str(row.get("firm", "")),
-                    date=date,
-                    address=str(row.get("address", "")),
-                    item_name=item_name,
-                    quantity=float(row.get("quantity", 0)),
-                    price=float(row.get("price", 0)),
-                    cost=cost_val,
-                    type=t_type,
-                )
-            )
-            added_count += 1
-
-        await session.commit()
+        else:
+            lines.append(f"❌ {file_name}: {result}")
+    text = (
+        f"📦 Обработка {kind} из архива «{zip_name}» завершена.\n"
+        f"Файлов: {len(results)}, всего добавлено: {total_added}\n\n" + "\n".join(lines)
+    )
+    await message.answer(text[:4096])
 
-    return added_count, skipped_count, warnings
+    reports = [(name, r.collisions) for name, r in results if isinstance(r, ImportResult)]
+    merged_path = await asyncio.to_thread(merge_collision_reports, reports)
+    for _, report in reports:
+        report.discard()
+    if merged_path:
+        try:
+            await message.answer_document(FSInputFile(merged_path, filename="collisions.csv"))
+        finally:
+            os.remove(merged_path)
 
 @router.message(AdminState.waiting_for_expense_file, F.document)
 async def handle_expense_file(message: Message, state: FSMContext, bot: Bot):
@@ -279,9 +478,10 @@ async def handle_expense_file(message: Message, state: FSMContext, bot: Bot):
     file = await bot.get_file(file_id)
     file_content = await bot.download_file(file.file_path)
     content_bytes = file_content.read()
-    # формируем метку документа: первые 10 символов имени + текущий момент в SQL-формате
-    now = datetime.now()
-    document_label = f"{file_name[:10]}_{now.strftime('%Y-%m-%d %H:%M:%S')}"
+    if file_name.lower().endswith(".zip"):
+        await submit_zip_import(message, state, content_bytes, file_name, TransactionType.EXPENSE)
+        return
+    document_label = await make_document_label(file_name)
     
     await state.update_data(file_bytes=content_bytes, document=document_label)
     
@@ -299,8 +499,10 @@ async def handle_payment_file(message: Message, state: FSMContext, bot: Bot):
     file = await bot.get_file(file_id)
     file_content = await bot.download_file(file.file_path)
     content_bytes = file_content.read()
-    now = datetime.now()
-    document_label = f"{file_name[:10]}_{now.strftime('%Y-%m-%d %H:%M:%S')}"
+    if file_name.lower().endswith(".zip"):
+        await submit_zip_import(message, state, content_bytes, file_name, TransactionType.PAYMENT)
+        return
+    document_label = await make_document_label(file_name)
     
     await state.update_data(file_bytes=content_bytes, document=document_label)
     
@@ -330,54 +532,52 @@ async def confirm_no(callback: CallbackQuery, state: FSMContext):
     await state.clear()
     await callback.answer()
 
-from bot.utils import update_last_update_time
+async def send_import_result(message: Message, result: ImportResult, kind: str):
+    """Краткая сводка в чат, полный список совпадений — файлом."""
+    collisions = result.collisions
+    text = f"Обработка {kind} завершена.\nДобавлено: {result.added}\nПропущено (дубликаты): {result.skipped}"
+    if result.resumed_after is not None:
+        text += f"\nИмпорт продолжен после строки {result.resumed_after + 4} в документ «{result.document}»"
+
+    if collisions.count:
+        text += f"\n\n⚠️ Строк с совпадающими номером карты и датой: {collisions.count}"
+        text += f"\nПервые {len(collisions.preview)}:\n"
+        for row, card, dt_str, item_name, cost_rounded, _ in collisions.preview:
+            text += (
+                f"Строка {row}: карта {card}, дата {dt_str}, "
+                f"наименование/вид: {item_name}, стоимость (округлённо): {cost_rounded}\n"
+            )
+        text += "Полный список — в приложенном файле."
+
+    await message.answer(text)
+    if collisions.path:
+        try:
+            await message.answer_document(
+                FSInputFile(collisions.path, filename=f"collisions_{result.document[:10]}.csv")
+            )
+        finally:
+            collisions.discard()
 
 async def do_process_expense(message, state, content_bytes, document_label: str):
     try:
-        added, skipped, warnings = await process_excel_expense(content_bytes, document_label)
-        update_last_update_time() # Обновляем время
-        text = f"Обработка трат завершена.\nДобавлено: {added}\nПропущено (дубликаты): {skipped}"
-
-        if warnings:
-            text += "\n\n⚠️ Найдены строки с совпадающими номером карты и датой:\n"
-            for w in warnings:
-                dt_str = (
-                    w["date"].strftime("%d.%m.%Y %H:%M")
-                    if isinstance(w["date"], datetime)
-                    else str(w["date"])
-                )
-                text += (
-                    f"Строка {w['row']}: карта {w['card']}, дата {dt_str}, "
-                    f"наименование/вид: {w['item_name']}, стоимость (округлённо): {w['cost_rounded']}\n"
-                )
-
-        await message.answer(text)
+        result = await import_report(content_bytes, TransactionType.EXPENSE, document_label)
+        await send_import_result(message, result, "трат")
     except Exception as e:
-        await message.answer(f"Ошибка: {e}")
+        await message.answer(
+            f"Ошибка: {e}\n"
+            "Сохранённые строки остались в базе — повторная загрузка того же файла продолжит импорт."
+        )
     await state.clear()
 
 async def do_process_payment(message, state, content_bytes, document_label: str):
     try:
-        added, skipped, warnings = await process_excel_payment(content_bytes, document_label)
-        update_last_update_time() # Обновляем время
-        text = f"Обработка оплат завершена.\nДобавлено: {added}\nПропущено (дубликаты): {skipped}"
-
-        if warnings:
-            text += "\n\n⚠️ Найдены строки с совпадающими номером карты и датой:\n"
-            for w in warnings:
-                dt_str = (
-                    w["date"].strftime("%d.%m.%Y %H:%M")
-                    if isinstance(w["date"], datetime)
-                    else str(w["date"])
-                )
-                text += (
-                    f"Строка {w['row']}: карта {w['card']}, дата {dt_str}, "
-                    f"наименование/вид: {w['item_name']}, стоимость (округлённо): {w['cost_rounded']}\n"
-                )
-
-        await message.answer(text)
+        result = await import_report(content_bytes, TransactionType.PAYMENT, document_label)
+        await send_import_result(message, result, "оплат")
     except Exception as e:
-        await message.answer(f"Ошибка: {e}")
+        await message.answer(
+            f"Ошибка: {e}\n"
+            "Сохранённые строки остались в базе — повторная загрузка того же файла продолжит импорт."
+        )
     await state.clear()
 
 @router.callback_query(F.data == "admin_export")
@@ -403,12 +603,16 @@ async def broadcast_process(message: Message, state: FSMContext, bot: Bot):
     if not is_admin(message.from_user.id):
         return
     
-    msg_text = message.text
-    async with async_session() as session:
-        from database.models import User
-        result = await session.execute(select(User.telegram_id))
-        user_ids = result.scalars().all()
-    
+    await state.clear()
+    ahead = job_queue.submit("broadcast", run_broadcast(message, bot, message.text))
+    text = "Рассылка поставлена в очередь. Итог придёт отдельным сообщением."
+    if ahead:
+        text += f"\nЗаданий в очереди перед ней: {ahead}."
+    await message.answer(text)
+
+async def run_broadcast(message: Message, bot: Bot, msg_text: str):
+    user_ids = await get_all_telegram_ids()
+
     count = 0
     for uid in user_ids:
         try:
@@ -418,7 +622,6 @@ async def broadcast_process(message: Message, state: FSMContext, bot: Bot):
             pass
     
     await message.answer(f"Рассылка завершена. Сообщение получили {count} пользователей.")
-    await state.clear()
 
 @router.callback_query(F.data == "admin_gen_link")
 async def gen_link_start(callback: CallbackQuery, state: FSMContext):
@@ -467,44 +670,37 @@ async def process_end_date(message: Message, state: FSMContext):
         data = await state.get_data()
         start_date = data["start_date"]
         
-        async with async_session() as session:
-            result = await session.execute(
-                select(Transaction).where(
-                    and_(
-                        Transaction.date >= start_date,
-                        Transaction.date <= end_date
-                    )
-                ).order_by(Transaction.date)
-            )
-            transactions = result.scalars().all()
-            
-            if not transactions:
-                await message.answer("За указанный период сделок не найдено.")
-                await state.clear()
-                return
-            
-            # Create Excel file
-            df_data = []
-            for t in transactions:
-                df_data.append({
-                    "Фирма": t.firm,
-                    "Карта": t.card_number,
-                    "Дата": t.date,
-                    "Адрес": t.address,
-                    "Наименование": t.item_name,
-                    "Количество": t.quantity,
-                    "Цена": t.price,
-                    "Стоимость": t.cost,
-                    "Тип": "Трата" if t.type == TransactionType.EXPENSE else "Оплата"
-                })
-            
-            df = pd.DataFrame(df_data)
-            output_file = f"export_{start_date.strftime('%d%m%Y')}_{end_date.strftime('%d%m%Y')}.xlsx"
-            df.to_excel(output_file, index=False)
-            
-            await message.answer_document(FSInputFile(output_file))
-            os.remove(output_file)
-            
+        transactions = await get_transactions_for_export(start_date, end_date)
+        
+        if not transactions:
+            await message.answer("За указанный период сделок не найдено.")
+            await state.clear()
+            return
+        
+        # Create Excel file
+        df_data = []
+        for t in transactions:
+            df_data.append({
+                "Фирма": t.firm,
+                "Карта": t.card_number,
+                "Дата": t.date,
+                "Адрес": t.address,
+                "Наименование": t.item_name,
+                "Количество": t.quantity,
+                "Цена": t.price,
+                "Стоимость": t.cost,
+                "Тип": "Трата" if t.type == TransactionType.EXPENSE else "Оплата"
+            })
+        
+        import pandas as pd  # нужен только для выгрузки, не грузим на старте
+
+        df = pd.DataFrame(df_data)
+        output_file = f"export_{start_date.strftime('%d%m%Y')}_{end_date.strftime('%d%m%Y')}.xlsx"
+        df.to_excel(output_file, index=False)
+        
+        await message.answer_document(FSInputFile(output_file))
+        os.remove(output_file)
+        
         await state.clear()
     except ValueError:
         await message.answer("Неверный формат даты. Используйте ДД.ММ.ГГГГ")
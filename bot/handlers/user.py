@@ -10,20 +10,30 @@ from database.db import (
     get_user_transactions, 
     count_user_transactions, 
     get_user_expense_stats,
-    async_session, 
     get_user_by_card,
-    get_all_user_cards
+    get_all_user_cards,
+    get_transaction_for_cards,
+    delete_user_registrations,
+    delete_user_card,
 )
-from sqlalchemy import select, and_
-from database.models import Transaction
 from bot.keyboards import (
     get_user_main_menu,
     get_transactions_kb,
     get_user_requisites_kb,
     get_user_delete_cards_kb,
     get_user_my_cards_kb,
+    get_statement_cards_kb,
+    get_transaction_details_kb,
 )
-from bot.utils import get_last_update_time
+from bot.utils import get_last_update_time, format_number, MONTH_NAMES_RU
+from bot.cache import screen_cache, statement_cache, page_snapshots, invalidate_user, TransactionSnapshot
+from bot.statements import build_statement, StatementLimiter
+from bot.prices import render_station_prices
+from aiogram.types import FSInputFile
+from config import STATEMENT_DAILY_LIMIT
+from datetime import datetime
+import logging
+import os
 import math
 import re
 
@@ -32,27 +42,12 @@ router = Router()
 class Registration(StatesGroup):
     waiting_for_card = State()
 
+class Statement(StatesGroup):
+    waiting_for_period = State()
 
-MONTH_NAMES_RU = {
-    1: "Январь",
-    2: "Февраль",
-    3: "Март",
-    4: "Апрель",
-    5: "Май",
-    6: "Июнь",
-    7: "Июль",
-    8: "Август",
-    9: "Сентябрь",
-    10: "Октябрь",
-    11: "Ноябрь",
-    12: "Декабрь",
-}
 
+statement_limiter = StatementLimiter(STATEMENT_DAILY_LIMIT)
 
-def format_number(value: float) -> str:
-    if abs(value - round(value)) < 1e-9:
-        return f"{int(round(value)):,}".replace(",", " ")
-    return f"{value:,.2f}".replace(",", " ").replace(".", ",")
 
 main_menu_text = (
     "Здравствуйте!\n"
@@ -64,6 +59,19 @@ main_menu_text = (
     "3. Возник вопрос? Напишите менеджеру в Telegram — @ToplexM"
 )
 
+requisites_text = (
+    "💳 Реквизиты для оплаты:\n\n"
+    "<code>2200 1545 0861 8864</code> Федаш Е. А.\n"
+    "Альфа банк\n\n"
+    "<code>2200 2479 6490 8215</code> Федаш Е. А.\n"
+    "ВТБ банк\n\n"
+    "<code>2202 2061 5142 4897</code> Федаш Е. А.\n"
+    "Сбер банк\n\n"
+    "Для пополнения баланса наличными обращайтесь к менеджеру @ToplexM"
+)
+
+my_cards_template = "🧾 Мои карты:\n\n<i>{cards}</i>"
+
 
 def parse_cards_from_text(raw_value: str) -> list[str]:
     cards = [c.strip() for c in re.split(r"[,%&;|\s-]+", raw_value or "") if c.strip()]
@@ -100,6 +108,7 @@ async def cmd_start(message: Message, state: FSMContext, command: CommandObject)
             else:
                 for card_number in card_numbers:
                     await register_user(message.from_user.id, card_number)
+                await invalidate_user(message.from_user.id)
                 cards_str = ", ".join(card_numbers)
                 await message.answer(
                     f"Регистрация по картам {cards_str} прошла успешно!",
@@ -119,18 +128,10 @@ async def cmd_null(message: Message, state: FSMContext):
         await message.answer("Вы не зарегистрированы в системе.")
         return
     
-    async with async_session() as session:
-        from database.models import User
-        # Находим всех пользователей с этим telegram_id и удаляем их
-        result = await session.execute(select(User).where(User.telegram_id == message.from_user.id))
-        db_users = result.scalars().all()
-        
-        cards = [u.card_number for u in db_users]
-        
-        for u in db_users:
-            await session.delete(u)
-        await session.commit()
-            
+    # Удаляем все карты этого telegram_id
+    cards = await delete_user_registrations(message.from_user.id)
+
+    await invalidate_user(message.from_user.id)
     await state.clear()
     cards_str = ", ".join(cards)
     await message.answer(f"Вы успешно разлогинены. Все ваши карты (<code>{cards_str}</code>) теперь свободны для регистрации.", parse_mode="HTML")
@@ -145,6 +146,7 @@ async def process_card_number(message: Message, state: FSMContext):
         return
 
     await register_user(message.from_user.id, card_number)
+    await invalidate_user(message.from_user.id)
     await message.answer("Регистрация прошла успешно!", reply_markup=get_user_main_menu())
     await state.clear()
 
@@ -156,7 +158,7 @@ async def show_balance(callback: CallbackQuery):
         return
     balance = await get_user_balance(callback.from_user.id)
     
-    last_update = get_last_update_time()
+    last_update = await get_last_update_time()
     
     display_balance = -balance
     text = f"Ваш баланс: {display_balance:.2f} рублей"
@@ -168,17 +170,7 @@ async def show_balance(callback: CallbackQuery):
 
 @router.callback_query(F.data == "user_requisites")
 async def show_requisites(callback: CallbackQuery):
-    text = (
-        "💳 Реквизиты для оплаты:\n\n"
-        "<code>2200 1545 0861 8864</code> Федаш Е. А.\n"
-        "Альфа банк\n\n"
-        "<code>2200 2479 6490 8215</code> Федаш Е. А.\n"
-        "ВТБ банк\n\n"
-        "<code>2202 2061 5142 4897</code> Федаш Е. А.\n"
-        "Сбер банк\n\n"
-        "Для пополнения баланса наличными обращайтесь к менеджеру @ToplexM"
-    )
-    await callback.message.edit_text(text, reply_markup=get_user_requisites_kb(), parse_mode="HTML")
+    await callback.message.edit_text(requisites_text, reply_markup=get_user_requisites_kb(), parse_mode="HTML")
     await callback.answer()
 
 @router.callback_query(F.data == "user_my_cards")
@@ -186,7 +178,7 @@ async def show_my_cards(callback: CallbackQuery):
     user_id = callback.from_user.id
     cards = await get_all_user_cards(user_id)
     cards_str = ", ".join(cards) if cards else "не привязаны"
-    text = f"🧾 Мои карты:\n\n<i>{cards_str}</i>"
+    text = my_cards_template.format(cards=cards_str)
     await callback.message.edit_text(text, reply_markup=get_user_my_cards_kb(), parse_mode="HTML")
     await callback.answer()
 
@@ -208,18 +200,11 @@ async def del_card_list(callback: CallbackQuery):
 @router.callback_query(F.data.startswith("user_del_card_exec_"))
 async def del_card_exec(callback: CallbackQuery):
     card_number = callback.data.split("_")[-1]
-    async with async_session() as session:
-        from database.models import User
-        result = await session.execute(
-            select(User).where(and_(User.telegram_id == callback.from_user.id, User.card_number == card_number))
-        )
-        db_user = result.scalar_one_or_none()
-        if db_user:
-            await session.delete(db_user)
-            await session.commit()
-            await callback.answer(f"Карта {card_number} удалена.")
-        else:
-            await callback.answer("Карта не найдена.")
+    if await delete_user_card(callback.from_user.id, card_number):
+        await invalidate_user(callback.from_user.id)
+        await callback.answer(f"Карта {card_number} удалена.")
+    else:
+        await callback.answer("Карта не найдена.")
     
     # Возвращаемся в "Мои карты"
     await show_my_cards(callback)
@@ -235,12 +220,17 @@ async def show_transactions(callback: CallbackQuery, state: FSMContext):
     await send_transaction_page(callback.message, callback.from_user.id, 0)
     await callback.answer()
 
-async def send_transaction_page(message: Message, telegram_id: int, page: int):
+async def render_transaction_page(telegram_id: int, page: int):
     page_size = 10
-    transactions = await get_user_transactions(telegram_id, limit=page_size, offset=page * page_size)
-    total_count = await count_user_transactions(telegram_id)
+    # Карты определяем один раз и передаём во все запросы страницы
+    cards = await get_all_user_cards(telegram_id)
+    transactions = await get_user_transactions(
+        telegram_id, limit=page_size, offset=page * page_size, cards=cards
+    )
+    transactions = [TransactionSnapshot.from_transaction(t) for t in transactions]
+    total_count = await count_user_transactions(telegram_id, cards=cards)
     total_pages = math.ceil(total_count / page_size)
-    stats = await get_user_expense_stats(telegram_id)
+    stats = await get_user_expense_stats(telegram_id, cards=cards)
     
     kb = get_transactions_kb(transactions, page, total_pages)
     stats_text = (
@@ -265,7 +255,17 @@ async def send_transaction_page(message: Message, telegram_id: int, page: int):
             stats_text += f"• {month_name}: {format_number(liters)} л ({format_number(cost)} ₽)\n"
 
     stats_text += f"\n\nВаши сделки (страница {page + 1} из {max(1, total_pages)}):"
-    
+    return stats_text, kb, cards, transactions
+
+
+async def send_transaction_page(message: Message, telegram_id: int, page: int):
+    # Повторные нажатия «Статистика» и ⬅️/➡️ отдаются из кэша, пока данные пользователя не изменились
+    key = ("trans_page", telegram_id, page, screen_cache.version(telegram_id))
+    stats_text, kb, cards, transactions = await screen_cache.get_or_compute(
+        key, lambda: render_transaction_page(telegram_id, page)
+    )
+    page_snapshots.put(telegram_id, cards, transactions)
+
     # We always use edit_text or answer a new message with the menu
     if (
         message.text.startswith("Ваши сделки")
@@ -291,44 +291,165 @@ async def process_pagination(callback: CallbackQuery, state: FSMContext):
 @router.callback_query(F.data.startswith("trans_details_"))
 async def show_transaction_details(callback: CallbackQuery, state: FSMContext):
     transaction_id = int(callback.data.split("_")[-1])
+
+    # Обычно сделка есть в снимке только что показанной страницы — тогда в БД не ходим
+    transaction = None
+    cached = page_snapshots.get(callback.from_user.id)
+    if cached is not None:
+        cards, rows = cached
+        transaction = rows.get(transaction_id)
+    else:
+        cards = await get_all_user_cards(callback.from_user.id)
+
+    if transaction is None:
+        transaction = await get_transaction_for_cards(transaction_id, cards)
+    # Чужие сделки не показываем
+    if not transaction or transaction.card_number not in cards:
+        await callback.answer("Сделка не найдена")
+        return
+
+    if transaction.type.value == 'expense':
+        # Только Карта, дата, имя, вид транзакции, Стоимость
+        text = (
+            f"🔴 Списание\n"
+            f"Карта: {transaction.card_number}\n"
+            f"Дата: {transaction.date.strftime('%d.%m.%Y %H:%M')}\n"
+            f"Имя: {transaction.item_name}\n"
+            f"Вид транзакции: Списание\n"
+            f"Стоимость: {transaction.cost:.2f} руб."
+        )
+    else:
+        # Для оплат (пополнений) можно оставить полный вид или тоже сократить
+        text = (
+            f"🟢 Пополнение\n"
+            f"Карта: {transaction.card_number}\n"
+            f"Дата: {transaction.date.strftime('%d.%m.%Y %H:%M')}\n"
+            f"Имя: {transaction.item_name}\n"
+            f"Вид транзакции: Пополнение\n"
+            f"Стоимость: {transaction.cost:.2f} руб."
+        )
     
-    async with async_session() as session:
-        transaction = await session.get(Transaction, transaction_id)
-        if not transaction:
-            await callback.answer("Сделка не найдена")
-            return
-        
-        if transaction.type.value == 'expense':
-            # Только Карта, дата, имя, вид транзакции, Стоимость
-            text = (
-                f"🔴 Списание\n"
-                f"Карта: {transaction.card_number}\n"
-                f"Дата: {transaction.date.strftime('%d.%m.%Y %H:%M')}\n"
-                f"Имя: {transaction.item_name}\n"
-                f"Вид транзакции: Списание\n"
-                f"Стоимость: {transaction.cost:.2f} руб."
-            )
-        else:
-            # Для оплат (пополнений) можно оставить полный вид или тоже сократить
-            text = (
-                f"🟢 Пополнение\n"
-                f"Карта: {transaction.card_number}\n"
-                f"Дата: {transaction.date.strftime('%d.%m.%Y %H:%M')}\n"
-                f"Имя: {transaction.item_name}\n"
-                f"Вид транзакции: Пополнение\n"
-                f"Стоимость: {transaction.cost:.2f} руб."
-            )
-        
-        data = await state.get_data()
-        page = data.get("page", 0)
-        
-        # We need a back to list kb but let's define it or import if exists
-        from bot.keyboards import InlineKeyboardBuilder, InlineKeyboardButton
-        kb_builder = InlineKeyboardBuilder()
-        kb_builder.row(InlineKeyboardButton(text="Назад", callback_data=f"trans_page_{page}"))
-        
-        await callback.message.edit_text(text, reply_markup=kb_builder.as_markup())
-        await callback.answer()
+    data = await state.get_data()
+    page = data.get("page", 0)
+
+    await callback.message.edit_text(text, reply_markup=get_transaction_details_kb(page))
+    await callback.answer()
+
+@router.callback_query(F.data.startswith("user_prices"))
+async def show_station_prices(callback: CallbackQuery):
+    user = await get_user_by_tg_id(callback.from_user.id)
+    if not user:
+        await callback.answer("Ошибка: пользователь не найден")
+        return
+    year = month = None
+    parts = callback.data.split("_")
+    if len(parts) == 4:
+        year, month = int(parts[2]), int(parts[3])
+    text, kb = await render_station_prices(year, month)
+    if year is None:
+        await callback.message.answer(text, reply_markup=kb)
+    else:
+        await callback.message.edit_text(text, reply_markup=kb)
+    await callback.answer()
+
+@router.callback_query(F.data == "user_statement")
+async def statement_start(callback: CallbackQuery, state: FSMContext):
+    cards = await get_all_user_cards(callback.from_user.id)
+    if not cards:
+        await callback.answer("У вас нет привязанных карт.")
+        return
+    if len(cards) == 1:
+        await ask_statement_period(callback.message, state, None)
+    else:
+        await callback.message.answer(
+            "📄 Выберите карту для выписки:", reply_markup=get_statement_cards_kb(cards)
+        )
+    await callback.answer()
+
+@router.callback_query(F.data.startswith("stmt_card_"))
+async def statement_choose_card(callback: CallbackQuery, state: FSMContext):
+    card = callback.data[len("stmt_card_"):]
+    if card == "all":
+        card = None
+    elif card not in await get_all_user_cards(callback.from_user.id):
+        await callback.answer("Карта не найдена.")
+        return
+    await ask_statement_period(callback.message, state, card)
+    await callback.answer()
+
+async def ask_statement_period(message: Message, state: FSMContext, card):
+    await state.update_data(statement_card=card)
+    await state.set_state(Statement.waiting_for_period)
+    await message.answer(
+        "Введите период выписки в формате ДД.ММ.ГГГГ-ДД.ММ.ГГГГ "
+        "или отправьте «все», чтобы получить выписку за всё время."
+    )
+
+def parse_statement_period(raw_value: str):
+    raw_value = (raw_value or "").strip().lower()
+    if raw_value in ("все", "всё"):
+        return None, None
+    start_raw, end_raw = [p.strip() for p in raw_value.split("-", 1)]
+    start_date = datetime.strptime(start_raw, "%d.%m.%Y")
+    end_date = datetime.strptime(end_raw, "%d.%m.%Y").replace(hour=23, minute=59, second=59)
+    return start_date, end_date
+
+@router.message(Statement.waiting_for_period)
+async def statement_process(message: Message, state: FSMContext):
+    telegram_id = message.from_user.id
+    try:
+        start_date, end_date = parse_statement_period(message.text)
+    except ValueError:
+        await message.answer("Неверный формат периода. Пример: 01.01.2026-31.01.2026 или «все».")
+        return
+
+    data = await state.get_data()
+    card = data.get("statement_card")
+    await state.clear()
+    cards = await get_all_user_cards(telegram_id)
+    if card is not None:
+        cards = [c for c in cards if c == card]
+    if not cards:
+        await message.answer("У вас нет привязанных карт.")
+        return
+
+    # Та же выписка без новых данных отдаётся по file_id уже отправленного файла
+    key = (telegram_id, card, start_date, end_date, screen_cache.version(telegram_id))
+    file_id = statement_cache.get(key)
+    if file_id is not None:
+        await message.answer_document(file_id, reply_markup=get_user_main_menu())
+        return
+
+    # место в лимите занимается заранее, чтобы параллельные запросы с разных экземпляров его не превысили
+    if not await statement_limiter.acquire(telegram_id):
+        await message.answer(
+            f"Сегодня уже сформировано {STATEMENT_DAILY_LIMIT} выписок. Попробуйте завтра.",
+            reply_markup=get_user_main_menu(),
+        )
+        return
+
+    try:
+        path = await build_statement(cards, start_date, end_date)
+    except Exception:
+        logging.exception("Statement build failed")
+        # в лимит идут только успешно сформированные выписки
+        await statement_limiter.release(telegram_id)
+        await message.answer(
+            "Ошибка при формировании выписки. Попробуйте позже.", reply_markup=get_user_main_menu()
+        )
+        return
+    try:
+        period = (
+            f"{start_date.strftime('%d%m%Y')}_{end_date.strftime('%d%m%Y')}" if start_date else "all"
+        )
+        sent = await message.answer_document(
+            FSInputFile(path, filename=f"statement_{period}.xlsx"),
+            caption="📄 Ваша выписка",
+            reply_markup=get_user_main_menu(),
+        )
+    finally:
+        os.remove(path)
+    statement_cache.put(key, sent.document.file_id)
 
 @router.message()
 async def main_menu_fallback(message: Message):
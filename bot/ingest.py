@@ -0,0 +1,126 @@
+import asyncio
+import logging
+import shutil
+from datetime import datetime
+from pathlib import Path
+
+from aiogram import Bot
+
+from config import ADMIN_IDS, INGEST_DIR, INGEST_WORKERS, INGEST_POLL_INTERVAL
+from bot.cluster import leader
+from bot.reports import (
+    INVALID_FORMAT_MESSAGE,
+    validate_format,
+    detect_report_type,
+    make_document_label,
+    import_report,
+)
+from database.models import TransactionType
+
+logger = logging.getLogger(__name__)
+
+
+class DropFolderIngestor:
+    """
+    Служба загрузки отчётов из локальной папки.
+    Новые .xlsx файлы берутся в работу, когда их размер перестал меняться между проходами,
+    импортируются тем же конвейером, что и из админ-панели, и переносятся в done/ или failed/.
+    По каждому проходу администраторам отправляется сводка.
+    """
+
+    def __init__(self, root: str, workers: int, poll_interval: float):
+        self.root = Path(root)
+        self.done_dir = self.root / "done"
+        self.failed_dir = self.root / "failed"
+        self.workers = max(1, workers)
+        self.poll_interval = poll_interval
+        self._sizes = {}  # путь -> размер на предыдущем проходе
+
+    def _ready_files(self) -> list[Path]:
+        ready = []
+        seen = {}
+        for path in sorted(self.root.glob("*.xlsx")):
+            if path.name.startswith("~$"):
+                continue  # временные файлы Excel
+            size = path.stat().st_size
+            seen[path] = size
+            if self._sizes.get(path) == size:
+                ready.append(path)
+        self._sizes = {p: size for p, size in seen.items() if p not in ready}
+        return ready
+
+    def _move(self, path: Path, target_dir: Path):
+        target = target_dir / path.name
+        if target.exists():
+            target = target_dir / f"{datetime.now().strftime('%Y%m%d%H%M%S')}_{path.name}"
+        shutil.move(str(path), str(target))
+
+    async def _process(self, path: Path, semaphore: asyncio.Semaphore) -> str:
+        async with semaphore:
+            try:
+                content = await asyncio.to_thread(path.read_bytes)
+                if not await validate_format(content):
+                    raise ValueError(INVALID_FORMAT_MESSAGE)
+                t_type = await asyncio.to_thread(detect_report_type, path.name, content)
+                if t_type is None:
+                    raise ValueError("не удалось определить тип отчёта")
+                document_label = await make_document_label(path.name)
+                result = await import_report(content, t_type, document_label)
+            except Exception as e:
+                logger.exception(f"Drop folder import failed: {path.name}")
+                await asyncio.to_thread(self._move, path, self.failed_dir)
+                return f"❌ {path.name}: ошибка — {e}"
+
+            await asyncio.to_thread(self._move, path, self.done_dir)
+            line = (
+                f"✅ {path.name} ({'траты' if t_type == TransactionType.EXPENSE else 'оплаты'}, "
+                f"документ «{result.document}»): добавлено {result.added}, пропущено {result.skipped}, "
+                f"совпадений карты и даты {result.collisions.count}"
+            )
+            if result.collisions.path:
+                # отчёт о совпадениях кладём рядом с обработанным файлом
+                report_path = self.done_dir / f"{path.stem}_collisions.csv"
+                await asyncio.to_thread(shutil.move, result.collisions.path, str(report_path))
+                line += f" (список: done/{report_path.name})"
+            return line
+
+    async def scan_once(self) -> list[str]:
+        files = await asyncio.to_thread(self._ready_files)
+        if not files:
+            return []
+        semaphore = asyncio.Semaphore(self.workers)
+        return await asyncio.gather(*(self._process(path, semaphore) for path in files))
+
+    async def notify_admins(self, bot: Bot, lines: list[str]):
+        text = f"📂 Папка загрузки: обработано файлов — {len(lines)}\n\n" + "\n".join(lines)
+        for admin_id in ADMIN_IDS:
+            try:
+                await bot.send_message(admin_id, text[:4096])
+            except Exception:
+                pass
+
+    async def run(self, bot: Bot):
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.done_dir.mkdir(exist_ok=True)
+        self.failed_dir.mkdir(exist_ok=True)
+        logger.info(f"Drop folder ingestion started: {self.root}")
+        while True:
+            try:
+                lines = await self.scan_once()
+                if lines:
+                    await self.notify_admins(bot, lines)
+            except Exception:
+                logger.exception("Drop folder scan failed")
+            await asyncio.sleep(self.poll_interval)
+
+
+def start_ingestion(bot: Bot):
+    """
+    Регистрирует службу, если задана INGEST_DIR. Папку обходит только ведущий экземпляр,
+    иначе два процесса взяли бы в работу один и тот же файл.
+    """
+    if not INGEST_DIR:
+        return None
+    ingestor = DropFolderIngestor(INGEST_DIR, INGEST_WORKERS, INGEST_POLL_INTERVAL)
+    leader.run_while_leader("ingest", lambda: ingestor.run(bot))
+    return ingestor
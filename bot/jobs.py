@@ -0,0 +1,51 @@
+import asyncio
+import logging
+
+from bot.cluster import cluster_lock
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueue:
+    """
+    Очередь фоновых заданий (пакетные импорты, рассылка): задания выполняются по одному,
+    хендлер только ставит задание в очередь и сразу отвечает пользователю.
+    Задание выполняется под блокировкой кластера, поэтому при нескольких экземплярах
+    бота одновременно идёт только одно задание.
+    """
+
+    def __init__(self):
+        self.queue = asyncio.Queue()
+        self.done = 0
+        self.failed = 0
+        self._worker = None
+
+    def submit(self, name: str, job) -> int:
+        """Ставит корутину в очередь, возвращает число заданий перед ней."""
+        ahead = self.queue.qsize()
+        self.queue.put_nowait((name, job))
+        return ahead
+
+    async def run(self):
+        while True:
+            name, job = await self.queue.get()
+            try:
+                async with cluster_lock("jobs"):
+                    await job
+                self.done += 1
+            except Exception:
+                self.failed += 1
+                logger.exception(f"Background job failed: {name}")
+            finally:
+                self.queue.task_done()
+
+    def start(self):
+        if self._worker is None:
+            self._worker = asyncio.create_task(self.run())
+        return self._worker
+
+    def stats(self) -> dict:
+        return {"queued": self.queue.qsize(), "done": self.done, "failed": self.failed}
+
+
+job_queue = JobQueue()
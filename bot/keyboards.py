@@ -1,14 +1,25 @@
+from functools import lru_cache
+
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
+# Статичные клавиатуры строятся один раз, параметризованные кэшируются по аргументам
+# (списки карт передаются кортежем). Возвращаемые объекты общие для всех обновлений:
+# модели aiogram изменяемые, поэтому менять их после получения нельзя — только строить новые
+KEYBOARD_CACHE_SIZE = 1024
+
+@lru_cache(maxsize=None)
 def get_user_main_menu():
     builder = InlineKeyboardBuilder()
     builder.row(InlineKeyboardButton(text="📊 Статистика", callback_data="user_transactions"))
     builder.row(InlineKeyboardButton(text="🧾 Мои карты", callback_data="user_my_cards"))
     builder.row(InlineKeyboardButton(text="💳 Реквизиты для оплаты", callback_data="user_requisites"))
     builder.row(InlineKeyboardButton(text="💰 Ваш баланс", callback_data="user_balance"))
+    builder.row(InlineKeyboardButton(text="📄 Выписка", callback_data="user_statement"))
+    builder.row(InlineKeyboardButton(text="⛽ Цены АЗС", callback_data="user_prices"))
     return builder.as_markup()
 
+@lru_cache(maxsize=None)
 def get_admin_main_menu():
     builder = InlineKeyboardBuilder()
     builder.row(InlineKeyboardButton(text="Загрузить отчет", callback_data="admin_upload"))
@@ -16,14 +27,59 @@ def get_admin_main_menu():
     builder.row(InlineKeyboardButton(text="Рассылка всем", callback_data="admin_broadcast"))
     builder.row(InlineKeyboardButton(text="Создать ссылку регистрации", callback_data="admin_gen_link"))
     builder.row(InlineKeyboardButton(text="Управление документами", callback_data="admin_docs"))
+    builder.row(InlineKeyboardButton(text="Аналитика", callback_data="admin_analytics"))
+    builder.row(InlineKeyboardButton(text="Поиск сделок", callback_data="admin_search"))
+    builder.row(InlineKeyboardButton(text="Индекс цен АЗС", callback_data="admin_prices"))
+    return builder.as_markup()
+
+@lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def get_search_results_kb(page: int, has_more: bool):
+    builder = InlineKeyboardBuilder()
+    pagination_row = []
+    if page > 0:
+        pagination_row.append(InlineKeyboardButton(text="⬅️", callback_data=f"admin_search_page_{page-1}"))
+    if has_more:
+        pagination_row.append(InlineKeyboardButton(text="➡️", callback_data=f"admin_search_page_{page+1}"))
+    if pagination_row:
+        builder.row(*pagination_row)
+    builder.row(InlineKeyboardButton(text="Новый поиск", callback_data="admin_search"))
+    builder.row(InlineKeyboardButton(text="Назад", callback_data="admin_main"))
+    return builder.as_markup()
+
+def get_station_prices_kb(periods, period, prefix: str, back_callback: str):
+    """
+    Переключение месяцев индекса цен: periods отсортированы от нового к старому,
+    callback — <prefix>_<год>_<месяц>.
+    """
+    builder = InlineKeyboardBuilder()
+    if period in periods:
+        idx = periods.index(period)
+        pagination_row = []
+        if idx + 1 < len(periods):
+            y, m = periods[idx + 1]
+            pagination_row.append(InlineKeyboardButton(text=f"⬅️ {m:02d}.{y}", callback_data=f"{prefix}_{y}_{m}"))
+        if idx > 0:
+            y, m = periods[idx - 1]
+            pagination_row.append(InlineKeyboardButton(text=f"{m:02d}.{y} ➡️", callback_data=f"{prefix}_{y}_{m}"))
+        if pagination_row:
+            builder.row(*pagination_row)
+    builder.row(InlineKeyboardButton(text="Назад", callback_data=back_callback))
+    return builder.as_markup()
+
+@lru_cache(maxsize=None)
+def get_admin_back_kb():
+    builder = InlineKeyboardBuilder()
+    builder.row(InlineKeyboardButton(text="Назад", callback_data="admin_main"))
     return builder.as_markup()
 
+@lru_cache(maxsize=None)
 def get_report_type_kb():
     builder = InlineKeyboardBuilder()
     builder.row(InlineKeyboardButton(text="Траты клиентов", callback_data="report_expense"))
     builder.row(InlineKeyboardButton(text="Оплаты клиентов", callback_data="report_payment"))
     return builder.as_markup()
 
+@lru_cache(maxsize=None)
 def get_confirm_format_kb(report_type: str):
     builder = InlineKeyboardBuilder()
     builder.row(InlineKeyboardButton(text="Да", callback_data=f"confirm_yes_{report_type}"))
@@ -47,35 +103,51 @@ def get_documents_kb(documents: list[str]):
     builder.row(InlineKeyboardButton(text="Назад", callback_data="admin_main"))
     return builder.as_markup()
 
-def get_transactions_kb(transactions, page, total_pages):
-    builder = InlineKeyboardBuilder()
-    for t in transactions:
-        # 🔴 для трат, 🟢 для оплат
-        prefix = "🔴" if t.type.value == "expense" else "🟢"
-        builder.row(InlineKeyboardButton(
-            text=f"{prefix} {t.date.strftime('%d.%m.%Y %H:%M')}", 
-            callback_data=f"trans_details_{t.id}"
-        ))
-    
+@lru_cache(maxsize=KEYBOARD_CACHE_SIZE * 4)
+def _transaction_button(transaction_id: int, is_expense: bool, date) -> InlineKeyboardButton:
+    # 🔴 для трат, 🟢 для оплат
+    prefix = "🔴" if is_expense else "🟢"
+    return InlineKeyboardButton(
+        text=f"{prefix} {date.strftime('%d.%m.%Y %H:%M')}",
+        callback_data=f"trans_details_{transaction_id}",
+    )
+
+@lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def _transactions_pagination(page: int, total_pages: int):
     pagination_row = []
     if page > 0:
         pagination_row.append(InlineKeyboardButton(text="⬅️", callback_data=f"trans_page_{page-1}"))
     if page < total_pages - 1:
         pagination_row.append(InlineKeyboardButton(text="➡️", callback_data=f"trans_page_{page+1}"))
-    
+    return pagination_row
+
+_main_menu_row = [InlineKeyboardButton(text="🏠 В главное меню", callback_data="user_main_menu")]
+
+def get_transactions_kb(transactions, page, total_pages):
+    rows = [
+        [_transaction_button(t.id, t.type.value == "expense", t.date)]
+        for t in transactions
+    ]
+    pagination_row = _transactions_pagination(page, total_pages)
     if pagination_row:
-        builder.row(*pagination_row)
-    
+        rows.append(pagination_row)
     # Кнопка возврата в главное меню
-    builder.row(InlineKeyboardButton(text="🏠 В главное меню", callback_data="user_main_menu"))
-        
+    rows.append(_main_menu_row)
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+@lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def get_transaction_details_kb(page: int):
+    builder = InlineKeyboardBuilder()
+    builder.row(InlineKeyboardButton(text="Назад", callback_data=f"trans_page_{page}"))
     return builder.as_markup()
 
+@lru_cache(maxsize=None)
 def get_user_requisites_kb():
     builder = InlineKeyboardBuilder()
     builder.row(InlineKeyboardButton(text="🏠 В главное меню", callback_data="user_main_menu"))
     return builder.as_markup()
 
+@lru_cache(maxsize=None)
 def get_user_my_cards_kb():
     builder = InlineKeyboardBuilder()
     builder.row(InlineKeyboardButton(text="➕ Добавить ТК", callback_data="user_add_card"))
@@ -84,9 +156,37 @@ def get_user_my_cards_kb():
     return builder.as_markup()
 
 def get_user_delete_cards_kb(cards):
+    return _user_delete_cards_kb(tuple(cards))
+
+@lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def _user_delete_cards_kb(cards: tuple):
     builder = InlineKeyboardBuilder()
     for card in cards:
         builder.row(InlineKeyboardButton(text=f"Удалить {card}", callback_data=f"user_del_card_exec_{card}"))
     builder.row(InlineKeyboardButton(text="Назад", callback_data="user_my_cards"))
     return builder.as_markup()
 
+
+def get_statement_cards_kb(cards):
+    return _statement_cards_kb(tuple(cards))
+
+@lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def _statement_cards_kb(cards: tuple):
+    builder = InlineKeyboardBuilder()
+    builder.row(InlineKeyboardButton(text="Все карты", callback_data="stmt_card_all"))
+    for card in cards:
+        builder.row(InlineKeyboardButton(text=card, callback_data=f"stmt_card_{card}"))
+    builder.row(InlineKeyboardButton(text="🏠 В главное меню", callback_data="user_main_menu"))
+    return builder.as_markup()
+
+
+# Статичные клавиатуры строятся при импорте, до первого обновления
+for _build in (
+    get_user_main_menu,
+    get_admin_main_menu,
+    get_admin_back_kb,
+    get_report_type_kb,
+    get_user_requisites_kb,
+    get_user_my_cards_kb,
+):
+    _build()
@@ -0,0 +1,85 @@
+import time
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.exceptions import TelegramAPIError
+from aiogram.types import CallbackQuery
+
+from config import THROTTLE_RATE, THROTTLE_BURST
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Внешний middleware для callback-запросов:
+    - одинаковый callback, который уже обрабатывается для этого пользователя, не запускается повторно;
+    - на каждого пользователя действует token bucket (rate токенов в секунду, не более burst).
+    Отброшенные запросы получают пустой answer и не доходят до хендлеров и БД.
+    """
+
+    # при таком числе корзин удаляем полностью восстановившиеся
+    PRUNE_THRESHOLD = 10000
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}  # user_id -> (токены, время последнего обновления)
+        self._inflight = set()
+        self.throttled = 0
+        self.merged = 0
+
+    def _take_token(self, user_id: int) -> bool:
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(user_id, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        allowed = tokens >= 1
+        self._buckets[user_id] = (tokens - 1 if allowed else tokens, now)
+        if len(self._buckets) > self.PRUNE_THRESHOLD:
+            self._prune(now)
+        return allowed
+
+    def _prune(self, now: float):
+        full_after = self.burst / self.rate if self.rate > 0 else float("inf")
+        self._buckets = {
+            user_id: bucket
+            for user_id, bucket in self._buckets.items()
+            if now - bucket[1] < full_after
+        }
+
+    async def _answer(self, event: CallbackQuery, text: str = None):
+        try:
+            await event.answer(text)
+        except TelegramAPIError:
+            pass
+
+    async def __call__(
+        self,
+        handler: Callable[[CallbackQuery, Dict[str, Any]], Awaitable[Any]],
+        event: CallbackQuery,
+        data: Dict[str, Any],
+    ) -> Any:
+        key = (event.from_user.id, event.data)
+        if key in self._inflight:
+            self.merged += 1
+            await self._answer(event)
+            return None
+
+        if not self._take_token(event.from_user.id):
+            self.throttled += 1
+            await self._answer(event, "Слишком много запросов, подождите секунду")
+            return None
+
+        self._inflight.add(key)
+        try:
+            return await handler(event, data)
+        finally:
+            self._inflight.discard(key)
+
+    def stats(self) -> dict:
+        return {
+            "throttled": self.throttled,
+            "merged": self.merged,
+            "tracked_users": len(self._buckets),
+        }
+
+
+throttling_middleware = ThrottlingMiddleware(THROTTLE_RATE, THROTTLE_BURST)
@@ -0,0 +1,93 @@
+import asyncio
+import logging
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter
+
+from config import BALANCE_ALERTS, LOW_BALANCE_THRESHOLD, NEW_CHARGE_ALERTS, NOTIFY_RATE
+from database.db import get_document_balance_changes
+
+logger = logging.getLogger(__name__)
+
+
+class Notifier:
+    """
+    Очередь исходящих уведомлений с ограничением скорости отправки.
+    Хендлеры только кладут сообщения в очередь, отправляет один фоновый воркер.
+    """
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate > 0 else 0
+        self.queue = asyncio.Queue()
+        self.sent = 0
+        self.failed = 0
+        self._tasks = set()
+
+    def enqueue(self, chat_id: int, text: str):
+        self.queue.put_nowait((chat_id, text))
+
+    def spawn(self, coro):
+        """Фоновая задача, на которую держим ссылку до завершения."""
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _send(self, bot: Bot, chat_id: int, text: str, attempts: int = 3):
+        for _ in range(attempts):
+            try:
+                await bot.send_message(chat_id, text)
+                self.sent += 1
+                return
+            except TelegramRetryAfter as e:
+                # Telegram просит подождать — ждём и повторяем
+                await asyncio.sleep(e.retry_after)
+            except Exception:
+                break
+        self.failed += 1
+
+    async def run(self, bot: Bot):
+        while True:
+            chat_id, text = await self.queue.get()
+            await self._send(bot, chat_id, text)
+            self.queue.task_done()
+            await asyncio.sleep(self.interval)
+
+    def start(self, bot: Bot):
+        return self.spawn(self.run(bot))
+
+    def stats(self) -> dict:
+        return {"queued": self.queue.qsize(), "sent": self.sent, "failed": self.failed}
+
+
+notifier = Notifier(NOTIFY_RATE)
+
+
+async def queue_balance_alerts(document: str) -> int:
+    """Ставит в очередь уведомления пользователям, чьи карты есть в документе."""
+    changes = await get_document_balance_changes(document)
+    queued = 0
+    for telegram_id, balance, new_charges in changes:
+        display_balance = -balance
+        if display_balance < LOW_BALANCE_THRESHOLD:
+            text = (
+                f"⚠️ Ваш баланс: {display_balance:.2f} рублей.\n"
+                "Пожалуйста, пополните баланс. Реквизиты — в меню «💳 Реквизиты для оплаты»."
+            )
+        elif NEW_CHARGE_ALERTS and new_charges > 0:
+            text = (
+                f"🔴 Новые списания: {new_charges:.2f} рублей.\n"
+                f"Ваш баланс: {display_balance:.2f} рублей."
+            )
+        else:
+            continue
+        notifier.enqueue(telegram_id, text)
+        queued += 1
+    logger.info(f"Balance alerts queued for document {document}: {queued}")
+    return queued
+
+
+def schedule_balance_alerts(document: str):
+    """Расчёт и постановка уведомлений в фоне, не задерживая ответ на импорт."""
+    if BALANCE_ALERTS:
+        notifier.spawn(queue_balance_alerts(document))
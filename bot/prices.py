@@ -0,0 +1,46 @@
+from bot.cache import screen_cache
+from bot.keyboards import get_station_prices_kb
+from bot.utils import MONTH_NAMES_RU, format_number
+from database.db import get_station_price_periods, get_station_prices
+
+STATION_PRICES_LIMIT = 20
+
+
+async def _render(year, month, prefix: str, back_callback: str, detailed: bool):
+    periods = await get_station_price_periods()
+    if not periods:
+        text = "⛽ Индекс цен АЗС пока пуст: ещё не загружено ни одного отчёта о тратах."
+        return text, get_station_prices_kb([], None, prefix, back_callback)
+    period = (year, month) if (year, month) in periods else periods[0]
+    rows = await get_station_prices(*period, limit=STATION_PRICES_LIMIT)
+
+    month_name = MONTH_NAMES_RU.get(period[1], str(period[1]))
+    text = f"⛽ Цены АЗС за {month_name} {period[0]}\n\n"
+    for row in rows:
+        text += f"📍 {row.address}\n{row.item_name or 'Без наименования'}: "
+        if row.avg_price is not None:
+            text += (
+                f"ср. {format_number(round(row.avg_price, 2))} ₽/л "
+                f"(мин. {format_number(row.min_price)}, макс. {format_number(row.max_price)})"
+            )
+        else:
+            text += "цена не указана"
+        if detailed:
+            text += (
+                f"\n{format_number(round(row.liters, 2))} л, {format_number(round(row.cost, 2))} ₽, "
+                f"операций: {row.count}"
+            )
+        text += "\n\n"
+    return text[:4096], get_station_prices_kb(periods, period, prefix, back_callback)
+
+
+async def render_station_prices(year=None, month=None, prefix="user_prices",
+                                back_callback="user_main_menu", detailed=False):
+    """
+    Экран индекса цен АЗС за месяц (по умолчанию — последний загруженный).
+    Данные читаются из station_month_prices и кэшируются до следующего импорта.
+    """
+    key = ("station_prices", screen_cache.generation, year, month, prefix, detailed)
+    return await screen_cache.get_or_compute(
+        key, lambda: _render(year, month, prefix, back_callback, detailed)
+    )
@@ -0,0 +1,424 @@
+import asyncio
+import csv
+import hashlib
+import io
+import os
+import tempfile
+import zipfile
+from dataclasses import dataclass
+from datetime import datetime
+
+from bot.cache import invalidate_cards
+from bot.notify import schedule_balance_alerts
+from bot.utils import update_last_update_time
+from config import IMPORT_BATCH_SIZE, ZIP_MAX_FILES, ZIP_MAX_TOTAL_MB
+from database.db import (
+    async_session,
+    add_to_whitelist_in_session,
+    lock_cards,
+    get_transactions_for_dedup,
+    insert_transactions,
+    get_import_checkpoint,
+    save_import_checkpoint,
+    finish_import_checkpoint,
+    refresh_card_month_totals,
+    refresh_card_daily_balances,
+    refresh_station_month_prices,
+    advance_rollup_watermark,
+    claim_document_label,
+)
+from database.models import TransactionType
+
+# Подсказки в имени файла для определения типа отчёта
+EXPENSE_NAME_HINTS = ("трат", "расход", "expense")
+PAYMENT_NAME_HINTS = ("оплат", "платеж", "платёж", "пополн", "payment")
+
+# pandas и openpyxl импортируются внутри функций: они нужны только при загрузке отчёта,
+# а импорт на старте заметно замедляет запуск бота
+
+# Причина отказа для файлов, не прошедших проверку раскладки (ZIP и папка загрузки)
+INVALID_FORMAT_MESSAGE = "неверный формат (B2 и A3 должны быть пустыми, B3 — заполнено)"
+
+async def validate_format(file_content: bytes):
+    return await asyncio.to_thread(check_format, file_content)
+
+def check_format(file_content: bytes):
+    import openpyxl
+
+    wb = openpyxl.load_workbook(io.BytesIO(file_content), data_only=True)
+    ws = wb.active
+    
+    # B2 is row 2, col 2; A3 is row 3, col 1; B3 is row 3, col 2
+    b2_val = ws.cell(row=2, column=2).value
+    a3_val = ws.cell(row=3, column=1).value
+    b3_val = ws.cell(row=3, column=2).value
+    
+    is_valid = (b2_val is None or str(b2_val).strip() == "") and \
+               (a3_val is None or str(a3_val).strip() == "") and \
+               (b3_val is not None and str(b3_val).strip() != "")
+               
+    return is_valid
+
+async def after_data_change(cards, months=None):
+    """
+    Вызывается после любого изменения сделок (импорт, отзыв документа):
+    пересчитывает производные данные по затронутым картам и сбрасывает кэши.
+    months — месяцы (год, месяц) затронутых трат для индекса цен АЗС.
+    """
+    cards = set(cards)
+    try:
+        if months:
+            await refresh_station_month_prices(months)
+        if cards:
+            await refresh_card_month_totals(cards)
+            await refresh_card_daily_balances(cards)
+    finally:
+        # сделки уже изменены: кэши сбрасываются, даже если пересчёт не удался
+        if cards:
+            await invalidate_cards(cards)
+
+def detect_report_type(file_name: str, file_content: bytes):
+    """
+    Определяет тип отчёта по имени файла, а если по имени не понятно — по раскладке:
+    у трат заполнены заголовки B3:I3, у оплат только B3:F3.
+    Возвращает TransactionType или None.
+    """
+    name = (file_name or "").lower()
+    if any(word in name for word in EXPENSE_NAME_HINTS):
+        return TransactionType.EXPENSE
+    if any(word in name for word in PAYMENT_NAME_HINTS):
+        return TransactionType.PAYMENT
+
+    import openpyxl
+
+    wb = openpyxl.load_workbook(io.BytesIO(file_content), read_only=True, data_only=True)
+    try:
+        ws = wb.active
+        header = next(ws.iter_rows(min_row=3, max_row=3, min_col=2, max_col=9, values_only=True), ())
+    finally:
+        wb.close()
+    filled = [v is not None and str(v).strip() != "" for v in header]
+    if len(filled) == 8 and all(filled[:5]) and any(filled[5:]):
+        return TransactionType.EXPENSE
+    if len(filled) >= 5 and all(filled[:5]):
+        return TransactionType.PAYMENT
+    return None
+
+async def make_document_label(file_name: str) -> str:
+    # метка документа: первые 10 символов имени + текущий момент в SQL-формате
+    now = datetime.now()
+    label = f"{file_name[:10]}_{now.strftime('%Y-%m-%d %H:%M:%S')}"
+    # файлы с похожими именами могут прийти в одну секунду, в том числе на разные экземпляры:
+    # метка регистрируется в БД, занятая получает суффикс
+    suffix = 2
+    unique_label = label
+    while not await claim_document_label(unique_label):
+        unique_label = f"{label}_{suffix}"
+        suffix += 1
+    return unique_label
+
+def read_expense_frame(file_content: bytes):
+    import pandas as pd
+
+    # Format: Фирма, карта, дата, адрес, наименование, количество, цена, стоимость
+    df = pd.read_excel(io.BytesIO(file_content), skiprows=2, usecols="B:I")
+    df.columns = ["firm", "card", "date", "address", "item_name", "quantity", "price", "cost"]
+    return df
+
+def read_payment_frame(file_content: bytes):
+    import pandas as pd
+
+    # New format for payments: Дата, карта, имя, вид транзакции, стоимость
+    df = pd.read_excel(io.BytesIO(file_content), skiprows=2, usecols="B:F")
+    df.columns = ["date", "card", "item_name", "type_str", "cost"]
+    
+    df["firm"] = ""
+    df["address"] = ""
+    df["quantity"] = 1.0
+    df["price"] = df["cost"]
+    return df
+
+def format_report_date(value) -> str:
+    return value.strftime("%d.%m.%Y %H:%M") if isinstance(value, datetime) else str(value)
+
+class CollisionReport:
+    """
+    Строки отчёта, у которых в БД уже есть сделка с той же картой и датой.
+    Пишутся в CSV по мере импорта (файл создаётся при первой записи),
+    в памяти остаются только счётчики и первые строки для сообщения в чате.
+    """
+
+    HEADER = ["Строка", "Карта", "Дата", "Наименование/вид", "Стоимость (округлённо)", "Дубликат"]
+    PREVIEW_SIZE = 5
+
+    def __init__(self):
+        self.path = None
+        self.count = 0
+        self.duplicates = 0
+        self.preview = []
+        self._file = None
+        self._writer = None
+
+    def add(self, row: int, card: str, date, item_name: str, cost_rounded: int, duplicate: bool):
+        if self._writer is None:
+            fd, self.path = tempfile.mkstemp(suffix=".csv", prefix="collisions_")
+            # utf-8-sig и «;» — чтобы Excel открыл файл без мастера импорта
+            self._file = os.fdopen(fd, "w", encoding="utf-8-sig", newline="")
+            self._writer = csv.writer(self._file, delimiter=";")
+            self._writer.writerow(self.HEADER)
+        values = [row, card, format_report_date(date), item_name, cost_rounded, "да" if duplicate else "нет"]
+        self._writer.writerow(values)
+        self.count += 1
+        if duplicate:
+            self.duplicates += 1
+        if len(self.preview) < self.PREVIEW_SIZE:
+            self.preview.append(values)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._writer = None
+
+    def discard(self):
+        self.close()
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+        self.path = None
+
+def merge_collision_reports(named_reports) -> str:
+    """Сводит отчёты о совпадениях нескольких файлов в один CSV с колонкой «Файл»."""
+    named_reports = [(name, r) for name, r in named_reports if r.path]
+    if not named_reports:
+        return None
+    fd, path = tempfile.mkstemp(suffix=".csv", prefix="collisions_")
+    with os.fdopen(fd, "w", encoding="utf-8-sig", newline="") as out:
+        writer = csv.writer(out, delimiter=";")
+        writer.writerow(["Файл"] + CollisionReport.HEADER)
+        for name, report in named_reports:
+            report.close()
+            with open(report.path, encoding="utf-8-sig", newline="") as src:
+                reader = csv.reader(src, delimiter=";")
+                next(reader, None)
+                for values in reader:
+                    writer.writerow([name] + values)
+    return path
+
+@dataclass
+class ImportResult:
+    document: str
+    added: int
+    skipped: int
+    collisions: CollisionReport
+    # индекс строки, после которой продолжен прерванный импорт (None — импорт с начала)
+    resumed_after: int = None
+
+async def import_report(file_content: bytes, t_type: TransactionType, document: str) -> ImportResult:
+    """
+    Единая точка импорта отчёта (админ-панель и папка загрузки).
+    Разбор Excel идёт в отдельном потоке; одновременные импорты разделяются
+    блокировками карт внутри save_transactions.
+    Если тот же файл уже загружался и импорт оборвался, он продолжается
+    с сохранённой контрольной точки под прежней меткой документа.
+    """
+    if t_type == TransactionType.EXPENSE:
+        df = await asyncio.to_thread(read_expense_frame, file_content)
+    else:
+        df = await asyncio.to_thread(read_payment_frame, file_content)
+    file_hash = hashlib.sha256(file_content).hexdigest()
+
+    checkpoint = await get_import_checkpoint(file_hash)
+    resumed_after = None
+    if checkpoint is not None and not checkpoint.finished:
+        document = checkpoint.document
+        resumed_after = checkpoint.last_row
+        df = df[df.index > resumed_after]
+    added, skipped, collisions = await save_transactions(df, t_type, document, file_hash)
+
+    await update_last_update_time()
+    if added:
+        schedule_balance_alerts(document)
+    return ImportResult(document, added, skipped, collisions, resumed_after)
+
+def extract_zip_reports(zip_content: bytes) -> list[tuple[str, bytes]]:
+    """Достаёт .xlsx файлы из ZIP-архива с ограничением на их число и общий размер."""
+    with zipfile.ZipFile(io.BytesIO(zip_content)) as archive:
+        members = [
+            info for info in archive.infolist()
+            if not info.is_dir()
+            and info.filename.lower().endswith(".xlsx")
+            and not info.filename.startswith("__MACOSX/")
+            and not os.path.basename(info.filename).startswith("~$")
+        ]
+        if len(members) > ZIP_MAX_FILES:
+            raise ValueError(f"в архиве больше {ZIP_MAX_FILES} файлов")
+        if sum(info.file_size for info in members) > ZIP_MAX_TOTAL_MB * 1024 * 1024:
+            raise ValueError(f"распакованный архив больше {ZIP_MAX_TOTAL_MB} МБ")
+        return [(os.path.basename(info.filename), archive.read(info)) for info in members]
+
+async def import_many(files, t_type: TransactionType, workers: int):
+    """
+    Импортирует несколько отчётов, каждый под своей меткой документа.
+    Разбор файлов идёт параллельно (не больше workers одновременно),
+    запись в БД — параллельно, с блокировками по картам.
+    Возвращает список (имя файла, ImportResult или исключение) в исходном порядке.
+    """
+    semaphore = asyncio.Semaphore(max(1, workers))
+
+    async def run_one(file_name: str, content: bytes):
+        async with semaphore:
+            try:
+                if not await validate_format(content):
+                    raise ValueError(INVALID_FORMAT_MESSAGE)
+                return file_name, await import_report(content, t_type, await make_document_label(file_name))
+            except Exception as e:
+                return file_name, e
+
+    return await asyncio.gather(*(run_one(name, content) for name, content in files))
+
+@dataclass(slots=True)
+class ParsedRow:
+    """Строка отчёта после разбора: только скаляры, без pandas Series и ORM-объекта."""
+    index: int
+    card_number: str
+    date: datetime
+    firm: str
+    address: str
+    item_name: str
+    quantity: float
+    price: float
+    cost: float
+
+def parse_report_date(value):
+    if isinstance(value, str):
+        for fmt in ("%d.%m.%Y %H:%M:%S", "%d.%m.%Y %H:%M"):
+            try:
+                return datetime.strptime(value, fmt)
+            except Exception:
+                continue
+        return value
+    if hasattr(value, "to_pydatetime"):
+        return value.to_pydatetime()
+    return value
+
+def iter_parsed_rows(df):
+    """Строки DataFrame как ParsedRow: колонки читаются целиком, без df.iterrows()."""
+    columns = [df[name].tolist() for name in (
+        "card", "date", "firm", "address", "item_name", "quantity", "price", "cost",
+    )]
+    for idx, card, date, firm, address, item_name, quantity, price, cost in zip(df.index, *columns):
+        yield ParsedRow(
+            index=int(idx),
+            card_number=str(card),
+            date=parse_report_date(date),
+            firm=str(firm),
+            address=str(address),
+            item_name=str(item_name),
+            quantity=float(quantity),
+            price=float(price),
+            cost=float(cost),
+        )
+
+async def save_transactions(df, t_type: TransactionType, document: str, file_hash: str = None):
+    """
+    Сохраняем транзакции с логикой:
+    - дубликат определяется по: карта, дата, тип, наименование, стоимость (округлённая до целого);
+    - если в БД уже есть любая строка с той же картой и датой (даже если остальные поля отличаются),
+      записываем предупреждение с номером строки и 4 полями в CollisionReport.
+    Строки пишутся пачками по IMPORT_BATCH_SIZE, каждая пачка — в своей сессии и транзакции
+    вместе с контрольной точкой (file_hash, последняя строка), поэтому память сессии не растёт,
+    а при сбое сохранённые пачки остаются и импорт можно продолжить.
+    Существующие сделки пачки читаются одним запросом, новые вставляются через Core
+    одним executemany — ORM-объекты Transaction не создаются.
+    """
+    df = df.dropna(subset=["card", "date"])
+    added_count = 0
+    skipped_count = 0
+    collisions = CollisionReport()
+    affected_cards = set()
+    affected_months = set()
+
+    try:
+        for chunk_start in range(0, len(df), IMPORT_BATCH_SIZE):
+            chunk = df.iloc[chunk_start:chunk_start + IMPORT_BATCH_SIZE]
+            rows = list(iter_parsed_rows(chunk))
+            async with async_session() as session:
+                # проверка дубликатов и вставка идут под блокировками карт пачки:
+                # параллельный импорт с теми же картами ждёт commit этой пачки
+                await lock_cards(session, {row.card_number for row in rows})
+                chunk_cards = set()
+                chunk_months = set()
+
+                # Все существующие сделки с картами и датами пачки: (карта, дата) -> [(тип, наименование, стоимость)]
+                known = {}
+                for card_number, date, existing_type, existing_item, existing_cost in await get_transactions_for_dedup(
+                    session, {row.card_number for row in rows}, {row.date for row in rows}
+                ):
+                    known.setdefault((card_number, date), []).append((existing_type, existing_item, existing_cost))
+
+                pending = []
+                for row in rows:
+                    rounded_cost = int(round(row.cost))
+                    existing = known.setdefault((row.card_number, row.date), [])
+
+                    is_duplicate = False
+                    if existing:
+                        # Проверяем дубликат по всем 4 полям
+                        for existing_type, existing_item, existing_cost in existing:
+                            if (
+                                existing_type == t_type
+                                and (existing_item or "") == row.item_name
+                                and int(round(existing_cost)) == rounded_cost
+                            ):
+                                is_duplicate = True
+                                break
+
+                        # Всегда добавляем предупреждение о совпадении карты и даты
+                        excel_row = row.index + 4  # данные начинаются с 4-й строки в Excel
+                        collisions.add(excel_row, row.card_number, row.date, row.item_name, rounded_cost, is_duplicate)
+
+                    if is_duplicate:
+                        skipped_count += 1
+                        continue
+
+                    # строка видна проверке следующих строк этой же пачки
+                    existing.append((t_type, row.item_name, row.cost))
+                    pending.append({
+                        "card_number": row.card_number,
+                        "document": document,
+                        "firm": row.firm,
+                        "date": row.date,
+                        "address": row.address,
+                        "item_name": row.item_name,
+                        "quantity": row.quantity,
+                        "price": row.price,
+                        "cost": row.cost,
+                        "type": t_type,
+                    })
+                    chunk_cards.add(row.card_number)
+                    if t_type == TransactionType.EXPENSE and isinstance(row.date, datetime):
+                        chunk_months.add((row.date.year, row.date.month))
+                    added_count += 1
+
+                await insert_transactions(session, pending)
+                await add_to_whitelist_in_session(session, chunk_cards)
+                if file_hash:
+                    await save_import_checkpoint(session, file_hash, document, int(chunk.index[-1]))
+                await session.commit()
+                affected_cards |= chunk_cards
+                affected_months |= chunk_months
+
+        if file_hash:
+            await finish_import_checkpoint(file_hash)
+    except Exception:
+        collisions.discard()
+        raise
+    finally:
+        collisions.close()
+        # обновляем итоги и кэши и для частично сохранённого импорта
+        await after_data_change(affected_cards, affected_months)
+    # сделки импорта уже учтены в итогах — периодический проход их не пересчитывает
+    if affected_cards:
+        await advance_rollup_watermark()
+
+    return added_count, skipped_count, collisions
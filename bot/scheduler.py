@@ -0,0 +1,177 @@
+import asyncio
+import logging
+import random
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+from bot.cluster import leader
+from bot.notify import notifier
+from bot.reports import after_data_change
+from config import (
+    ADMIN_IDS,
+    SCHEDULER_ENABLED,
+    ROLLUP_REFRESH_INTERVAL,
+    VERIFY_AT,
+    JOB_JITTER,
+    JOB_TIME_BUDGET,
+)
+from database.db import (
+    ROLLUP_WATERMARK_KEY,
+    get_setting,
+    set_setting,
+    advance_rollup_watermark,
+    get_changes_since,
+    find_month_total_drift,
+    find_daily_balance_drift,
+)
+
+logger = logging.getLogger(__name__)
+
+VERIFIED_AT_KEY = "rollups_verified_at"
+
+
+@dataclass
+class ScheduledJob:
+    name: str
+    factory: object  # () -> корутина
+    next_delay: object  # () -> секунд до следующего запуска
+    budget: float
+    runs: int = 0
+    failures: int = 0
+    timeouts: int = 0
+    last_duration: float = 0.0
+    last_run: datetime = None
+
+
+class Scheduler:
+    """
+    Планировщик фоновых заданий внутри процесса бота.
+    К каждому запуску добавляется случайная задержка (jitter), чтобы задания
+    не совпадали между собой и с пиком запросов, а время выполнения ограничено
+    бюджетом: задание дольше budget секунд отменяется до следующего запуска.
+    """
+
+    def __init__(self, jitter: float, budget: float):
+        self.jitter = jitter
+        self.budget = budget
+        self.jobs = {}
+
+    def every(self, name: str, interval: float, factory, budget: float = None):
+        self.jobs[name] = ScheduledJob(name, factory, lambda: interval, budget or self.budget)
+
+    def daily(self, name: str, at: str, factory, budget: float = None):
+        """at — время запуска ЧЧ:ММ по местному времени."""
+        hour, minute = (int(part) for part in at.split(":"))
+
+        def next_delay():
+            now = datetime.now()
+            moment = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+            if moment <= now:
+                moment += timedelta(days=1)
+            return (moment - now).total_seconds()
+
+        self.jobs[name] = ScheduledJob(name, factory, next_delay, budget or self.budget)
+
+    async def run_job(self, job: ScheduledJob):
+        started = time.perf_counter()
+        job.last_run = datetime.now()
+        try:
+            await asyncio.wait_for(job.factory(), timeout=job.budget)
+        except asyncio.TimeoutError:
+            job.timeouts += 1
+            logger.warning(f"Scheduled job {job.name} exceeded budget of {job.budget:.0f}s")
+        except Exception:
+            job.failures += 1
+            logger.exception(f"Scheduled job {job.name} failed")
+        finally:
+            job.runs += 1
+            job.last_duration = time.perf_counter() - started
+
+    async def _loop(self, job: ScheduledJob):
+        while True:
+            await asyncio.sleep(job.next_delay() + random.uniform(0, self.jitter))
+            await self.run_job(job)
+
+    async def run(self):
+        await asyncio.gather(*(self._loop(job) for job in self.jobs.values()))
+
+    def start(self):
+        # задания общие для всех экземпляров — выполняет только ведущий
+        leader.run_while_leader("scheduler", self.run)
+
+    def stats(self) -> dict:
+        return {
+            name: {
+                "runs": job.runs,
+                "failures": job.failures,
+                "timeouts": job.timeouts,
+                "last_duration": job.last_duration,
+                "last_run": job.last_run,
+            }
+            for name, job in self.jobs.items()
+        }
+
+
+scheduler = Scheduler(JOB_JITTER, JOB_TIME_BUDGET)
+
+
+async def refresh_new_transactions():
+    """
+    Догоняет производные данные по сделкам, появившимся после прошлого прохода
+    (водяной знак — максимальный transactions.id). Импорт сдвигает знак сам после
+    своего пересчёта, поэтому обычно проход сводится к чтению знака и запросу max(id).
+    """
+    raw = await get_setting(ROLLUP_WATERMARK_KEY)
+    if raw is None:
+        # первый запуск: итоги уже заполнены init_db, начинаем с текущего максимума
+        max_id, _, _ = await get_changes_since(0)
+        await set_setting(ROLLUP_WATERMARK_KEY, str(max_id))
+        return
+    max_id, cards, months = await get_changes_since(int(raw))
+    if max_id == int(raw):
+        return
+    await after_data_change(cards, months)
+    await advance_rollup_watermark(max_id)
+    logger.info(f"Rollup refresh: {len(cards)} cards, {len(months)} months up to id {max_id}")
+
+
+async def verify_rollups():
+    """
+    Ночная сверка card_month_totals и card_daily_balances с суммами по transactions.
+    Расходящиеся карты пересчитываются, администраторы получают отчёт.
+    """
+    month_drift = await find_month_total_drift()
+    balance_drift = await find_daily_balance_drift()
+    cards = month_drift | balance_drift
+    if cards:
+        await after_data_change(cards)
+    await set_setting(VERIFIED_AT_KEY, datetime.now().isoformat())
+    if not cards:
+        logger.info("Rollup verification: no drift")
+        return
+
+    logger.warning(
+        f"Rollup verification repaired {len(cards)} cards "
+        f"(monthly totals: {len(month_drift)}, daily balances: {len(balance_drift)})"
+    )
+    sample = ", ".join(sorted(cards)[:10])
+    text = (
+        "🛠 Ночная сверка итогов\n\n"
+        f"Расхождения найдены и исправлены по {len(cards)} картам.\n"
+        f"Итоги по месяцам: {len(month_drift)}, дневные балансы: {len(balance_drift)}.\n"
+        f"Карты: {sample}" + (" …" if len(cards) > 10 else "")
+    )
+    for admin_id in ADMIN_IDS:
+        notifier.enqueue(admin_id, text)
+
+
+def start_scheduler():
+    if not SCHEDULER_ENABLED:
+        return None
+    if ROLLUP_REFRESH_INTERVAL > 0:
+        scheduler.every("rollup_refresh", ROLLUP_REFRESH_INTERVAL, refresh_new_transactions)
+    if VERIFY_AT:
+        scheduler.daily("rollup_verify", VERIFY_AT, verify_rollups)
+    scheduler.start()
+    return scheduler
@@ -0,0 +1,54 @@
+import logging
+import time
+from contextlib import contextmanager
+
+
+class StartupProfile:
+    """
+    Замер этапов запуска: импорт модулей, инициализация БД, готовность к приёму
+    обновлений и время до первого обновления от Telegram.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = []  # (название, длительность в секундах)
+        self.ready_at = None
+        self.first_update_at = None
+
+    @contextmanager
+    def phase(self, name: str):
+        phase_started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - phase_started))
+
+    def elapsed_ms(self, moment: float = None) -> float:
+        moment = time.perf_counter() if moment is None else moment
+        return (moment - self.started) * 1000
+
+    def mark_ready(self):
+        self.ready_at = time.perf_counter()
+
+    def report(self) -> str:
+        lines = [f"  {name}: {seconds * 1000:.0f} ms" for name, seconds in self.phases]
+        if self.ready_at is not None:
+            lines.append(f"  ready to poll: {self.elapsed_ms(self.ready_at):.0f} ms")
+        if self.first_update_at is not None:
+            lines.append(f"  first update: {self.elapsed_ms(self.first_update_at):.0f} ms")
+        return "Startup profile:\n" + "\n".join(lines)
+
+    def within_budget(self, budget_ms: float) -> bool:
+        """Уложился ли запуск (до готовности к приёму обновлений) в бюджет."""
+        moment = self.ready_at if self.ready_at is not None else time.perf_counter()
+        return self.elapsed_ms(moment) <= budget_ms
+
+    async def first_update_middleware(self, handler, event, data):
+        # outer-middleware для dp.update: фиксирует момент первого обновления
+        if self.first_update_at is None:
+            self.first_update_at = time.perf_counter()
+            logging.info(self.report())
+        return await handler(event, data)
+
+
+startup_profile = StartupProfile()
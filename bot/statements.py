@@ -0,0 +1,87 @@
+import asyncio
+import os
+import tempfile
+
+from bot.utils import MONTH_NAMES_RU
+from database.db import iter_statement_rows, get_statement_monthly_totals, reserve_statement, release_statement
+from database.models import TransactionType
+
+STATEMENT_HEADER = ["Дата", "Карта", "Тип", "Адрес", "Наименование", "Количество", "Цена", "Стоимость"]
+TOTALS_HEADER = ["Год", "Месяц", "Тип", "Операций", "Литры", "Сумма"]
+
+
+def type_title(t_type: TransactionType) -> str:
+    return "Трата" if t_type == TransactionType.EXPENSE else "Оплата"
+
+
+STATEMENT_WRITE_BATCH = 1000
+
+
+def _append_rows(ws, rows):
+    for row in rows:
+        ws.append(row)
+
+
+async def build_statement(cards, start_date=None, end_date=None) -> str:
+    """
+    Формирует xlsx-выписку во временный файл и возвращает путь к нему.
+    Книга открыта в режиме write_only: строки сразу сбрасываются на диск,
+    поэтому память не зависит от размера выписки. Итоги по месяцам считаются в SQL.
+    Запись строк и сохранение книги идут в отдельном потоке пачками, чтобы
+    большая выписка не останавливала обработку остальных обновлений.
+    """
+    import openpyxl
+
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet("Выписка")
+    batch = [STATEMENT_HEADER]
+    async for row in iter_statement_rows(cards, start_date, end_date, batch_size=STATEMENT_WRITE_BATCH):
+        batch.append([
+            row.date,
+            row.card_number,
+            type_title(row.type),
+            row.address,
+            row.item_name,
+            row.quantity,
+            row.price,
+            row.cost,
+        ])
+        if len(batch) >= STATEMENT_WRITE_BATCH:
+            await asyncio.to_thread(_append_rows, ws, batch)
+            batch = []
+    await asyncio.to_thread(_append_rows, ws, batch)
+
+    totals_ws = wb.create_sheet("Итоги по месяцам")
+    totals = [TOTALS_HEADER]
+    for item in await get_statement_monthly_totals(cards, start_date, end_date):
+        totals.append([
+            item["year"],
+            MONTH_NAMES_RU.get(item["month"], str(item["month"])),
+            type_title(item["type"]),
+            item["count"],
+            item["liters"],
+            item["cost"],
+        ])
+    await asyncio.to_thread(_append_rows, totals_ws, totals)
+
+    fd, path = tempfile.mkstemp(suffix=".xlsx", prefix="statement_")
+    os.close(fd)
+    try:
+        await asyncio.to_thread(wb.save, path)
+    except BaseException:
+        os.remove(path)
+        raise
+    return path
+
+
+class StatementLimiter:
+    """Дневной лимит выписок по пользователям; счётчики хранятся в БД и общие для всех экземпляров."""
+
+    def __init__(self, daily_limit: int):
+        self.daily_limit = daily_limit
+
+    async def acquire(self, telegram_id: int) -> bool:
+        return await reserve_statement(telegram_id, self.daily_limit)
+
+    async def release(self, telegram_id: int):
+        await release_statement(telegram_id)
@@ -0,0 +1,80 @@
+import base64
+import json
+from datetime import date, datetime
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+from database.db import get_fsm_record, save_fsm_record
+
+
+def _encode(value):
+    # в данных диалогов бывают содержимое файла и даты
+    if isinstance(value, bytes):
+        return {"__bytes__": base64.b64encode(value).decode("ascii")}
+    if isinstance(value, datetime):
+        return {"__datetime__": value.isoformat()}
+    if isinstance(value, date):
+        return {"__date__": value.isoformat()}
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _decode(obj: dict):
+    if "__bytes__" in obj:
+        return base64.b64decode(obj["__bytes__"])
+    if "__datetime__" in obj:
+        return datetime.fromisoformat(obj["__datetime__"])
+    if "__date__" in obj:
+        return date.fromisoformat(obj["__date__"])
+    return obj
+
+
+class DatabaseStorage(BaseStorage):
+    """
+    Хранилище FSM в таблице fsm_records: следующий шаг диалога может обработать
+    любой экземпляр бота, а состояние переживает перезапуск.
+    """
+
+    @staticmethod
+    def make_key(key: StorageKey) -> str:
+        return ":".join(
+            str(part) if part is not None else ""
+            for part in (
+                key.bot_id,
+                key.chat_id,
+                key.user_id,
+                key.thread_id,
+                key.business_connection_id,
+                key.destiny,
+            )
+        )
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        value = state.state if isinstance(state, State) else state
+        await save_fsm_record(self.make_key(key), state=value)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        record = await get_fsm_record(self.make_key(key))
+        return record.state if record else None
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        payload = json.dumps(data, default=_encode, ensure_ascii=False) if data else None
+        await save_fsm_record(self.make_key(key), data=payload)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        record = await get_fsm_record(self.make_key(key))
+        if not record or not record.data:
+            return {}
+        return json.loads(record.data, object_hook=_decode)
+
+    async def update_data(self, key: StorageKey, data: Dict[str, Any]) -> Dict[str, Any]:
+        # запись только при изменении: повторный выбор той же страницы не пишет в БД
+        current_data = await self.get_data(key)
+        new_data = {**current_data, **data}
+        if new_data != current_data:
+            await self.set_data(key, new_data)
+        return new_data.copy()
+
+    async def close(self) -> None:
+        pass
@@ -1,5 +1,29 @@
 import datetime
 
+from database.db import get_setting, set_setting
+
+LAST_UPDATE_KEY = "last_update"
+
+MONTH_NAMES_RU = {
+    1: "Январь",
+    2: "Февраль",
+    3: "Март",
+    4: "Апрель",
+    5: "Май",
+    6: "Июнь",
+    7: "Июль",
+    8: "Август",
+    9: "Сентябрь",
+    10: "Октябрь",
+    11: "Ноябрь",
+    12: "Декабрь",
+}
+
+def format_number(value: float) -> str:
+    if abs(value - round(value)) < 1e-9:
+        return f"{int(round(value)):,}".replace(",", " ")
+    return f"{value:,.2f}".replace(",", " ").replace(".", ",")
+
 def get_russian_month(month_idx):
     months = [
         "января", "февраля", "марта", "апреля", "мая", "июня",
@@ -13,20 +37,19 @@ def format_last_update(dt: datetime.datetime):
     month = get_russian_month(dt.month)
     return dt.strftime(f"%H:%M %d {month} %Y")
 
-def update_last_update_time():
-    now = datetime.datetime.now()
-    with open("last_update.txt", "w", encoding="utf-8") as f:
-        f.write(now.isoformat())
-
-def get_last_update_time():
-    try:
-        with open("last_update.txt", "r", encoding="utf-8") as f:
-            content = f.read().strip()
-            if content:
-                dt = datetime.datetime.fromisoformat(content)
-                return format_last_update(dt)
-    except FileNotFoundError:
-        pass
-    return "неизвестно"
-
+async def update_last_update_time():
+    # хранится в БД, чтобы все экземпляры бота показывали одно и то же время
+    await set_setting(LAST_UPDATE_KEY, datetime.datetime.now().isoformat())
 
+async def get_last_update_time():
+    content = await get_setting(LAST_UPDATE_KEY)
+    if not content:
+        # значение из файла, который писали до переноса в БД
+        try:
+            with open("last_update.txt", "r", encoding="utf-8") as f:
+                content = f.read().strip()
+        except FileNotFoundError:
+            pass
+    if content:
+        return format_last_update(datetime.datetime.fromisoformat(content))
+    return "неизвестно"
@@ -29,7 +29,90 @@ DB_NAME = os.getenv("DB_NAME", "roadcards")
 DB_HOST = os.getenv("DB_HOST", "localhost")  # По умолчанию localhost для локального запуска
 DB_PORT = os.getenv("DB_PORT", "5432")
 
+# Можно указать SQLite для локальных прогонов без Postgres:
+# sqlite+aiosqlite:///roadcards.db или sqlite+aiosqlite:///:memory: (временный файл на время работы)
 DATABASE_URL = os.getenv(
     "DATABASE_URL", 
     f"postgresql+asyncpg://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
 )
+# Необязательная реплика только для чтения: пользовательские экраны читают с неё
+DATABASE_READ_URL = os.getenv("DATABASE_READ_URL", "")
+# Сколько секунд после изменения данных пользователя его чтения идут на основную БД
+READ_YOUR_WRITES_WINDOW = float(os.getenv("READ_YOUR_WRITES_WINDOW", "30"))
+
+# Пул соединений с БД (одинаковые настройки для основной БД и реплики)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))  # ожидание свободного соединения, сек
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "1") == "1"
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))  # пересоздавать соединения старше, сек
+# Ограничение времени запроса, мс (0 — без ограничения). Пересчёты итогов, архивация,
+# сверка и ожидание блокировок кластера выполняются без него
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "0"))
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100"))  # кэш prepared statements asyncpg
+DB_POOL_STATS_INTERVAL = float(os.getenv("DB_POOL_STATS_INTERVAL", "60"))  # 0 — не логировать
+
+# Кэш отрисованных экранов (статистика и страницы сделок): максимум записей в LRU
+SCREEN_CACHE_SIZE = int(os.getenv("SCREEN_CACHE_SIZE", "2000"))
+# Сколько секунд хранится снимок последней показанной страницы сделок (для деталей сделки)
+PAGE_SNAPSHOT_TTL = float(os.getenv("PAGE_SNAPSHOT_TTL", "300"))
+
+# Ограничение частоты callback-запросов от одного пользователя (token bucket)
+THROTTLE_RATE = float(os.getenv("THROTTLE_RATE", "2"))  # токенов в секунду
+THROTTLE_BURST = int(os.getenv("THROTTLE_BURST", "5"))  # размер корзины
+
+# Папка для автоматической загрузки отчётов (пусто — служба выключена).
+# Обработанные файлы переносятся в подпапки done/ и failed/.
+INGEST_DIR = os.getenv("INGEST_DIR", "")
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "2"))
+INGEST_POLL_INTERVAL = float(os.getenv("INGEST_POLL_INTERVAL", "10"))
+
+# Уведомления пользователям после импорта: низкий баланс и новые списания
+BALANCE_ALERTS = os.getenv("BALANCE_ALERTS", "0") == "1"
+LOW_BALANCE_THRESHOLD = float(os.getenv("LOW_BALANCE_THRESHOLD", "0"))  # в рублях, как видит пользователь
+NEW_CHARGE_ALERTS = os.getenv("NEW_CHARGE_ALERTS", "0") == "1"
+NOTIFY_RATE = float(os.getenv("NOTIFY_RATE", "20"))  # сообщений в секунду
+
+# Импорт отчётов пачками: сколько строк сохраняется в одной транзакции
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "1000"))
+# Блокировки карт при импорте: 0 — своя блокировка на каждую карту (по хэшу номера),
+# иначе карты раскладываются по указанному числу корзин
+IMPORT_LOCK_BUCKETS = int(os.getenv("IMPORT_LOCK_BUCKETS", "0"))
+
+# Выписки пользователей: сколько новых файлов можно сформировать за сутки
+STATEMENT_DAILY_LIMIT = int(os.getenv("STATEMENT_DAILY_LIMIT", "5"))
+
+# Бюджет времени запуска до готовности к приёму обновлений, мс (0 — не проверять)
+STARTUP_BUDGET_MS = float(os.getenv("STARTUP_BUDGET_MS", "0"))
+
+# Пакетная загрузка отчётов из ZIP: параллельный разбор и ограничения на архив
+ZIP_WORKERS = int(os.getenv("ZIP_WORKERS", "4"))
+ZIP_MAX_FILES = int(os.getenv("ZIP_MAX_FILES", "50"))
+ZIP_MAX_TOTAL_MB = int(os.getenv("ZIP_MAX_TOTAL_MB", "500"))  # суммарный размер после распаковки
+
+# Несколько экземпляров бота. При заданном WEBHOOK_URL каждый экземпляр принимает
+# обновления по webhook (за балансировщиком); без него обновления получает polling
+# только ведущего экземпляра, остальные ждут в резерве.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # публичный адрес, например https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", "8080"))
+# Как часто ведущий проверяет соединение с блокировкой, а остальные пытаются её захватить, сек
+LEADER_CHECK_INTERVAL = float(os.getenv("LEADER_CHECK_INTERVAL", "5"))
+# Хранилище состояний диалогов: db — общая таблица, memory — в памяти процесса.
+# Таблица нужна, только когда обновления принимают несколько экземпляров (webhook):
+# с ней каждое обновление читает состояние из БД ещё до ограничения частоты запросов
+FSM_STORAGE = os.getenv("FSM_STORAGE", "db" if WEBHOOK_URL else "memory")
+
+# Трассировка обновлений: JSONL-файл со spans вызовов БД и Bot API (пусто — выключена)
+TRACE_FILE = os.getenv("TRACE_FILE", "")
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.1"))  # доля записываемых обновлений
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "1000"))  # обновления дольше записываются всегда
+
+# Планировщик фоновых пересчётов (работает только на ведущем экземпляре)
+SCHEDULER_ENABLED = os.getenv("SCHEDULER_ENABLED", "1") == "1"
+ROLLUP_REFRESH_INTERVAL = float(os.getenv("ROLLUP_REFRESH_INTERVAL", "300"))  # догон новых сделок, сек
+VERIFY_AT = os.getenv("VERIFY_AT", "03:30")  # ночная сверка итогов с transactions, ЧЧ:ММ
+JOB_JITTER = float(os.getenv("JOB_JITTER", "30"))  # случайная добавка к запуску, сек
+JOB_TIME_BUDGET = float(os.getenv("JOB_TIME_BUDGET", "600"))  # задание дольше прерывается, сек
@@ -1,33 +1,291 @@
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
-from sqlalchemy import select, and_, func, extract
-from .models import Base, User, Whitelist, Transaction, TransactionType
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy import text, select, insert, update, delete, and_, or_, func, extract, case, cast, literal, literal_column, bindparam, any_, union_all, Integer, Float, String, Date
+from sqlalchemy.dialects.postgresql import ARRAY, insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from .models import (
+    Base,
+    User,
+    Whitelist,
+    Transaction,
+    TransactionType,
+    ImportCheckpoint,
+    CardMonthTotal,
+    TransactionArchive,
+    ArchivedMonth,
+    ARCHIVE_DOCUMENT_PREFIX,
+    CardDailyBalance,
+    StationMonthPrice,
+    FsmRecord,
+    AppSetting,
+    StatementUsage,
+    DocumentLabel,
+)
+from config import (
+    DATABASE_URL,
+    DATABASE_READ_URL,
+    READ_YOUR_WRITES_WINDOW,
+    DB_POOL_SIZE,
+    DB_MAX_OVERFLOW,
+    DB_POOL_TIMEOUT,
+    DB_POOL_PRE_PING,
+    DB_POOL_RECYCLE,
+    DB_STATEMENT_TIMEOUT_MS,
+    DB_STATEMENT_CACHE_SIZE,
+    IMPORT_LOCK_BUCKETS,
+)
+from tracing import instrument_module
+from datetime import datetime, date, timedelta
+import asyncio
+import atexit
+import logging
 import os
+import tempfile
+import time
+import zlib
 
-DATABASE_URL = os.getenv("DATABASE_URL", "postgresql+asyncpg://postgres:postgres@db:5432/roadcards")
 
-engine = create_async_engine(DATABASE_URL, echo=False)
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    """Пул соединений, который замеряет ожидание выдачи соединения и считает таймауты."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - started
+            self.checkouts += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+
+    def snapshot(self, reset: bool = False) -> dict:
+        stats = {
+            "size": self.size(),
+            "checked_out": self.checkedout(),
+            "overflow": max(self.overflow(), 0),
+            "checkouts": self.checkouts,
+            "timeouts": self.timeouts,
+            "wait_avg_ms": self.wait_total / self.checkouts * 1000 if self.checkouts else 0.0,
+            "wait_max_ms": self.wait_max * 1000,
+        }
+        if reset:
+            self.checkouts = 0
+            self.timeouts = 0
+            self.wait_total = 0.0
+            self.wait_max = 0.0
+        return stats
+
+
+def _remove_file(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def make_engine(url: str):
+    connect_args = {}
+    if url.startswith("sqlite"):
+        # SQLite (aiosqlite) — для локальных прогонов без Postgres; писатели ждут друг друга до 30 с
+        connect_args["timeout"] = 30
+        if ":memory:" in url or url.endswith(":///"):
+            # БД в памяти живёт в одном соединении, и сессии на нём не изолированы друг от друга
+            # (откат одной сессии отменяет незакоммиченные записи другой), поэтому вместо неё —
+            # временный файл, который удаляется при выходе
+            fd, path = tempfile.mkstemp(suffix=".db", prefix="roadcards_")
+            os.close(fd)
+            atexit.register(_remove_file, path)
+            logging.info(f"In-memory SQLite replaced with temporary file {path}")
+            url = f"{url.split(':///', 1)[0]}:///{path}"
+    if url.startswith("postgresql+asyncpg"):
+        connect_args["statement_cache_size"] = DB_STATEMENT_CACHE_SIZE
+        if DB_STATEMENT_TIMEOUT_MS:
+            connect_args["server_settings"] = {"statement_timeout": str(DB_STATEMENT_TIMEOUT_MS)}
+    return create_async_engine(
+        url,
+        echo=False,
+        poolclass=InstrumentedPool,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_pre_ping=DB_POOL_PRE_PING,
+        pool_recycle=DB_POOL_RECYCLE,
+        connect_args=connect_args,
+    )
+
+
+engine = make_engine(DATABASE_URL)
 async_session = async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
 
+# Postgres-специфичные пути (= ANY(массив), pg_trgm, advisory-блокировки, LISTEN/NOTIFY)
+# включаются только на Postgres; на SQLite используются их простые замены
+IS_POSTGRES = engine.dialect.name == "postgresql"
+
+
+
+async def _without_statement_timeout(session):
+    """Снимает statement_timeout до конца текущей транзакции (долгие пересчёты и ожидание блокировок)."""
+    if IS_POSTGRES and DB_STATEMENT_TIMEOUT_MS:
+        await session.execute(text("SET LOCAL statement_timeout = 0"))
+
+
+read_engine = make_engine(DATABASE_READ_URL) if DATABASE_READ_URL else engine
+read_session = async_sessionmaker(read_engine, expire_on_commit=False, class_=AsyncSession)
+
+_recent_writes = {}  # telegram_id -> момент последнего изменения его данных
+
+
+def mark_written(*telegram_ids: int):
+    """Запоминает пользователей, чьи данные только что изменились (чтение своих записей)."""
+    now = time.monotonic()
+    for telegram_id in telegram_ids:
+        _recent_writes[telegram_id] = now
+    if len(_recent_writes) > 10000:
+        for telegram_id, written in list(_recent_writes.items()):
+            if now - written > READ_YOUR_WRITES_WINDOW:
+                del _recent_writes[telegram_id]
+
+
+def session_for_read(telegram_id: int):
+    """Реплика для чтения, кроме пользователей с недавними изменениями — им основная БД."""
+    if read_engine is engine:
+        return async_session()
+    written = _recent_writes.get(telegram_id)
+    if written is not None and time.monotonic() - written < READ_YOUR_WRITES_WINDOW:
+        return async_session()
+    return read_session()
+
+
+def get_pool_stats(reset: bool = False) -> dict:
+    """Состояние пулов: выдано, переполнение, среднее/максимальное ожидание с прошлого сброса."""
+    stats = {}
+    if isinstance(engine.pool, InstrumentedPool):
+        stats["primary"] = engine.pool.snapshot(reset)
+    if read_engine is not engine and isinstance(read_engine.pool, InstrumentedPool):
+        stats["replica"] = read_engine.pool.snapshot(reset)
+    return stats
+
+
+async def log_pool_stats(interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        for name, stats in get_pool_stats(reset=True).items():
+            logging.info(
+                f"DB pool {name}: size={stats['size']} checked_out={stats['checked_out']} "
+                f"overflow={stats['overflow']} checkouts={stats['checkouts']} timeouts={stats['timeouts']} "
+                f"wait_avg={stats['wait_avg_ms']:.1f}ms wait_max={stats['wait_max_ms']:.1f}ms"
+            )
+
+
+# GIN-индексы pg_trgm для поиска подстроки (ILIKE '%...%') по сделкам
+TRIGRAM_INDEXES = {
+    "ix_transactions_card_number_trgm": ("transactions", "card_number"),
+    "ix_transactions_address_trgm": ("transactions", "address"),
+    "ix_transactions_item_name_trgm": ("transactions", "item_name"),
+    "ix_transactions_archive_card_number_trgm": ("transactions_archive", "card_number"),
+    "ix_transactions_archive_address_trgm": ("transactions_archive", "address"),
+    "ix_transactions_archive_item_name_trgm": ("transactions_archive", "item_name"),
+}
+
+
+async def create_trigram_indexes():
+    if not IS_POSTGRES:
+        return
+    statements = ["CREATE EXTENSION IF NOT EXISTS pg_trgm"] + [
+        f"CREATE INDEX IF NOT EXISTS {name} ON {table} USING gin ({column} gin_trgm_ops)"
+        for name, (table, column) in TRIGRAM_INDEXES.items()
+    ]
+    for statement in statements:
+        try:
+            async with engine.begin() as conn:
+                # построение индекса на большой таблице может идти дольше statement_timeout
+                await _without_statement_timeout(conn)
+                await conn.execute(text(statement))
+        except Exception as e:
+            # без прав на расширение поиск работает, но без индекса
+            logging.warning(f"Could not apply '{statement}': {e}")
+            if statement == statements[0]:
+                return
+
 
 async def init_db():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+    await create_trigram_indexes()
+
+    # Первичное заполнение итогов по месяцам и дневных балансов для уже загруженных сделок
+    async with async_session() as session:
+        has_rollups = await session.scalar(select(CardMonthTotal.id).limit(1))
+        has_snapshots = await session.scalar(select(CardDailyBalance.id).limit(1))
+        has_prices = await session.scalar(select(StationMonthPrice.id).limit(1))
+        has_transactions = await session.scalar(select(Transaction.id).limit(1))
+    if has_transactions and not has_rollups:
+        await refresh_card_month_totals()
+    if has_transactions and not has_snapshots:
+        await refresh_card_daily_balances()
+    if has_transactions and not has_prices:
+        await refresh_station_month_prices()
+
+
+# Запросы горячих хелперов строятся один раз: форма SQL не зависит от аргументов
+# (карты передаются одним массивом в = ANY(:cards), а не списком IN разной длины),
+# поэтому SQLAlchemy берёт скомпилированный запрос из кэша,
+# а asyncpg переиспользует prepared statement на сервере.
+# На SQLite массивов нет — там тот же параметр cards раскрывается в IN (...).
+def _in_cards(column):
+    if IS_POSTGRES:
+        return column == any_(bindparam("cards", type_=ARRAY(String)))
+    return column.in_(bindparam("cards", expanding=True))
+
+
+_user_by_tg_id_stmt = (
+    select(User).where(User.telegram_id == bindparam("telegram_id")).limit(1)
+)
+_user_cards_stmt = select(User.card_number).where(User.telegram_id == bindparam("telegram_id"))
+_user_balance_stmt = select(
+    func.coalesce(
+        func.sum(
+            case(
+                (Transaction.type == TransactionType.EXPENSE, Transaction.cost),
+                else_=-Transaction.cost,
+            )
+        ),
+        0.0,
+    )
+).where(_in_cards(Transaction.card_number))
+_user_transactions_stmt = (
+    select(Transaction)
+    .where(_in_cards(Transaction.card_number))
+    .order_by(Transaction.date.desc())
+    .limit(bindparam("limit"))
+    .offset(bindparam("offset"))
+)
+_user_transactions_count_stmt = select(func.count(Transaction.id)).where(
+    _in_cards(Transaction.card_number)
+)
 
 
 async def get_user_by_tg_id(telegram_id: int) -> User:
     async with async_session() as session:
         # возвращаем первую найденную карту для этого пользователя
-        result = await session.execute(
-            select(User).where(User.telegram_id == telegram_id).limit(1)
-        )
+        result = await session.execute(_user_by_tg_id_stmt, {"telegram_id": telegram_id})
         return result.scalar_one_or_none()
 
 
 async def get_all_user_cards(telegram_id: int):
-    async with async_session() as session:
-        result = await session.execute(
-            select(User.card_number).where(User.telegram_id == telegram_id)
-        )
+    async with session_for_read(telegram_id) as session:
+        result = await session.execute(_user_cards_stmt, {"telegram_id": telegram_id})
         return result.scalars().all()
 
 
@@ -52,6 +310,33 @@ async def register_user(telegram_id: int, card_number: str, is_admin: bool = Fal
         user = User(telegram_id=telegram_id, card_number=card_number, is_admin=is_admin)
         session.add(user)
         await session.commit()
+    mark_written(telegram_id)
+
+
+async def delete_user_registrations(telegram_id: int) -> list[str]:
+    """Удаляет все карты пользователя, возвращает их номера."""
+    async with async_session() as session:
+        result = await session.execute(select(User).where(User.telegram_id == telegram_id))
+        db_users = result.scalars().all()
+        for u in db_users:
+            await session.delete(u)
+        await session.commit()
+    return [u.card_number for u in db_users]
+
+
+async def delete_user_card(telegram_id: int, card_number: str) -> bool:
+    async with async_session() as session:
+        result = await session.execute(
+            delete(User).where(and_(User.telegram_id == telegram_id, User.card_number == card_number))
+        )
+        await session.commit()
+    return result.rowcount > 0
+
+
+async def get_all_telegram_ids() -> list[int]:
+    async with async_session() as session:
+        result = await session.execute(select(User.telegram_id))
+        return result.scalars().all()
 
 
 async def add_to_whitelist(card_number: str):
@@ -62,68 +347,207 @@ async def add_to_whitelist(card_number: str):
             await session.commit()
 
 
-async def get_user_balance(telegram_id: int) -> float:
+async def add_to_whitelist_in_session(session, cards):
+    """Добавляет в белый список недостающие карты в рамках переданной сессии."""
+    cards = set(cards)
+    if not cards:
+        return
+    result = await session.execute(
+        select(Whitelist.card_number).where(Whitelist.card_number.in_(cards))
+    )
+    for card_number in cards - set(result.scalars().all()):
+        session.add(Whitelist(card_number=card_number))
+
+
+# Пространства ключей advisory-блокировок (двухключевая форма, не пересекаются с блокировками кластера):
+# карты, месяцы индекса цен и производные таблицы целиком
+CARD_LOCK_NAMESPACE = 7301
+MONTH_LOCK_NAMESPACE = 7302
+TABLE_LOCK_NAMESPACE = 7303
+
+# Все ключи берутся одним запросом по возрастанию, поэтому транзакции
+# с пересекающимися наборами ключей не взаимоблокируются
+_LOCK_KEYS = text(
+    "SELECT pg_advisory_xact_lock(:namespace, k) FROM unnest(:keys) AS k ORDER BY k"
+).bindparams(bindparam("keys", type_=ARRAY(Integer)))
+
+
+def _int4(key: int) -> int:
+    # int4 для pg_advisory_xact_lock(int, int)
+    return key - 2 ** 32 if key >= 2 ** 31 else key
+
+
+def card_lock_key(card_number: str) -> int:
+    key = zlib.crc32(card_number.encode())
+    if IMPORT_LOCK_BUCKETS > 0:
+        return key % IMPORT_LOCK_BUCKETS
+    return _int4(key)
+
+
+async def _lock_keys(session, namespace: int, keys):
+    if not IS_POSTGRES:
+        # в SQLite пишет один писатель: пустой DELETE сразу берёт блокировку записи на всю БД
+        await session.execute(delete(Whitelist).where(literal(False)))
+        return
+    keys = sorted(set(keys))
+    if keys:
+        await session.execute(_LOCK_KEYS, {"namespace": namespace, "keys": keys})
+
+
+async def lock_cards(session, cards):
+    """
+    Берёт блокировки транзакции на карты (снимаются при commit/rollback).
+    Импорты и пересчёты с разными картами идут параллельно, с общими — по очереди.
+    """
+    await _lock_keys(session, CARD_LOCK_NAMESPACE, (card_lock_key(card) for card in cards))
+
+
+async def _lock_refresh(session, table, namespace: int = None, keys=None):
+    """
+    Блокировки пересчёта производной таблицы (DELETE + INSERT ... SELECT) до конца транзакции.
+    Без них два параллельных пересчёта одних карт или месяцев вставляют одинаковые строки:
+    DELETE второго не видит строк, только что вставленных первым.
+    Полный пересчёт (keys=None) блокирует таблицу целиком, частичный — разделяемо таблицу
+    и свои ключи, поэтому частичные пересчёты с разными ключами не ждут друг друга.
+    """
+    if not IS_POSTGRES:
+        await _lock_keys(session, TABLE_LOCK_NAMESPACE, ())
+        return
+    table_key = _int4(zlib.crc32(table.__tablename__.encode()))
+    if keys is None:
+        await session.execute(select(func.pg_advisory_xact_lock(TABLE_LOCK_NAMESPACE, table_key)))
+        return
+    await session.execute(select(func.pg_advisory_xact_lock_shared(TABLE_LOCK_NAMESPACE, table_key)))
+    await _lock_keys(session, namespace, keys)
+
+
+async def get_transactions_for_dedup(session, cards, dates):
+    """
+    Сделки по картам и датам пачки одним запросом (для проверки дубликатов при импорте).
+    Архивированные сделки тоже учитываются, иначе повторная загрузка старого отчёта
+    добавила бы их второй раз рядом с итоговой строкой архива.
+    Возвращает строки (card_number, date, type, item_name, cost) без ORM-объектов;
+    пары карта+дата сверяет вызывающий код.
+    """
+    cards = list(cards)
+    dates = list(dates)
+    if not cards or not dates:
+        return []
+
+    def rows(model, *filters):
+        return select(
+            model.card_number, model.date, model.type, model.item_name, model.cost
+        ).where(and_(model.card_number.in_(cards), model.date.in_(dates), *filters))
+
+    result = await session.execute(
+        union_all(rows(Transaction, is_not_archive_summary()), rows(TransactionArchive))
+    )
+    return result.all()
+
+
+async def insert_transactions(session, rows: list[dict]):
+    """Вставка пачки сделок через Core (executemany), без создания ORM-объектов."""
+    if rows:
+        await session.execute(insert(Transaction), rows)
+
+
+async def get_import_checkpoint(file_hash: str) -> ImportCheckpoint:
     async with async_session() as session:
-        cards = await get_all_user_cards(telegram_id)
-        if not cards:
-            return 0.0
+        result = await session.execute(
+            select(ImportCheckpoint).where(ImportCheckpoint.file_hash == file_hash)
+        )
+        return result.scalar_one_or_none()
 
-        result_expenses = await session.execute(
-            select(Transaction.cost).where(
-                and_(
-                    Transaction.card_number.in_(cards),
-                    Transaction.type == TransactionType.EXPENSE,
-                )
-            )
+
+async def save_import_checkpoint(session, file_hash: str, document: str, last_row: int):
+    """Обновляет контрольную точку в той же транзакции, что и сохраняемая пачка строк."""
+    result = await session.execute(
+        select(ImportCheckpoint).where(ImportCheckpoint.file_hash == file_hash)
+    )
+    checkpoint = result.scalar_one_or_none()
+    if checkpoint is None:
+        checkpoint = ImportCheckpoint(file_hash=file_hash)
+        session.add(checkpoint)
+    checkpoint.document = document
+    checkpoint.last_row = last_row
+    checkpoint.finished = False
+    checkpoint.updated_at = datetime.now()
+
+
+async def finish_import_checkpoint(file_hash: str):
+    async with async_session() as session:
+        result = await session.execute(
+            select(ImportCheckpoint).where(ImportCheckpoint.file_hash == file_hash)
         )
-        expenses = sum(r[0] for r in result_expenses.all())
+        checkpoint = result.scalar_one_or_none()
+        if checkpoint is not None:
+            checkpoint.finished = True
+            checkpoint.updated_at = datetime.now()
+            await session.commit()
 
-        result_payments = await session.execute(
-            select(Transaction.cost).where(
-                and_(
-                    Transaction.card_number.in_(cards),
-                    Transaction.type == TransactionType.PAYMENT,
-                )
-            )
+
+async def delete_import_checkpoints(document: str):
+    """После отзыва документа его незавершённый импорт нельзя продолжать."""
+    async with async_session() as session:
+        await session.execute(
+            delete(ImportCheckpoint).where(ImportCheckpoint.document == document)
         )
-        payments = sum(r[0] for r in result_payments.all())
+        await session.commit()
 
-        return expenses - payments
 
+async def get_user_balance(telegram_id: int, cards=None) -> float:
+    """Траты минус оплаты по всем картам пользователя (одним агрегатом в БД)."""
+    if cards is None:
+        cards = await get_all_user_cards(telegram_id)
+    if not cards:
+        return 0.0
+    async with session_for_read(telegram_id) as session:
+        result = await session.execute(_user_balance_stmt, {"cards": list(cards)})
+        return float(result.scalar() or 0.0)
 
-async def get_user_transactions(telegram_id: int, limit: int = 10, offset: int = 0):
-    async with async_session() as session:
+
+async def get_user_transactions(telegram_id: int, limit: int = 10, offset: int = 0, cards=None):
+    if cards is None:
         cards = await get_all_user_cards(telegram_id)
-        if not cards:
-            return []
+    if not cards:
+        return []
+    async with session_for_read(telegram_id) as session:
         result = await session.execute(
-            select(Transaction)
-            .where(Transaction.card_number.in_(cards))
-            .order_by(Transaction.date.desc())
-            .limit(limit)
-            .offset(offset)
+            _user_transactions_stmt, {"cards": list(cards), "limit": limit, "offset": offset}
         )
         return result.scalars().all()
 
 
-async def count_user_transactions(telegram_id: int):
+async def get_transaction_for_cards(transaction_id: int, cards):
+    """Сделка по id, только если она относится к одной из переданных карт."""
+    if not cards:
+        return None
     async with async_session() as session:
-        cards = await get_all_user_cards(telegram_id)
-        if not cards:
-            return 0
-        from sqlalchemy import func
-
         result = await session.execute(
-            select(func.count(Transaction.id)).where(
-                Transaction.card_number.in_(cards)
+            select(Transaction).where(
+                and_(
+                    Transaction.id == transaction_id,
+                    Transaction.card_number.in_(cards),
+                )
             )
         )
-        return result.scalar()
+        return result.scalar_one_or_none()
 
 
-async def get_user_expense_stats(telegram_id: int):
-    async with async_session() as session:
+async def count_user_transactions(telegram_id: int, cards=None):
+    if cards is None:
         cards = await get_all_user_cards(telegram_id)
+    if not cards:
+        return 0
+    async with session_for_read(telegram_id) as session:
+        result = await session.execute(_user_transactions_count_stmt, {"cards": list(cards)})
+        return result.scalar()
+
+
+async def get_user_expense_stats(telegram_id: int, cards=None):
+    async with session_for_read(telegram_id) as session:
+        if cards is None:
+            cards = await get_all_user_cards(telegram_id)
         if not cards:
             return {
                 "total_liters": 0.0,
@@ -146,6 +570,19 @@ async def get_user_expense_stats(telegram_id: int):
         )
         total_liters, total_cost, total_count = total_result.one()
 
+        # Архивированные сделки представлены одной итоговой строкой за месяц
+        archived_result = await session.execute(
+            select(
+                func.coalesce(func.sum(ArchivedMonth.row_count - 1), 0)
+            ).where(
+                and_(
+                    ArchivedMonth.card_number.in_(cards),
+                    ArchivedMonth.type == TransactionType.EXPENSE,
+                )
+            )
+        )
+        total_count = (total_count or 0) + (archived_result.scalar() or 0)
+
         monthly_result = await session.execute(
             select(
                 extract("year", Transaction.date).label("year"),
@@ -186,3 +623,958 @@ async def add_transaction(data: dict):
         session.add(transaction)
         await session.commit()
 
+
+
+async def get_telegram_ids_by_cards(cards) -> list[int]:
+    cards = list(cards)
+    if not cards:
+        return []
+    async with async_session() as session:
+        result = await session.execute(
+            select(User.telegram_id).where(User.card_number.in_(cards)).distinct()
+        )
+        return result.scalars().all()
+
+
+async def get_document_balance_changes(document: str):
+    """
+    Одним запросом: для каждого пользователя, у которого есть карта из документа,
+    возвращает (telegram_id, баланс по всем картам, сумма новых списаний из документа).
+    """
+    affected_cards = (
+        select(Transaction.card_number)
+        .where(Transaction.document == document)
+        .distinct()
+    )
+    affected_users = select(User.telegram_id).where(User.card_number.in_(affected_cards))
+    signed_cost = case(
+        (Transaction.type == TransactionType.EXPENSE, Transaction.cost),
+        else_=-Transaction.cost,
+    )
+    new_charges = case(
+        (
+            and_(
+                Transaction.document == document,
+                Transaction.type == TransactionType.EXPENSE,
+            ),
+            Transaction.cost,
+        ),
+        else_=0.0,
+    )
+    async with async_session() as session:
+        result = await session.execute(
+            select(
+                User.telegram_id,
+                func.coalesce(func.sum(signed_cost), 0.0),
+                func.coalesce(func.sum(new_charges), 0.0),
+            )
+            .join(Transaction, Transaction.card_number == User.card_number)
+            .where(User.telegram_id.in_(affected_users))
+            .group_by(User.telegram_id)
+        )
+        return [(int(tg_id), float(balance), float(charges)) for tg_id, balance, charges in result.all()]
+
+
+def _month_totals_select():
+    """Итоги по карте, месяцу и типу, посчитанные по transactions (источник card_month_totals)."""
+    year = cast(extract("year", Transaction.date), Integer)
+    month = cast(extract("month", Transaction.date), Integer)
+    return select(
+        Transaction.card_number.label("card_number"),
+        year.label("year"),
+        month.label("month"),
+        Transaction.type.label("type"),
+        func.coalesce(func.sum(Transaction.quantity), 0.0).label("liters"),
+        func.coalesce(func.sum(Transaction.cost), 0.0).label("cost"),
+        func.count(Transaction.id).label("count"),
+    ).group_by(Transaction.card_number, year, month, Transaction.type)
+
+
+async def refresh_card_month_totals(cards=None):
+    """
+    Пересчитывает итоги card_month_totals по переданным картам (None — по всем)
+    одним INSERT ... SELECT с группировкой по карте, месяцу и типу.
+    """
+    if cards is not None:
+        cards = list(cards)
+        if not cards:
+            return
+    totals = _month_totals_select()
+    clear = delete(CardMonthTotal)
+    if cards is not None:
+        totals = totals.where(Transaction.card_number.in_(cards))
+        clear = clear.where(CardMonthTotal.card_number.in_(cards))
+
+    async with async_session() as session:
+        await _without_statement_timeout(session)
+        await _lock_refresh(
+            session,
+            CardMonthTotal,
+            CARD_LOCK_NAMESPACE,
+            None if cards is None else [card_lock_key(card) for card in cards],
+        )
+        await session.execute(clear)
+        await session.execute(
+            insert(CardMonthTotal).from_select(
+                ["card_number", "year", "month", "type", "liters", "cost", "count"],
+                totals,
+            )
+        )
+        await session.commit()
+
+
+async def get_fleet_analytics(top_limit: int = 10, months_limit: int = 12):
+    """Сводка по всем клиентам из card_month_totals: итоги, топ карт по тратам, литры по месяцам."""
+    async with async_session() as session:
+        totals_result = await session.execute(
+            select(CardMonthTotal.type, func.sum(CardMonthTotal.cost)).group_by(CardMonthTotal.type)
+        )
+        totals = {t_type: float(cost or 0) for t_type, cost in totals_result.all()}
+
+        top_cost = func.sum(CardMonthTotal.cost)
+        top_result = await session.execute(
+            select(
+                CardMonthTotal.card_number,
+                top_cost,
+                func.sum(CardMonthTotal.liters),
+            )
+            .where(CardMonthTotal.type == TransactionType.EXPENSE)
+            .group_by(CardMonthTotal.card_number)
+            .order_by(top_cost.desc())
+            .limit(top_limit)
+        )
+
+        monthly_result = await session.execute(
+            select(
+                CardMonthTotal.year,
+                CardMonthTotal.month,
+                func.sum(CardMonthTotal.liters),
+                func.sum(CardMonthTotal.cost),
+            )
+            .where(CardMonthTotal.type == TransactionType.EXPENSE)
+            .group_by(CardMonthTotal.year, CardMonthTotal.month)
+            .order_by(CardMonthTotal.year.desc(), CardMonthTotal.month.desc())
+            .limit(months_limit)
+        )
+
+        return {
+            "expenses": totals.get(TransactionType.EXPENSE, 0.0),
+            "payments": totals.get(TransactionType.PAYMENT, 0.0),
+            "top_cards": [
+                {"card": card, "cost": float(cost or 0), "liters": float(liters or 0)}
+                for card, cost, liters in top_result.all()
+            ],
+            "monthly": [
+                {"year": year, "month": month, "liters": float(liters or 0), "cost": float(cost or 0)}
+                for year, month, liters, cost in monthly_result.all()
+            ],
+        }
+
+
+def _month_range(year: int, month: int):
+    start = datetime(year, month, 1)
+    end = datetime(year + month // 12, month % 12 + 1, 1)
+    return start, end
+
+
+async def refresh_station_month_prices(months=None):
+    """
+    Пересчитывает индекс цен АЗС за переданные месяцы ((год, месяц), None — за всё время).
+    Источник — траты из transactions (без итоговых строк архива) и transactions_archive,
+    так что архивация не меняет индекс.
+    """
+    if months is not None:
+        months = sorted(set(months))
+        if not months:
+            return
+
+    def expense_rows(model, extra_filter=None):
+        filters = [model.type == TransactionType.EXPENSE, model.address.is_not(None), model.address != ""]
+        if extra_filter is not None:
+            filters.append(extra_filter)
+        if months is not None:
+            filters.append(
+                or_(*[and_(model.date >= start, model.date < end) for start, end in (_month_range(y, m) for y, m in months)])
+            )
+        return select(
+            model.address, model.item_name, model.date, model.quantity, model.price, model.cost
+        ).where(and_(*filters))
+
+    rows = union_all(
+        expense_rows(Transaction, is_not_archive_summary()),
+        expense_rows(TransactionArchive),
+    ).subquery()
+    year = cast(extract("year", rows.c.date), Integer)
+    month = cast(extract("month", rows.c.date), Integer)
+    item_name = func.coalesce(rows.c.item_name, "")
+    # строки без цены не портят минимум и среднее, но литры по станции учитываются
+    priced = rows.c.price > 0
+    priced_quantity = func.sum(case((priced, rows.c.quantity)))
+    prices = select(
+        rows.c.address,
+        item_name,
+        year,
+        month,
+        func.coalesce(
+            func.sum(case((priced, rows.c.price * rows.c.quantity))) / func.nullif(priced_quantity, 0, type_=Float),
+            func.avg(case((priced, rows.c.price))),
+        ),
+        func.min(case((priced, rows.c.price))),
+        func.max(case((priced, rows.c.price))),
+        func.coalesce(func.sum(rows.c.quantity), 0.0),
+        func.coalesce(func.sum(rows.c.cost), 0.0),
+        func.count(),
+    ).group_by(rows.c.address, item_name, year, month)
+
+    clear = delete(StationMonthPrice)
+    if months is not None:
+        clear = clear.where(
+            or_(*[and_(StationMonthPrice.year == y, StationMonthPrice.month == m) for y, m in months])
+        )
+
+    async with async_session() as session:
+        await _without_statement_timeout(session)
+        await _lock_refresh(
+            session,
+            StationMonthPrice,
+            MONTH_LOCK_NAMESPACE,
+            None if months is None else [y * 12 + m for y, m in months],
+        )
+        await session.execute(clear)
+        await session.execute(
+            insert(StationMonthPrice).from_select(
+                [
+                    "address", "item_name", "year", "month", "avg_price",
+                    "min_price", "max_price", "liters", "cost", "count",
+                ],
+                prices,
+            )
+        )
+        await session.commit()
+
+
+async def get_station_price_periods(limit: int = 24) -> list[tuple[int, int]]:
+    """Месяцы, за которые есть индекс цен АЗС, от последнего к первому."""
+    async with async_session() as session:
+        result = await session.execute(
+            select(StationMonthPrice.year, StationMonthPrice.month)
+            .distinct()
+            .order_by(StationMonthPrice.year.desc(), StationMonthPrice.month.desc())
+            .limit(limit)
+        )
+        return [(y, m) for y, m in result.all()]
+
+
+async def get_station_prices(year: int, month: int, limit: int = 20):
+    """Строки индекса цен АЗС за месяц, самые загруженные станции (по литрам) первыми."""
+    async with async_session() as session:
+        result = await session.execute(
+            select(StationMonthPrice)
+            .where(and_(StationMonthPrice.year == year, StationMonthPrice.month == month))
+            .order_by(StationMonthPrice.liters.desc(), StationMonthPrice.address, StationMonthPrice.item_name)
+            .limit(limit)
+        )
+        return result.scalars().all()
+
+
+def _statement_rows(cards, start_date=None, end_date=None):
+    """
+    Строки выписки по картам за период: transactions без итоговых строк архива
+    и исходные сделки из transactions_archive (как в выгрузке администратора).
+    """
+    def rows(model, *filters):
+        filters = [model.card_number.in_(cards), *filters]
+        if start_date is not None:
+            filters.append(model.date >= start_date)
+        if end_date is not None:
+            filters.append(model.date <= end_date)
+        return select(
+            model.date.label("date"),
+            model.card_number.label("card_number"),
+            model.type.label("type"),
+            model.address.label("address"),
+            model.item_name.label("item_name"),
+            model.quantity.label("quantity"),
+            model.price.label("price"),
+            model.cost.label("cost"),
+        ).where(and_(*filters))
+
+    return union_all(rows(Transaction, is_not_archive_summary()), rows(TransactionArchive)).subquery()
+
+
+async def iter_statement_rows(cards, start_date=None, end_date=None, batch_size: int = 1000):
+    """Потоково отдаёт строки выписки по картам за период, не загружая их все в память."""
+    rows = _statement_rows(cards, start_date, end_date)
+    async with async_session() as session:
+        result = await session.stream(
+            select(rows).order_by(rows.c.date).execution_options(yield_per=batch_size)
+        )
+        async for row in result:
+            yield row
+
+
+async def get_statement_monthly_totals(cards, start_date=None, end_date=None):
+    """Итоги выписки по месяцам и типам операций, посчитанные в SQL по тем же строкам."""
+    rows = _statement_rows(cards, start_date, end_date)
+    year = extract("year", rows.c.date)
+    month = extract("month", rows.c.date)
+    async with async_session() as session:
+        result = await session.execute(
+            select(
+                year,
+                month,
+                rows.c.type,
+                func.coalesce(func.sum(rows.c.quantity), 0.0),
+                func.coalesce(func.sum(rows.c.cost), 0.0),
+                func.count(),
+            )
+            .group_by(year, month, rows.c.type)
+            .order_by(year, month)
+        )
+        return [
+            {
+                "year": int(y),
+                "month": int(m),
+                "type": t_type,
+                "liters": float(liters or 0),
+                "cost": float(cost or 0),
+                "count": int(count or 0),
+            }
+            for y, m, t_type, liters, cost, count in result.all()
+        ]
+
+
+async def delete_document(document: str):
+    """
+    Удаляет все сделки документа.
+    Возвращает (число строк, затронутые карты, месяцы трат (год, месяц)).
+    """
+    async with async_session() as session:
+        rows = (
+            await session.execute(
+                select(Transaction.card_number, Transaction.date, Transaction.type)
+                .where(Transaction.document == document)
+            )
+        ).all()
+        await session.execute(delete(Transaction).where(Transaction.document == document))
+        await session.commit()
+    cards = {row.card_number for row in rows}
+    months = {
+        (row.date.year, row.date.month) for row in rows if row.type == TransactionType.EXPENSE
+    }
+    return len(rows), cards, months
+
+
+def is_archive_summary():
+    return Transaction.document.startswith(ARCHIVE_DOCUMENT_PREFIX)
+
+
+def is_not_archive_summary():
+    # NOT (document LIKE ...) для NULL даёт NULL, поэтому старые строки без документа проверяются отдельно
+    return or_(Transaction.document.is_(None), ~is_archive_summary())
+
+
+def _month_start(column):
+    """Начало месяца даты (в SQLite — строкой в том же формате, в каком SQLAlchemy хранит даты)."""
+    if IS_POSTGRES:
+        # константа, а не параметр: выражение должно совпадать в SELECT и GROUP BY
+        return func.date_trunc(literal_column("'month'"), column)
+    return func.strftime("%Y-%m-01 00:00:00.000000", column)
+
+
+def _format_month(column, pattern: str):
+    """Месяц даты строкой; pattern в формате strftime, только %Y и %m."""
+    if IS_POSTGRES:
+        return func.to_char(column, pattern.replace("%Y", "YYYY").replace("%m", "MM"))
+    return func.strftime(pattern, column)
+
+
+async def get_documents() -> list[str]:
+    """Метки загруженных документов (без итоговых строк архива)."""
+    async with async_session() as session:
+        result = await session.execute(
+            select(Transaction.document)
+            .where(and_(Transaction.document.is_not(None), ~is_archive_summary()))
+            .distinct()
+            .order_by(Transaction.document)
+        )
+        return [d for (d,) in result.all() if d]
+
+
+async def archive_transactions(cutoff: datetime):
+    """
+    Переносит сделки старше cutoff в transactions_archive и заменяет их итоговыми строками
+    по карте, месяцу и типу (сумма количества и стоимости), поэтому баланс и статистика
+    не меняются. Всё выполняется в одной транзакции несколькими INSERT ... SELECT,
+    без построчной работы в Python.
+    Возвращает (перенесено строк, создано итоговых строк, затронутые карты).
+    """
+    old_rows = and_(Transaction.date < cutoff, is_not_archive_summary())
+    month_start = _month_start(Transaction.date)
+    groups = (
+        select(
+            Transaction.card_number.label("card_number"),
+            month_start.label("month_start"),
+            Transaction.type.label("type"),
+            func.coalesce(func.sum(Transaction.quantity), 0.0).label("quantity"),
+            func.coalesce(func.sum(Transaction.cost), 0.0).label("cost"),
+            func.count(Transaction.id).label("count"),
+        )
+        .where(old_rows)
+        .group_by(Transaction.card_number, month_start, Transaction.type)
+        .subquery()
+    )
+    summaries = select(
+        groups.c.card_number,
+        literal(ARCHIVE_DOCUMENT_PREFIX) + _format_month(groups.c.month_start, "%Y-%m"),
+        literal(""),
+        groups.c.month_start,
+        literal(""),
+        literal("Архив за ")
+        + _format_month(groups.c.month_start, "%m.%Y")
+        + literal(" (")
+        + cast(groups.c.count, String)
+        + literal(" операций)"),
+        groups.c.quantity,
+        literal(None, Float),
+        groups.c.cost,
+        groups.c.type,
+    )
+    columns = [
+        "id", "card_number", "document", "firm", "date", "address",
+        "item_name", "quantity", "price", "cost", "type",
+    ]
+    archived_at = datetime.now()
+
+    async with async_session() as session:
+        await _without_statement_timeout(session)
+        max_id_before = await session.scalar(select(func.coalesce(func.max(Transaction.id), 0)))
+        summary_cards = (
+            await session.execute(
+                insert(Transaction)
+                .from_select(
+                    ["card_number", "document", "firm", "date", "address",
+                     "item_name", "quantity", "price", "cost", "type"],
+                    summaries,
+                )
+                .returning(Transaction.card_number)
+            )
+        ).scalars().all()
+        if not summary_cards:
+            return 0, 0, set()
+
+        # итоговая строка находится по карте, типу и началу месяца среди только что вставленных
+        await session.execute(
+            insert(ArchivedMonth).from_select(
+                ["card_number", "year", "month", "type", "row_count", "summary_transaction_id"],
+                select(
+                    groups.c.card_number,
+                    cast(extract("year", groups.c.month_start), Integer),
+                    cast(extract("month", groups.c.month_start), Integer),
+                    groups.c.type,
+                    groups.c.count,
+                    Transaction.id,
+                ).join(
+                    Transaction,
+                    and_(
+                        Transaction.id > max_id_before,
+                        is_archive_summary(),
+                        Transaction.card_number == groups.c.card_number,
+                        Transaction.type == groups.c.type,
+                        Transaction.date == groups.c.month_start,
+                    ),
+                ),
+            )
+        )
+        await session.execute(
+            insert(TransactionArchive).from_select(
+                columns + ["archived_at"],
+                select(*[getattr(Transaction, c) for c in columns], literal(archived_at)).where(old_rows),
+            )
+        )
+        archived_count = (
+            await session.execute(
+                delete(Transaction).where(old_rows).execution_options(synchronize_session=False)
+            )
+        ).rowcount
+        await session.commit()
+
+    return archived_count, len(summary_cards), set(summary_cards)
+
+
+async def get_transactions_for_export(start_date: datetime, end_date: datetime):
+    """
+    Сделки за период для выгрузки. Итоговые строки архива не выгружаются —
+    вместо них возвращаются исходные сделки из transactions_archive.
+    """
+    async with async_session() as session:
+        live = (
+            await session.execute(
+                select(Transaction).where(
+                    and_(
+                        Transaction.date >= start_date,
+                        Transaction.date <= end_date,
+                        is_not_archive_summary(),
+                    )
+                )
+            )
+        ).scalars().all()
+        archived = (
+            await session.execute(
+                select(TransactionArchive).where(
+                    and_(
+                        TransactionArchive.date >= start_date,
+                        TransactionArchive.date <= end_date,
+                    )
+                )
+            )
+        ).scalars().all()
+
+    return sorted([*live, *archived], key=lambda t: t.date)
+
+
+def signed_cost(model=Transaction):
+    """Стоимость со знаком: траты положительные, оплаты отрицательные (как в балансе)."""
+    return case(
+        (model.type == TransactionType.EXPENSE, model.cost),
+        else_=-model.cost,
+    )
+
+
+def _day_level_rows(cards=None):
+    """
+    Сделки с точностью до дня (карта, дата, стоимость со знаком): transactions без итоговых
+    строк архива и исходные сделки из transactions_archive. Итоговая строка датирована
+    1-м числом месяца, поэтому для балансов по дням она не подходит.
+    """
+    def rows(model, *filters):
+        if cards is not None:
+            filters = (*filters, model.card_number.in_(cards))
+        return select(
+            model.card_number.label("card_number"),
+            model.date.label("date"),
+            signed_cost(model).label("amount"),
+        ).where(and_(*filters))
+
+    return union_all(rows(Transaction, is_not_archive_summary()), rows(TransactionArchive)).subquery()
+
+
+async def refresh_card_daily_balances(cards=None):
+    """
+    Пересчитывает дневные балансы card_daily_balances по переданным картам (None — по всем):
+    сумма за день по карте и нарастающий итог оконной функцией, одним INSERT ... SELECT.
+    Архивированные месяцы считаются по исходным сделкам из transactions_archive.
+    """
+    if cards is not None:
+        cards = list(cards)
+        if not cards:
+            return
+    rows = _day_level_rows(cards)
+    # в SQLite даты хранятся строками, CAST AS DATE там не работает
+    day = cast(rows.c.date, Date) if IS_POSTGRES else func.date(rows.c.date)
+    daily = select(
+        rows.c.card_number.label("card_number"),
+        day.label("day"),
+        func.sum(rows.c.amount).label("delta"),
+    ).group_by(rows.c.card_number, day)
+    clear = delete(CardDailyBalance)
+    if cards is not None:
+        clear = clear.where(CardDailyBalance.card_number.in_(cards))
+    daily = daily.subquery()
+    cumulative = select(
+        daily.c.card_number,
+        daily.c.day,
+        func.sum(daily.c.delta).over(partition_by=daily.c.card_number, order_by=daily.c.day),
+    )
+
+    async with async_session() as session:
+        await _without_statement_timeout(session)
+        await _lock_refresh(
+            session,
+            CardDailyBalance,
+            CARD_LOCK_NAMESPACE,
+            None if cards is None else [card_lock_key(card) for card in cards],
+        )
+        await session.execute(clear)
+        await session.execute(
+            insert(CardDailyBalance).from_select(["card_number", "day", "balance"], cumulative)
+        )
+        await session.commit()
+
+
+async def get_cards_balance_as_of(cards, as_of: date) -> float:
+    """
+    Баланс карт на конец дня as_of: последний дневной снимок каждой карты не позже as_of
+    плюс операции после снимка (обычно их нет — снимки обновляются при каждом импорте).
+    Операции берутся с точностью до дня, в том числе из архива.
+    """
+    cards = list(cards)
+    if not cards:
+        return 0.0
+    async with async_session() as session:
+        latest = (
+            select(CardDailyBalance.card_number, func.max(CardDailyBalance.day).label("day"))
+            .where(and_(CardDailyBalance.card_number.in_(cards), CardDailyBalance.day <= as_of))
+            .group_by(CardDailyBalance.card_number)
+            .subquery()
+        )
+        snapshots = (
+            await session.execute(
+                select(CardDailyBalance.card_number, CardDailyBalance.day, CardDailyBalance.balance)
+                .join(
+                    latest,
+                    and_(
+                        CardDailyBalance.card_number == latest.c.card_number,
+                        CardDailyBalance.day == latest.c.day,
+                    ),
+                )
+            )
+        ).all()
+
+        balance = sum(row.balance for row in snapshots)
+        snapshot_days = {row.card_number: row.day for row in snapshots}
+        rows = _day_level_rows(cards)
+        # операции после снимка (или с начала, если снимка нет) до конца дня as_of
+        after_snapshot = [
+            and_(
+                rows.c.card_number == card,
+                rows.c.date >= datetime.combine(snapshot_days[card] + timedelta(days=1), datetime.min.time()),
+            )
+            for card in snapshot_days
+        ]
+        without_snapshot = [card for card in cards if card not in snapshot_days]
+        if without_snapshot:
+            after_snapshot.append(rows.c.card_number.in_(without_snapshot))
+        delta = await session.scalar(
+            select(func.coalesce(func.sum(rows.c.amount), 0.0)).where(
+                and_(
+                    or_(*after_snapshot),
+                    rows.c.date < datetime.combine(as_of + timedelta(days=1), datetime.min.time()),
+                )
+            )
+        )
+        return float(balance) + float(delta or 0.0)
+
+
+async def get_balance_as_of(telegram_id: int, as_of: date) -> float:
+    """Баланс пользователя по всем его картам на конец дня as_of."""
+    cards = await get_all_user_cards(telegram_id)
+    return await get_cards_balance_as_of(cards, as_of)
+
+
+def _escape_like(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+async def search_transactions(
+    query: str,
+    start_date: datetime = None,
+    end_date: datetime = None,
+    t_type: TransactionType = None,
+    limit: int = 10,
+    offset: int = 0,
+):
+    """
+    Поиск сделок по части номера карты, адреса или наименования (ILIKE, ускоряется индексами pg_trgm).
+    Ищет и в transactions (без итоговых строк архива), и в transactions_archive;
+    у строк есть признак archived. Возвращает (строки страницы, есть ли следующая страница)
+    — без COUNT по всей таблице.
+    """
+    pattern = f"%{_escape_like(query)}%"
+
+    def matches(model, archived: bool, *extra):
+        filters = [
+            or_(
+                model.card_number.ilike(pattern, escape="\\"),
+                model.address.ilike(pattern, escape="\\"),
+                model.item_name.ilike(pattern, escape="\\"),
+            ),
+            *extra,
+        ]
+        if start_date is not None:
+            filters.append(model.date >= start_date)
+        if end_date is not None:
+            filters.append(model.date <= end_date)
+        if t_type is not None:
+            filters.append(model.type == t_type)
+        return select(
+            model.id.label("id"),
+            model.date.label("date"),
+            model.card_number.label("card_number"),
+            model.type.label("type"),
+            model.address.label("address"),
+            model.item_name.label("item_name"),
+            model.cost.label("cost"),
+            model.document.label("document"),
+            literal(archived).label("archived"),
+        ).where(and_(*filters))
+
+    found = union_all(
+        matches(Transaction, False, is_not_archive_summary()), matches(TransactionArchive, True)
+    ).subquery()
+    async with async_session() as session:
+        result = await session.execute(
+            select(found)
+            .order_by(found.c.date.desc(), found.c.id.desc())
+            .limit(limit + 1)
+            .offset(offset)
+        )
+        rows = result.all()
+    return rows[:limit], len(rows) > limit
+
+
+# Сессионные advisory-блокировки кластера (только Postgres) на выделенном соединении
+async def advisory_lock(conn, key: int):
+    # ожидание блокировки длится, пока задание другого экземпляра не закончится
+    await _without_statement_timeout(conn)
+    await conn.execute(select(func.pg_advisory_lock(key)))
+    await conn.commit()
+
+
+async def advisory_unlock(conn, key: int):
+    await conn.execute(select(func.pg_advisory_unlock(key)))
+    await conn.commit()
+
+
+async def try_advisory_lock(conn, key: int) -> bool:
+    acquired = await conn.scalar(select(func.pg_try_advisory_lock(key)))
+    await conn.commit()
+    return bool(acquired)
+
+
+async def ping(conn):
+    await conn.execute(select(literal(1)))
+
+
+# Канал LISTEN/NOTIFY для сброса кэшей на остальных экземплярах бота
+CACHE_CHANNEL = "roadcards_cache"
+
+
+async def publish_cache_invalidation(payload: str):
+    if not IS_POSTGRES:
+        return
+    async with async_session() as session:
+        await session.execute(select(func.pg_notify(CACHE_CHANNEL, payload)))
+        await session.commit()
+
+
+def _upsert(model):
+    """INSERT с поддержкой ON CONFLICT в диалекте текущего движка."""
+    return (pg_insert if IS_POSTGRES else sqlite_insert)(model)
+
+
+async def get_fsm_record(key: str) -> FsmRecord:
+    async with async_session() as session:
+        return await session.get(FsmRecord, key)
+
+
+async def save_fsm_record(key: str, **values):
+    """Создаёт или обновляет запись FSM (state и/или data) одним INSERT ... ON CONFLICT."""
+    values["updated_at"] = datetime.now()
+    stmt = _upsert(FsmRecord).values(key=key, **values)
+    stmt = stmt.on_conflict_do_update(index_elements=[FsmRecord.key], set_=values)
+    async with async_session() as session:
+        await session.execute(stmt)
+        await session.commit()
+
+
+async def get_setting(key: str):
+    async with async_session() as session:
+        return await session.scalar(select(AppSetting.value).where(AppSetting.key == key))
+
+
+async def set_setting(key: str, value: str):
+    now = datetime.now()
+    stmt = _upsert(AppSetting).values(key=key, value=value, updated_at=now)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[AppSetting.key], set_={"value": value, "updated_at": now}
+    )
+    async with async_session() as session:
+        await session.execute(stmt)
+        await session.commit()
+
+
+async def reserve_statement(telegram_id: int, daily_limit: int) -> bool:
+    """
+    Атомарно занимает одну выписку из дневного лимита пользователя.
+    False — лимит на сегодня исчерпан. Счётчик общий для всех экземпляров бота.
+    """
+    if daily_limit <= 0:
+        return False
+    today = date.today()
+    stmt = _upsert(StatementUsage).values(telegram_id=telegram_id, day=today, count=1)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[StatementUsage.telegram_id, StatementUsage.day],
+        set_={"count": StatementUsage.count + 1},
+        where=StatementUsage.count < daily_limit,
+    ).returning(StatementUsage.count)
+    async with async_session() as session:
+        reserved = (await session.execute(stmt)).scalar() is not None
+        # счётчики прошлых дней больше не нужны
+        await session.execute(
+            delete(StatementUsage).where(
+                StatementUsage.telegram_id == telegram_id, StatementUsage.day < today
+            )
+        )
+        await session.commit()
+    return reserved
+
+
+async def release_statement(telegram_id: int):
+    """Возвращает занятую выписку в лимит (выписку не удалось сформировать)."""
+    async with async_session() as session:
+        await session.execute(
+            update(StatementUsage)
+            .where(
+                StatementUsage.telegram_id == telegram_id,
+                StatementUsage.day == date.today(),
+                StatementUsage.count > 0,
+            )
+            .values(count=StatementUsage.count - 1)
+        )
+        await session.commit()
+
+
+async def claim_document_label(label: str) -> bool:
+    """Регистрирует метку документа; False — такую метку уже выдал этот или другой экземпляр."""
+    stmt = (
+        _upsert(DocumentLabel)
+        .values(label=label, issued_at=datetime.now())
+        .on_conflict_do_nothing(index_elements=[DocumentLabel.label])
+        .returning(DocumentLabel.label)
+    )
+    async with async_session() as session:
+        claimed = (await session.execute(stmt)).scalar() is not None
+        await session.commit()
+    return claimed
+
+
+# Водяной знак догоняющего пересчёта: id последней сделки, по которой итоги уже пересчитаны
+ROLLUP_WATERMARK_KEY = "rollup_watermark"
+
+
+async def advance_rollup_watermark(up_to: int = None):
+    """
+    Сдвигает водяной знак до up_to (None — до текущего max(transactions.id)), только вперёд.
+    Вызывается после пересчёта итогов импортом, поэтому периодический проход
+    не пересчитывает те же сделки повторно. Пока знака нет (планировщик ещё не запускался),
+    ничего не делает.
+    """
+    target = literal(up_to) if up_to is not None else select(func.max(Transaction.id)).scalar_subquery()
+    async with async_session() as session:
+        await session.execute(
+            update(AppSetting)
+            .where(and_(AppSetting.key == ROLLUP_WATERMARK_KEY, cast(AppSetting.value, Integer) < target))
+            .values(value=cast(target, String), updated_at=datetime.now())
+            .execution_options(synchronize_session=False)
+        )
+        await session.commit()
+
+
+async def get_changes_since(last_id: int):
+    """
+    Сделки с id больше водяного знака: (новый максимальный id, карты, месяцы трат (год, месяц)).
+    Нужно периодическому пересчёту, чтобы догнать изменения, прошедшие мимо after_data_change.
+    """
+    newer = Transaction.id > last_id
+    year = cast(extract("year", Transaction.date), Integer)
+    month = cast(extract("month", Transaction.date), Integer)
+    async with async_session() as session:
+        max_id = await session.scalar(select(func.max(Transaction.id)))
+        if max_id is None or max_id <= last_id:
+            return last_id, set(), set()
+        cards = await session.execute(select(Transaction.card_number).where(newer).distinct())
+        months = await session.execute(
+            select(year, month)
+            .where(and_(newer, Transaction.type == TransactionType.EXPENSE))
+            .distinct()
+        )
+        return max_id, set(cards.scalars().all()), {(y, m) for y, m in months.all()}
+
+
+def _differs(a, b):
+    # суммы с плавающей точкой сравниваются с допуском в полкопейки
+    return func.abs(func.coalesce(a, 0.0) - func.coalesce(b, 0.0)) >= 0.005
+
+
+async def find_month_total_drift() -> set[str]:
+    """
+    Карты, у которых card_month_totals расходится с суммами по transactions.
+    Сравнение идёт в SQL (FULL OUTER JOIN итогов с агрегатом), в Python приходят только карты.
+    """
+    expected = _month_totals_select().subquery()
+    stored = CardMonthTotal
+    joined = expected.join(
+        stored,
+        and_(
+            expected.c.card_number == stored.card_number,
+            expected.c.year == stored.year,
+            expected.c.month == stored.month,
+            expected.c.type == stored.type,
+        ),
+        full=True,
+    )
+    async with async_session() as session:
+        await _without_statement_timeout(session)
+        result = await session.execute(
+            select(func.coalesce(expected.c.card_number, stored.card_number))
+            .select_from(joined)
+            .where(
+                or_(
+                    expected.c.card_number.is_(None),
+                    stored.card_number.is_(None),
+                    expected.c.count != stored.count,
+                    _differs(expected.c.liters, stored.liters),
+                    _differs(expected.c.cost, stored.cost),
+                )
+            )
+            .distinct()
+        )
+        return set(result.scalars().all())
+
+
+async def find_daily_balance_drift() -> set[str]:
+    """
+    Карты, у которых последний дневной баланс не равен итогу по сделкам
+    (или снимков нет, или остались снимки без сделок). Сравнение идёт в SQL.
+    """
+    rows = _day_level_rows()
+    expected = (
+        select(rows.c.card_number.label("card_number"), func.sum(rows.c.amount).label("balance"))
+        .group_by(rows.c.card_number)
+        .subquery()
+    )
+    latest = (
+        select(CardDailyBalance.card_number, func.max(CardDailyBalance.day).label("day"))
+        .group_by(CardDailyBalance.card_number)
+        .subquery()
+    )
+    stored = (
+        select(CardDailyBalance.card_number.label("card_number"), CardDailyBalance.balance.label("balance"))
+        .join(
+            latest,
+            and_(
+                CardDailyBalance.card_number == latest.c.card_number,
+                CardDailyBalance.day == latest.c.day,
+            ),
+        )
+        .subquery()
+    )
+    async with async_session() as session:
+        await _without_statement_timeout(session)
+        result = await session.execute(
+            select(func.coalesce(expected.c.card_number, stored.c.card_number))
+            .select_from(expected.join(stored, expected.c.card_number == stored.c.card_number, full=True))
+            .where(
+                or_(
+                    expected.c.card_number.is_(None),
+                    stored.c.card_number.is_(None),
+                    _differs(expected.c.balance, stored.c.balance),
+                )
+            )
+        )
+        return set(result.scalars().all())
+
+
+# Каждая корутина модуля — отдельный span в трассировке обновления (если она включена)
+instrument_module(globals(), __name__)
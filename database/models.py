@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, BigInteger, String, Float, DateTime, Boolean, ForeignKey, Enum
+from sqlalchemy import Column, Integer, BigInteger, String, Text, Float, Date, DateTime, Boolean, ForeignKey, Enum, Index, UniqueConstraint
 from sqlalchemy.orm import declarative_base
 import enum
 
@@ -43,3 +43,143 @@ class Transaction(Base):
         "confirm_deleted_rows": False
     }
 
+
+class ImportCheckpoint(Base):
+    """Контрольная точка импорта отчёта: до какой строки файл уже сохранён в БД."""
+    __tablename__ = "import_checkpoints"
+
+    id = Column(Integer, primary_key=True)
+    file_hash = Column(String, unique=True, nullable=False)  # sha256 содержимого файла
+    document = Column(String, nullable=False)
+    last_row = Column(Integer, nullable=False)  # индекс строки DataFrame последней сохранённой пачки
+    finished = Column(Boolean, default=False, nullable=False)
+    updated_at = Column(DateTime, nullable=False)
+
+class CardMonthTotal(Base):
+    """
+    Предрасчитанные итоги по карте за месяц и тип операции (rollup над transactions).
+    Пересчитывается для затронутых карт после каждого импорта и отзыва документа.
+    """
+    __tablename__ = "card_month_totals"
+
+    id = Column(Integer, primary_key=True)
+    card_number = Column(String, nullable=False)
+    year = Column(Integer, nullable=False)
+    month = Column(Integer, nullable=False)
+    type = Column(Enum(TransactionType), nullable=False)
+    liters = Column(Float, nullable=False, default=0.0)
+    cost = Column(Float, nullable=False, default=0.0)
+    count = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        UniqueConstraint("card_number", "year", "month", "type"),
+        Index("ix_card_month_totals_period", "year", "month"),
+    )
+
+# Метка документа для итоговых строк, заменяющих архивированные сделки за месяц
+ARCHIVE_DOCUMENT_PREFIX = "archive:"
+
+class TransactionArchive(Base):
+    """Сделки, перенесённые из transactions в архив (id сохраняется исходный)."""
+    __tablename__ = "transactions_archive"
+
+    id = Column(Integer, primary_key=True)
+    card_number = Column(String, nullable=False, index=True)
+    document = Column(String, nullable=True)
+    firm = Column(String)
+    date = Column(DateTime, nullable=False, index=True)
+    address = Column(String)
+    item_name = Column(String)
+    quantity = Column(Float)
+    price = Column(Float)
+    cost = Column(Float)
+    type = Column(Enum(TransactionType), nullable=False)
+    archived_at = Column(DateTime, nullable=False)
+
+class ArchivedMonth(Base):
+    """
+    Сколько сделок заменено итоговой строкой за месяц по карте и типу.
+    Нужно, чтобы количество заправок оставалось верным после архивации.
+    """
+    __tablename__ = "archived_months"
+
+    id = Column(Integer, primary_key=True)
+    card_number = Column(String, nullable=False, index=True)
+    year = Column(Integer, nullable=False)
+    month = Column(Integer, nullable=False)
+    type = Column(Enum(TransactionType), nullable=False)
+    row_count = Column(Integer, nullable=False)
+    summary_transaction_id = Column(Integer, nullable=False)
+
+class CardDailyBalance(Base):
+    """
+    Баланс карты (траты минус оплаты, нарастающим итогом) на конец каждого дня,
+    в который по карте были операции. Пересчитывается после импорта и отзыва документа.
+    """
+    __tablename__ = "card_daily_balances"
+
+    id = Column(Integer, primary_key=True)
+    card_number = Column(String, nullable=False)
+    day = Column(Date, nullable=False)
+    balance = Column(Float, nullable=False)
+
+    __table_args__ = (
+        UniqueConstraint("card_number", "day"),
+    )
+
+class StationMonthPrice(Base):
+    """
+    Индекс цен АЗС: средняя (взвешенная по литрам), минимальная и максимальная цена
+    по адресу станции и виду топлива за месяц, плюс литры и сумма. Строится по тратам
+    из transactions и transactions_archive; пересчитывается по затронутым месяцам после импорта.
+    """
+    __tablename__ = "station_month_prices"
+
+    id = Column(Integer, primary_key=True)
+    address = Column(String, nullable=False)
+    item_name = Column(String, nullable=False)
+    year = Column(Integer, nullable=False)
+    month = Column(Integer, nullable=False)
+    avg_price = Column(Float)
+    min_price = Column(Float)
+    max_price = Column(Float)
+    liters = Column(Float, nullable=False, default=0.0)
+    cost = Column(Float, nullable=False, default=0.0)
+    count = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        UniqueConstraint("address", "item_name", "year", "month"),
+        Index("ix_station_month_prices_period", "year", "month"),
+    )
+
+class FsmRecord(Base):
+    """Состояние FSM и данные диалога пользователя — общие для всех экземпляров бота."""
+    __tablename__ = "fsm_records"
+
+    key = Column(String, primary_key=True)
+    state = Column(String, nullable=True)
+    data = Column(Text, nullable=True)
+    updated_at = Column(DateTime, nullable=False)
+
+class AppSetting(Base):
+    """Общие для всех экземпляров значения (например, время последнего обновления данных)."""
+    __tablename__ = "app_settings"
+
+    key = Column(String, primary_key=True)
+    value = Column(Text, nullable=True)
+    updated_at = Column(DateTime, nullable=False)
+
+class StatementUsage(Base):
+    """Сколько выписок пользователь сформировал за день — счётчик, общий для всех экземпляров."""
+    __tablename__ = "statement_usage"
+
+    telegram_id = Column(BigInteger, primary_key=True)
+    day = Column(Date, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+class DocumentLabel(Base):
+    """Выданные метки документов: первичный ключ не даёт двум экземплярам выдать одну метку."""
+    __tablename__ = "document_labels"
+
+    label = Column(String, primary_key=True)
+    issued_at = Column(DateTime, nullable=False)
@@ -1,10 +1,58 @@
 import asyncio
 import logging
-from aiogram import Bot, Dispatcher
-from aiogram.fsm.storage.memory import MemoryStorage
-from config import BOT_TOKEN
-from bot.handlers import user, admin
-from database.db import init_db
+from bot.startup import startup_profile
+
+# Импорты замеряются по модулям; pandas/openpyxl подгружаются только при первой загрузке/выгрузке
+with startup_profile.phase("import aiogram"):
+    from aiogram import Bot, Dispatcher
+    from aiogram.fsm.storage.memory import MemoryStorage
+with startup_profile.phase("import config"):
+    from config import (
+        BOT_TOKEN,
+        DB_POOL_STATS_INTERVAL,
+        STARTUP_BUDGET_MS,
+        WEBHOOK_URL,
+        WEBHOOK_PATH,
+        WEBHOOK_SECRET,
+        WEBAPP_HOST,
+        WEBAPP_PORT,
+        FSM_STORAGE,
+    )
+with startup_profile.phase("import database.db"):
+    from database.db import init_db, log_pool_stats
+with startup_profile.phase("import bot.handlers"):
+    from bot.handlers import user, admin
+with startup_profile.phase("import bot services"):
+    from bot.middlewares import throttling_middleware
+    from bot.ingest import start_ingestion
+    from bot.notify import notifier
+    from bot.jobs import job_queue
+    from bot.cluster import leader, listen_cache_invalidations
+    from bot.scheduler import start_scheduler
+    from bot.storage import DatabaseStorage
+    from tracing import tracer, TracingRequestMiddleware
+
+async def register_webhook(bot: Bot):
+    await bot.set_webhook(f"{WEBHOOK_URL}{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET or None)
+    logging.info(f"Webhook set to {WEBHOOK_URL}{WEBHOOK_PATH}")
+
+async def run_webhook_server(dp: Dispatcher, bot: Bot):
+    from aiohttp import web
+    from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET or None).register(
+        app, path=WEBHOOK_PATH
+    )
+    setup_application(app, dp, bot=bot)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBAPP_HOST, WEBAPP_PORT).start()
+    logging.info(f"Webhook server listening on {WEBAPP_HOST}:{WEBAPP_PORT}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
 
 async def main():
     logging.basicConfig(level=logging.INFO)
@@ -14,7 +62,8 @@ async def main():
     retry_delay = 5
     for i in range(max_retries):
         try:
-            await init_db()
+            with startup_profile.phase("init_db"):
+                await init_db()
             logging.info("Database initialized successfully")
             break
         except Exception as e:
@@ -26,14 +75,62 @@ async def main():
                 return
     
     bot = Bot(token=BOT_TOKEN)
-    dp = Dispatcher(storage=MemoryStorage())
+    # Каждый вызов Bot API попадает в трассировку обновления
+    if tracer.enabled:
+        bot.session.middleware(TracingRequestMiddleware())
+    # Состояния диалогов в БД, если следующий шаг может прийти на другой экземпляр бота (webhook)
+    storage = DatabaseStorage() if FSM_STORAGE == "db" else MemoryStorage()
+    dp = Dispatcher(storage=storage)
     
+    # Фиксируем время до первого обновления для отчёта о запуске
+    dp.update.outer_middleware(startup_profile.first_update_middleware)
+
+    # Трассировка обновлений с замером вызовов БД и Bot API (TRACE_FILE)
+    dp.update.outer_middleware(tracer.update_middleware)
+
+    # Ограничение частоты и склейка повторных callback-запросов до обращения к БД
+    dp.callback_query.outer_middleware(throttling_middleware)
+
     # Register routers
     dp.include_router(admin.router)
     dp.include_router(user.router)
     
-    # Start polling
-    await dp.start_polling(bot)
+    # Периодическая статистика пула соединений для подбора его размера
+    if DB_POOL_STATS_INTERVAL > 0:
+        notifier.spawn(log_pool_stats(DB_POOL_STATS_INTERVAL))
+
+    # Отправка уведомлений пользователям с ограничением скорости
+    notifier.start(bot)
+
+    # Фоновые задания (пакетные импорты из ZIP, рассылка)
+    job_queue.start()
+
+    # Сброс кэшей по сообщениям других экземпляров и выбор ведущего для одиночных задач
+    notifier.spawn(listen_cache_invalidations())
+    leader.start()
+
+    # Загрузка отчётов из локальной папки (если настроена) — только на ведущем
+    ingestor = start_ingestion(bot)
+
+    # Периодический догон итогов и ночная сверка — тоже только на ведущем
+    start_scheduler()
+
+    startup_profile.mark_ready()
+    logging.info(startup_profile.report())
+    if STARTUP_BUDGET_MS and not startup_profile.within_budget(STARTUP_BUDGET_MS):
+        logging.warning(f"Startup exceeded budget of {STARTUP_BUDGET_MS:.0f} ms")
+
+    if WEBHOOK_URL:
+        # Обновления принимает каждый экземпляр, webhook регистрирует ведущий
+        leader.run_while_leader("webhook", lambda: register_webhook(bot))
+        await run_webhook_server(dp, bot)
+    else:
+        # Polling допускает только один процесс: остальные ждут в резерве
+        leader.run_while_leader(
+            "polling",
+            lambda: dp.start_polling(bot, handle_signals=False, close_bot_session=False),
+        )
+        await asyncio.Event().wait()
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,94 @@
+"""
+Микробенчмарк разбора отчёта: прежний путь (df.iterrows() + ORM Transaction в сессии)
+против iter_parsed_rows (колонки целиком + ParsedRow). Замеряются удерживаемая память
+на строку (tracemalloc) и скорость построения строк. БД не нужна.
+Запуск: python tests/bench_import_rows.py
+"""
+import os
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pandas as pd  # noqa: E402
+from sqlalchemy.orm import Session  # noqa: E402
+
+from bot.reports import iter_parsed_rows, parse_report_date  # noqa: E402
+from database.models import Transaction, TransactionType  # noqa: E402
+
+ROW_COUNTS = (1000, 20000)
+
+
+def make_frame(count: int):
+    start = datetime(2026, 1, 1)
+    return pd.DataFrame(
+        {
+            "card": [f"78260101{i % 500:08d}" for i in range(count)],
+            "date": [start + timedelta(minutes=i) for i in range(count)],
+            "firm": ["ООО Ромашка"] * count,
+            "address": [f"АЗС {i % 40}" for i in range(count)],
+            "item_name": ["АИ-95"] * count,
+            "quantity": [10.0 + i % 7 for i in range(count)],
+            "price": [50.0] * count,
+            "cost": [(10.0 + i % 7) * 50.0 for i in range(count)],
+        }
+    )
+
+
+def iterrows_orm(df):
+    # так строки собирались до ParsedRow: Series на строку и ORM-объект в сессии
+    session = Session()
+    for _, row in df.iterrows():
+        session.add(
+            Transaction(
+                card_number=str(row["card"]),
+                document="bench",
+                firm=str(row["firm"]),
+                date=parse_report_date(row["date"]),
+                address=str(row["address"]),
+                item_name=str(row["item_name"]),
+                quantity=float(row["quantity"]),
+                price=float(row["price"]),
+                cost=float(row["cost"]),
+                type=TransactionType.EXPENSE,
+            )
+        )
+    return session
+
+
+def parsed_rows(df):
+    return list(iter_parsed_rows(df))
+
+
+def bytes_per_row(build, df) -> float:
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = build(df)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+    return (after - before) / len(df)
+
+
+def rows_per_second(build, df) -> float:
+    started = time.perf_counter()
+    build(df)
+    return len(df) / (time.perf_counter() - started)
+
+
+def main():
+    cases = [("iterrows + ORM", iterrows_orm), ("iter_parsed_rows", parsed_rows)]
+    print(f"{'rows':>7}  {'path':<18}{'B/row':>8}{'rows/s':>10}")
+    for count in ROW_COUNTS:
+        df = make_frame(count)
+        for name, build in cases:
+            build(df.head(100))  # прогрев
+            memory = bytes_per_row(build, df)
+            speed = rows_per_second(build, df)
+            print(f"{count:>7}  {name:<18}{memory:>8.0f}{speed:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+Микробенчмарк клавиатур: построение с нуля (кэш очищен) и повторный вызов из кэша.
+Запуск: python tests/bench_keyboards.py
+"""
+import os
+import sys
+import timeit
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bot import keyboards  # noqa: E402
+from bot.cache import TransactionSnapshot  # noqa: E402
+from database.models import TransactionType  # noqa: E402
+
+NUMBER = 2000
+
+TRANSACTIONS = [
+    TransactionSnapshot(i, "7826010100000000", datetime(2026, 1, 1, 10, i), "АИ-95", 1.0, TransactionType.EXPENSE)
+    for i in range(10)
+]
+CARDS = ["7826010100000001", "7826010100000002", "7826010100000003"]
+
+CACHES = [
+    keyboards.get_user_main_menu,
+    keyboards.get_user_my_cards_kb,
+    keyboards._transaction_button,
+    keyboards._transactions_pagination,
+    keyboards._user_delete_cards_kb,
+    keyboards.get_transaction_details_kb,
+]
+
+CASES = [
+    ("main_menu", keyboards.get_user_main_menu),
+    ("my_cards", keyboards.get_user_my_cards_kb),
+    ("transactions_page", lambda: keyboards.get_transactions_kb(TRANSACTIONS, 3, 10)),
+    ("delete_cards", lambda: keyboards.get_user_delete_cards_kb(CARDS)),
+    ("transaction_details", lambda: keyboards.get_transaction_details_kb(3)),
+]
+
+
+def cold(build):
+    def run():
+        for cached in CACHES:
+            cached.cache_clear()
+        build()
+    return run
+
+
+def per_call_us(func) -> float:
+    return timeit.timeit(func, number=NUMBER) / NUMBER * 1e6
+
+
+def main():
+    clear_cost = per_call_us(cold(lambda: None))
+    print(f"{'keyboard':<22}{'cold, us':>10}{'cached, us':>12}")
+    for name, build in CASES:
+        cold_us = per_call_us(cold(build)) - clear_cost
+        cached_us = per_call_us(build)
+        print(f"{name:<22}{cold_us:>10.1f}{cached_us:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
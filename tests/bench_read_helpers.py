@@ -0,0 +1,151 @@
+"""
+Микробенчмарк горячих запросов: запрос, собираемый заново на каждый вызов
+(select(...).in_(cards), как было раньше), против заранее собранных _user_*_stmt
+с параметром cards. Замеряются сборка+компиляция без БД и выполнение через сессию
+на разном числе карт.
+Запуск: DATABASE_URL=sqlite+aiosqlite:///:memory: python tests/bench_read_helpers.py
+"""
+import asyncio
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import case, func, select  # noqa: E402
+
+from database import db  # noqa: E402
+from database.models import Transaction, TransactionType  # noqa: E402
+
+CARD_COUNTS = (1, 5, 20, 100)
+COMPILE_NUMBER = 2000
+EXECUTE_NUMBER = 300
+
+
+def inline_balance_stmt(cards):
+    return select(
+        func.coalesce(
+            func.sum(
+                case(
+                    (Transaction.type == TransactionType.EXPENSE, Transaction.cost),
+                    else_=-Transaction.cost,
+                )
+            ),
+            0.0,
+        )
+    ).where(Transaction.card_number.in_(cards))
+
+
+def inline_transactions_stmt(cards):
+    return (
+        select(Transaction)
+        .where(Transaction.card_number.in_(cards))
+        .order_by(Transaction.date.desc())
+        .limit(10)
+        .offset(0)
+    )
+
+
+def make_cards(count: int) -> list[str]:
+    return [f"B{i:06d}" for i in range(count)]
+
+
+def per_call_us(func, number: int) -> float:
+    started = time.perf_counter()
+    for _ in range(number):
+        func()
+    return (time.perf_counter() - started) / number * 1e6
+
+
+async def per_call_async_us(func, number: int) -> float:
+    started = time.perf_counter()
+    for _ in range(number):
+        await func()
+    return (time.perf_counter() - started) / number * 1e6
+
+
+def bench_compile():
+    dialect = db.engine.dialect
+    print(f"build + compile ({dialect.name}), us per call")
+    print(f"{'cards':>6}{'inline':>10}{'prebuilt':>10}")
+    for count in CARD_COUNTS:
+        cards = make_cards(count)
+        inline = per_call_us(lambda: inline_balance_stmt(cards).compile(dialect=dialect), COMPILE_NUMBER)
+        prebuilt = per_call_us(lambda: db._user_balance_stmt.compile(dialect=dialect), COMPILE_NUMBER)
+        print(f"{count:>6}{inline:>10.1f}{prebuilt:>10.1f}")
+
+
+async def seed(cards_total: int):
+    await db.init_db()
+    start = datetime(2026, 1, 1)
+    rows = [
+        {
+            "card_number": card,
+            "document": "bench",
+            "firm": "",
+            "date": start + timedelta(hours=i),
+            "address": "АЗС",
+            "item_name": "АИ-95",
+            "quantity": 10.0,
+            "price": 50.0,
+            "cost": 500.0,
+            "type": TransactionType.EXPENSE,
+        }
+        for card in make_cards(cards_total)
+        for i in range(20)
+    ]
+    async with db.async_session() as session:
+        await db.insert_transactions(session, rows)
+        await session.commit()
+
+
+async def bench_execute():
+    print(f"execute through a session ({db.engine.dialect.name}), us per call")
+    print(f"{'cards':>6}{'query':>14}{'inline':>10}{'prebuilt':>10}")
+    for count in CARD_COUNTS:
+        cards = make_cards(count)
+        cases = [
+            (
+                "balance",
+                lambda: inline_balance_stmt(cards),
+                lambda: (db._user_balance_stmt, {"cards": cards}),
+            ),
+            (
+                "transactions",
+                lambda: inline_transactions_stmt(cards),
+                lambda: (db._user_transactions_stmt, {"cards": cards, "limit": 10, "offset": 0}),
+            ),
+        ]
+        for name, inline_build, prebuilt_build in cases:
+            async with db.async_session() as session:
+                async def inline():
+                    (await session.execute(inline_build())).all()
+
+                async def prebuilt():
+                    stmt, params = prebuilt_build()
+                    (await session.execute(stmt, params)).all()
+
+                # прогрев: кэш компиляции SQLAlchemy и prepared statements
+                await inline()
+                await prebuilt()
+                inline_us = await per_call_async_us(inline, EXECUTE_NUMBER)
+                prebuilt_us = await per_call_async_us(prebuilt, EXECUTE_NUMBER)
+            print(f"{count:>6}{name:>14}{inline_us:>10.1f}{prebuilt_us:>10.1f}")
+
+
+async def main():
+    bench_compile()
+    print()
+    await seed(max(CARD_COUNTS))
+    try:
+        await bench_execute()
+    finally:
+        async with db.async_session() as session:
+            await session.execute(db.delete(Transaction).where(Transaction.document == "bench"))
+            await session.commit()
+        await db.engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
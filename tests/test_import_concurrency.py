@@ -0,0 +1,170 @@
+"""
+Параллельные импорты за один месяц (как при загрузке ZIP с отчётами за конец месяца)
+и одновременные пересчёты одних карт: ни один не должен упасть на вставке итогов,
+а итоги должны совпасть со сделками. Одновременные импорты одного и того же отчёта
+не должны записать строки дважды.
+Нужна БД из DATABASE_URL/DB_HOST, например Postgres из docker-compose:
+    docker compose run --rm bot sh -c "pip install pytest && python -m pytest tests"
+"""
+import asyncio
+import uuid
+from datetime import datetime
+
+import pandas as pd
+import pytest
+from sqlalchemy import delete, select
+
+from bot.reports import after_data_change, save_transactions
+from database.db import engine, async_session, init_db
+from database.models import (
+    CardDailyBalance,
+    CardMonthTotal,
+    StationMonthPrice,
+    Transaction,
+    TransactionType,
+    Whitelist,
+)
+
+IMPORTS = 8
+CARDS = 20
+
+
+def make_frame(cards, address: str, day: int):
+    return pd.DataFrame(
+        [
+            {
+                "card": card,
+                "date": datetime(2001, 1, day, 12, 0),
+                "firm": "",
+                "address": address,
+                "item_name": "АИ-95",
+                "quantity": 10.0,
+                "price": 50.0,
+                "cost": 500.0,
+            }
+            for card in cards
+        ]
+    )
+
+
+async def cleanup(cards, address: str):
+    async with async_session() as session:
+        for model in (Transaction, CardMonthTotal, CardDailyBalance, Whitelist):
+            await session.execute(delete(model).where(model.card_number.in_(cards)))
+        await session.execute(delete(StationMonthPrice).where(StationMonthPrice.address == address))
+        await session.commit()
+
+
+async def require_database():
+    try:
+        await init_db()
+    except (OSError, ConnectionError) as e:
+        pytest.skip(f"database is not available: {e}")
+
+
+async def run_parallel_imports():
+    await require_database()
+
+    run_id = uuid.uuid4().hex[:8]
+    # у каждого импорта свои карты (пачки пишутся параллельно), месяц и АЗС общие
+    batches = [[f"T{run_id}{n:02d}{i:03d}" for i in range(CARDS)] for n in range(IMPORTS)]
+    cards = [card for batch in batches for card in batch]
+    address = f"АЗС {run_id}"
+    try:
+        results = await asyncio.gather(
+            *(
+                save_transactions(make_frame(batch, address, n + 1), TransactionType.EXPENSE, f"test_{run_id}_{n}")
+                for n, batch in enumerate(batches)
+            ),
+            return_exceptions=True,
+        )
+        for result in results:
+            assert not isinstance(result, BaseException), repr(result)
+            added, skipped, collisions = result
+            assert (added, skipped) == (CARDS, 0)
+            collisions.discard()
+
+        # повторные пересчёты одних и тех же карт и месяца одновременно
+        results = await asyncio.gather(
+            *(after_data_change(cards, {(2001, 1)}) for _ in range(IMPORTS)),
+            return_exceptions=True,
+        )
+        for result in results:
+            assert not isinstance(result, BaseException), repr(result)
+
+        async with async_session() as session:
+            totals = (
+                await session.execute(select(CardMonthTotal).where(CardMonthTotal.card_number.in_(cards)))
+            ).scalars().all()
+            balances = (
+                await session.execute(select(CardDailyBalance).where(CardDailyBalance.card_number.in_(cards)))
+            ).scalars().all()
+            prices = (
+                await session.execute(select(StationMonthPrice).where(StationMonthPrice.address == address))
+            ).scalars().all()
+
+        assert len(totals) == len(cards)
+        assert all(t.count == 1 and t.cost == 500.0 for t in totals)
+        assert len(balances) == len(cards)
+        assert all(b.balance == 500.0 for b in balances)
+        assert len(prices) == 1
+        assert prices[0].count == len(cards)
+    finally:
+        await cleanup(cards, address)
+
+
+async def run_parallel_same_frame_imports():
+    await require_database()
+
+    run_id = uuid.uuid4().hex[:8]
+    cards = [f"S{run_id}{i:03d}" for i in range(CARDS)]
+    address = f"АЗС {run_id}"
+    frame = make_frame(cards, address, 1)
+    try:
+        results = await asyncio.gather(
+            *(
+                save_transactions(frame.copy(), TransactionType.EXPENSE, f"test_{run_id}_{n}")
+                for n in range(IMPORTS)
+            ),
+            return_exceptions=True,
+        )
+        counts = []
+        for result in results:
+            assert not isinstance(result, BaseException), repr(result)
+            added, skipped, collisions = result
+            counts.append((added, skipped))
+            collisions.discard()
+
+        # строки записал ровно один импорт, остальные увидели их как дубликаты
+        assert counts.count((len(frame), 0)) == 1
+        assert counts.count((0, len(frame))) == IMPORTS - 1
+
+        async with async_session() as session:
+            stored = (
+                await session.execute(
+                    select(Transaction.card_number).where(Transaction.card_number.in_(cards))
+                )
+            ).scalars().all()
+        assert sorted(stored) == sorted(cards)
+    finally:
+        await cleanup(cards, address)
+
+
+def test_parallel_imports_disjoint_cards_same_month():
+    async def scenario():
+        try:
+            await run_parallel_imports()
+        finally:
+            await engine.dispose()
+
+    asyncio.run(scenario())
+
+
+def test_parallel_imports_same_frame():
+    async def scenario():
+        try:
+            await run_parallel_same_frame_imports()
+        finally:
+            await engine.dispose()
+
+    asyncio.run(scenario())
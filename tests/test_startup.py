@@ -0,0 +1,57 @@
+"""
+Запуск укладывается в бюджет и не тянет тяжёлые модули: pandas и openpyxl
+импортируются только при работе с отчётами. Импорт main и init_db идут в отдельном
+процессе на временной SQLite, чтобы sys.modules и замер не зависели от других тестов.
+Бюджет с запасом на медленные CI-машины; для прода задаётся STARTUP_BUDGET_MS.
+"""
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STARTUP_BUDGET_MS = float(os.getenv("TEST_STARTUP_BUDGET_MS", "10000"))
+
+SCRIPT = """
+import asyncio
+import sys
+
+import main
+from bot.startup import startup_profile
+from database.db import engine, init_db
+
+heavy = sorted(name for name in ("pandas", "openpyxl") if name in sys.modules)
+
+
+async def start():
+    with startup_profile.phase("init_db"):
+        await init_db()
+    startup_profile.mark_ready()
+    await engine.dispose()
+
+
+asyncio.run(start())
+print(startup_profile.report())
+print("heavy:", ",".join(heavy))
+print("within_budget:", startup_profile.within_budget(float(sys.argv[1])))
+"""
+
+
+def test_startup_within_budget_without_heavy_imports():
+    env = dict(
+        os.environ,
+        BOT_TOKEN="1:test",
+        DATABASE_URL="sqlite+aiosqlite:///:memory:",
+        DATABASE_READ_URL="",
+        TRACE_FILE="",
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", SCRIPT, str(STARTUP_BUDGET_MS)],
+        cwd=ROOT,
+        env=env,
+        capture_output=True,
+        text=True,
+        timeout=120,
+    )
+    assert result.returncode == 0, result.stderr
+    assert "heavy: \n" in result.stdout, result.stdout
+    assert "within_budget: True" in result.stdout, result.stdout
@@ -0,0 +1,190 @@
+import functools
+import inspect
+import json
+import logging
+import random
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+
+from config import TRACE_FILE, TRACE_SAMPLE_RATE, TRACE_SLOW_MS
+
+logger = logging.getLogger(__name__)
+
+_current_trace = ContextVar("current_trace", default=None)
+
+
+class Trace:
+    """Трассировка одного обновления: id, длительность и вложенные spans (БД, Bot API)."""
+
+    def __init__(self, update_id, event_type: str, user_id):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.update_id = update_id
+        self.event_type = event_type
+        self.user_id = user_id
+        self.started_at = datetime.now()
+        self.started = time.perf_counter()
+        self.spans = []
+        self.finished = False
+
+    def add_span(self, name: str, kind: str, started: float, error: str = None):
+        # задачи, запущенные из хендлера, могут закончиться после записи трассировки
+        if self.finished:
+            return
+        span = {
+            "name": name,
+            "kind": kind,
+            "start_ms": round((started - self.started) * 1000, 2),
+            "duration_ms": round((time.perf_counter() - started) * 1000, 2),
+        }
+        if error:
+            span["error"] = error
+        self.spans.append(span)
+
+    def to_record(self, duration_ms: float, error: str = None) -> dict:
+        record = {
+            "trace_id": self.trace_id,
+            "update_id": self.update_id,
+            "type": self.event_type,
+            "user_id": self.user_id,
+            "start": self.started_at.isoformat(timespec="milliseconds"),
+            "duration_ms": round(duration_ms, 2),
+            "spans": self.spans,
+        }
+        if error:
+            record["error"] = error
+        return record
+
+
+def current_trace_id():
+    trace = _current_trace.get()
+    return trace.trace_id if trace else None
+
+
+@contextmanager
+def span(name: str, kind: str = "code"):
+    """Замер участка кода внутри текущей трассировки (без трассировки — ничего не делает)."""
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    except GeneratorExit:
+        # асинхронный генератор закрыли до конца итерации — это не ошибка
+        trace.add_span(name, kind, started)
+        raise
+    except BaseException as e:
+        trace.add_span(name, kind, started, type(e).__name__)
+        raise
+    trace.add_span(name, kind, started)
+
+
+def traced(kind: str, name: str = None):
+    """Декоратор корутины или асинхронного генератора: каждый вызов — span."""
+    def decorator(func):
+        span_name = name or func.__name__
+        if inspect.isasyncgenfunction(func):
+            @functools.wraps(func)
+            async def gen_wrapper(*args, **kwargs):
+                with span(span_name, kind):
+                    async for item in func(*args, **kwargs):
+                        yield item
+            return gen_wrapper
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            if _current_trace.get() is None:
+                return await func(*args, **kwargs)
+            with span(span_name, kind):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def instrument_module(namespace: dict, module_name: str, kind: str = "db"):
+    """
+    Оборачивает все публичные корутины и асинхронные генераторы модуля в traced.
+    Вызывается в конце модуля; при выключенной трассировке ничего не меняет.
+    """
+    if not TRACE_FILE:
+        return
+    for attr, obj in list(namespace.items()):
+        if attr.startswith("_") or getattr(obj, "__module__", None) != module_name:
+            continue
+        if inspect.iscoroutinefunction(obj) or inspect.isasyncgenfunction(obj):
+            namespace[attr] = traced(kind)(obj)
+
+
+class Tracer:
+    """
+    Пишет трассировки обновлений в JSONL-файл: случайную долю sample_rate
+    и все обновления дольше slow_ms (их важно не потерять при малой выборке).
+    """
+
+    def __init__(self, path: str, sample_rate: float, slow_ms: float):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self.written = 0
+        self.dropped = 0
+        self._file = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    def _write(self, record: dict):
+        if self._file is None:
+            self._file = open(self.path, "a", encoding="utf-8", buffering=1)
+        self._file.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+
+    def finish(self, trace: Trace, error: str = None):
+        trace.finished = True
+        duration_ms = (time.perf_counter() - trace.started) * 1000
+        if duration_ms < self.slow_ms and random.random() >= self.sample_rate:
+            self.dropped += 1
+            return
+        try:
+            self._write(trace.to_record(duration_ms, error))
+            self.written += 1
+        except OSError as e:
+            logger.warning(f"Failed to write trace: {e}")
+
+    async def update_middleware(self, handler, event, data):
+        # outer-middleware для dp.update: открывает трассировку на время обработки
+        if not self.enabled:
+            return await handler(event, data)
+        user = data.get("event_from_user")
+        trace = Trace(event.update_id, event.event_type, user.id if user else None)
+        token = _current_trace.set(trace)
+        try:
+            result = await handler(event, data)
+        except BaseException as e:
+            self.finish(trace, type(e).__name__)
+            raise
+        finally:
+            _current_trace.reset(token)
+        self.finish(trace)
+        return result
+
+    def stats(self) -> dict:
+        return {"enabled": self.enabled, "written": self.written, "dropped": self.dropped}
+
+
+class TracingRequestMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота: каждый вызов Bot API — span в текущей трассировке."""
+
+    async def __call__(self, make_request, bot, method):
+        if _current_trace.get() is None:
+            return await make_request(bot, method)
+        with span(type(method).__name__, "bot_api"):
+            return await make_request(bot, method)
+
+
+tracer = Tracer(TRACE_FILE, TRACE_SAMPLE_RATE, TRACE_SLOW_MS)